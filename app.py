@@ -16,9 +16,6 @@
 ###############################################################################
 
 # server.py
-from flask import Flask, render_template,send_from_directory,request, jsonify
-from flask_sockets import Sockets
-import base64
 import time
 import json
 #import gevent
@@ -26,32 +23,42 @@ import json
 #from geventwebsocket.handler import WebSocketHandler
 import os
 import re
+import importlib
 import numpy as np
 from threading import Thread,Event
-#import multiprocessing
-import torch.multiprocessing as mp
+import multiprocessing as mp
 
 from aiohttp import web
 import aiohttp
 import aiohttp_cors
-from aiortc import RTCPeerConnection, RTCSessionDescription
-from aiortc.rtcrtpsender import RTCRtpSender
-from webrtc import HumanPlayer
+from logger import logger
 
 import argparse
 import random
 
 import shutil
 import asyncio
-import torch
 
+#torch/aiortc/模型和tts后端都在启动时按需导入(load_runtime), http服务可以先起来
 
-app = Flask(__name__)
-#sockets = Sockets(app)
 nerfreals = {}
+players = {}
 opt = None
 model = None
-avatar = None
+avatars = None #AvatarPool
+
+ready = Event() #模型和默认avatar加载完成
+startup = {'stage':'starting','error':None}
+import_times = {} #启动时各模块的导入耗时(ms)
+
+# 按依赖顺序导入, 每个模块只统计它自己新增的耗时
+STARTUP_MODULES = ('cv2','torch','av','aiortc','webrtc','basereal','lipreal')
+
+def timed_import(name):
+    t = time.perf_counter()
+    module = importlib.import_module(name)
+    import_times[name] = round((time.perf_counter()-t)*1000,1)
+    return module
 
 
 # def llm_response(message):
@@ -207,17 +214,42 @@ def randN(N):
     max = pow(10, N)
     return random.randint(min, max - 1)
 
-def build_nerfreal(sessionid):
+def build_nerfreal(sessionid,avatar_id=None):
     opt.sessionid=sessionid
-
+    from avatarpool import check_avatar_id
     from lipreal import LipReal
-    nerfreal = LipReal(opt,model,avatar)
+    avatar_id = check_avatar_id(avatar_id or opt.avatar_id)
+    avatar = avatars.acquire(avatar_id)
+    try:
+        nerfreal = LipReal(opt,model,avatar)
+    except:
+        avatars.release(avatar_id)
+        raise
+    nerfreal.avatar_id = avatar_id
 
     return nerfreal
 
+def release_nerfreal(nerfreal):
+    nerfreal.close()
+    avatars.release(nerfreal.avatar_id)
+
+def close_session(sessionid):
+    '''会话断开,释放会话持有的共享资源'''
+    players.pop(sessionid,None)
+    nerfreal = nerfreals.pop(sessionid,None)
+    if nerfreal is not None: #停止录制要等写线程,不在事件循环里执行
+        asyncio.get_event_loop().run_in_executor(None, release_nerfreal, nerfreal)
+
 #@app.route('/offer', methods=['POST'])
 async def offer(request):
     params = await request.json()
+    if not ready.is_set(): #加载完成前不导入aiortc, 避免和后台的启动导入抢锁
+        return not_ready()
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+    from aiortc.rtcrtpsender import RTCRtpSender
+    from webrtc import HumanPlayer
+    from outputprofile import ProfileAdapter
+
     offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
 
     if len(nerfreals) >= opt.max_session:
@@ -226,8 +258,20 @@ async def offer(request):
     sessionid = randN(6) #len(nerfreals)
     print('sessionid=',sessionid)
     nerfreals[sessionid] = None
-    nerfreal = await asyncio.get_event_loop().run_in_executor(None, build_nerfreal,sessionid)
+    try:
+        nerfreal = await asyncio.get_event_loop().run_in_executor(None, build_nerfreal,sessionid,params.get('avatar_id'))
+    except Exception as e:
+        logger.exception('build session')
+        del nerfreals[sessionid]
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": -1, "msg": f"load avatar failed: {e}"}
+            ),
+        )
     nerfreals[sessionid] = nerfreal
+    profile = params.get('profile',opt.output_profile) #1080p/720p/480p/360p/native
+    nerfreal.set_output_profile(profile)
     
     pc = RTCPeerConnection()
     pcs.add(pc)
@@ -238,12 +282,13 @@ async def offer(request):
         if pc.connectionState == "failed":
             await pc.close()
             pcs.discard(pc)
-            del nerfreals[sessionid]
+            close_session(sessionid)
         if pc.connectionState == "closed":
             pcs.discard(pc)
-            del nerfreals[sessionid]
+            close_session(sessionid)
 
     player = HumanPlayer(nerfreals[sessionid])
+    players[sessionid] = player
     audio_sender = pc.addTrack(player.audio)
     video_sender = pc.addTrack(player.video)
     capabilities = RTCRtpSender.getCapabilities("video")
@@ -258,6 +303,13 @@ async def offer(request):
     answer = await pc.createAnswer()
     await pc.setLocalDescription(answer)
 
+    codecs = getattr(transceiver,'_codecs',None) or []
+    player.set_video_codec(video_sender,codecs[0].name if codecs else None)
+    if opt.idle_passthrough and codecs and codecs[0].name=='H264': #只有H264可以透传缓存的待机视频
+        player.set_video_sender(video_sender)
+    if params.get('adaptive',opt.adaptive_profile): #根据接收端报告的丢包率升降档
+        asyncio.ensure_future(ProfileAdapter(nerfreal,video_sender,profile).run())
+
     #return jsonify({"sdp": pc.localDescription.sdp, "type": pc.localDescription.type})
 
     return web.Response(
@@ -327,16 +379,17 @@ async def record(request):
     params = await request.json()
 
     sessionid = params.get('sessionid',0)
+    result = {"code": 0, "data":"ok"}
     if params['type']=='start_record':
         # nerfreals[sessionid].put_msg_txt(params['text'])
-        nerfreals[sessionid].start_recording()
+        player = players.get(sessionid)
+        nerfreals[sessionid].start_recording(player.packet_tracks if player else None)
     elif params['type']=='end_record':
-        nerfreals[sessionid].stop_recording()
+        #停止录制会等写线程把剩余帧写完,放到线程池里执行
+        result['files'] = await asyncio.get_event_loop().run_in_executor(None, nerfreals[sessionid].stop_recording)
     return web.Response(
         content_type="application/json",
-        text=json.dumps(
-            {"code": 0, "data":"ok"}
-        ),
+        text=json.dumps(result),
     )
 
 async def is_speaking(request):
@@ -357,6 +410,93 @@ async def is_speaking(request):
         ),
     )
 
+async def stats(request):
+    params = await request.json()
+
+    sessionid = params.get('sessionid',0)
+    if sessionid not in players:
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": -1, "data": None, "msg": "Session not found"}
+            ),
+        )
+    return web.Response(
+        content_type="application/json",
+        text=json.dumps(
+            {"code": 0, "data": players[sessionid].stats()}
+        ),
+    )
+
+
+async def tts_cache(request):
+    from ttscache import cache_stats
+    return web.Response(
+        content_type="application/json",
+        text=json.dumps({"code": 0, "data": cache_stats()}),
+    )
+
+async def tts_http(request):
+    from httppool import pool_stats
+    return web.Response(
+        content_type="application/json",
+        text=json.dumps({"code": 0, "data": pool_stats()}),
+    )
+
+async def avatar_preload(request):
+    params = await request.json()
+    if not ready.is_set():
+        return not_ready()
+    try:
+        from avatarpool import check_avatar_id
+        avatar_id = check_avatar_id(params.get('avatar_id'))
+        await asyncio.get_event_loop().run_in_executor(None, avatars.preload, avatar_id)
+    except Exception as e:
+        logger.exception('avatar preload')
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps({"code": -1, "msg": str(e)}),
+        )
+    return web.Response(
+        content_type="application/json",
+        text=json.dumps({"code": 0, "data": avatars.stats()}),
+    )
+
+async def avatar_unload(request):
+    params = await request.json()
+    if not ready.is_set():
+        return not_ready()
+    if not avatars.unload(params['avatar_id']):
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps({"code": -1, "msg": "avatar is used by sessions"}),
+        )
+    return web.Response(
+        content_type="application/json",
+        text=json.dumps({"code": 0, "data": avatars.stats()}),
+    )
+
+def not_ready():
+    return web.Response(
+        content_type="application/json",
+        text=json.dumps({"code": -1, "msg": f"server is loading: {startup['stage']}"}),
+    )
+
+async def ready_status(request):
+    data = {'ready':ready.is_set(),'stage':startup['stage'],'error':startup['error'],'import_ms':import_times}
+    return web.Response(
+        status=200 if ready.is_set() else 503, #可以直接作为就绪探针
+        content_type="application/json",
+        text=json.dumps({"code": 0 if ready.is_set() else -1, "data": data}),
+    )
+
+async def avatar_list(request):
+    if not ready.is_set():
+        return not_ready()
+    return web.Response(
+        content_type="application/json",
+        text=json.dumps({"code": 0, "data": avatars.stats()}),
+    )
 
 async def on_shutdown(app):
     # close peer connections
@@ -373,6 +513,10 @@ async def post(url,data):
         print(f'Error: {e}')
 
 async def run(push_url,sessionid):
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+    from webrtc import HumanPlayer
+
+    await asyncio.get_event_loop().run_in_executor(None, ready.wait)
     nerfreal = await asyncio.get_event_loop().run_in_executor(None, build_nerfreal,sessionid)
     nerfreals[sessionid] = nerfreal
 
@@ -385,8 +529,10 @@ async def run(push_url,sessionid):
         if pc.connectionState == "failed":
             await pc.close()
             pcs.discard(pc)
+            close_session(sessionid)
 
     player = HumanPlayer(nerfreals[sessionid])
+    players[sessionid] = player
     audio_sender = pc.addTrack(player.audio)
     video_sender = pc.addTrack(player.video)
 
@@ -439,11 +585,22 @@ if __name__ == '__main__':
     # parser.add_argument('--customvideo_imgnum', type=int, default=1)
 
     parser.add_argument('--customvideo_config', type=str, default='')
+    parser.add_argument('--avatar_budget_mb', type=int, default=0, help="memory budget for loaded avatars, idle avatars are unloaded LRU when exceeded, 0 means unlimited")
+    parser.add_argument('--frame_cache', type=int, default=0, help="decode avatar full frames on demand keeping at most N frames in memory, 0 loads all frames")
+    parser.add_argument('--load_workers', type=int, default=0, help="threads used to decode avatar and clip images, 0 means cpu count")
+    parser.add_argument('--custom_prefetch', type=int, default=0, help="decode custom clips on demand keeping this many frames ahead, 0 preloads image dirs (clips with videopath always stream)")
 
     parser.add_argument('--tts', type=str, default='local_edgetts') #local_edgetts edgetts xtts gpt-sovits cosyvoice fishtts
     parser.add_argument('--REF_FILE', type=str, default=None)
     parser.add_argument('--REF_TEXT', type=str, default=None)
+    parser.add_argument('--tts_cache_mb', type=int, default=0, help="memory budget of the speech cache in MB, 0 uses cache_size (also MB) from local_tts_config.json")
+    parser.add_argument('--tts_cache_dir', type=str, default='data/tts_cache', help="disk tier of the synthesized speech cache, empty keeps it in memory only (enable_cache/cache_size in local_tts_config.json)")
+    parser.add_argument('--tts_cache_disk_mb', type=int, default=1024, help="disk budget of the speech cache, 0 means unlimited")
+    parser.add_argument('--tts_lookahead', type=int, default=1, help="synthesize up to N upcoming messages while the current one plays, 0 synthesizes one message at a time")
     parser.add_argument('--TTS_SERVER', type=str, default='http://127.0.0.1:9880') # http://localhost:9000
+    parser.add_argument('--tts_pool_size', type=int, default=8, help="keep-alive connections kept per remote tts server")
+    parser.add_argument('--tts_connect_timeout', type=float, default=3.0, help="seconds to connect to the tts server")
+    parser.add_argument('--tts_read_timeout', type=float, default=60.0, help="seconds to wait for the next chunk from the tts server")
     # parser.add_argument('--CHARACTER', type=str, default='test')
     # parser.add_argument('--EMOTION', type=str, default='default')
 
@@ -453,6 +610,18 @@ if __name__ == '__main__':
     parser.add_argument('--push_url', type=str, default='http://localhost:1985/rtc/v1/whip/?app=live&stream=livestream') #rtmp://localhost/live/livestream
 
     parser.add_argument('--max_session', type=int, default=1)  #multi session count
+    parser.add_argument('--idle_passthrough', action='store_true', help="send shared pre-encoded H264 packets for idle frames")
+    parser.add_argument('--output_profile', type=str, default='native', help="default output resolution: native 1080p 720p 480p 360p, can be set per session in /offer")
+    parser.add_argument('--adaptive_profile', action='store_true', help="adapt the output resolution from RTCP receiver reports")
+    parser.add_argument('--max_buffer_ms', type=int, default=200, help="max media buffered in each webrtc track, 0 means the default, at least two video frames (80ms)")
+    parser.add_argument('--yuv_output', action='store_true', help="compose frames directly in yuv420p, idle frames are converted once and cached")
+    parser.add_argument('--buffer_policy', type=str, default='block', choices=['block','drop'], help="when the buffer is full, block the producer or drop the oldest frames")
+    parser.add_argument('--record_dir', type=str, default='data/record', help="recordings are written to record_dir/<sessionid>/")
+    parser.add_argument('--record_segment', type=float, default=0, help="split recordings into segments of this many seconds, 0 means one file")
+    parser.add_argument('--record_passthrough', action='store_true', help="encode H264/Opus once for both webrtc and the recording and mux the packets into mkv instead of encoding again")
+    parser.add_argument('--record_keep', type=int, default=0, help="keep only the latest N segments, 0 means keep all")
+    parser.add_argument('--compile_cache', type=str, default='', help="directory for TorchScript compiled models reused across restarts, empty disables compilation")
+    parser.add_argument('--fast_start', action='store_true', help="open the http port first and load the model and avatar in the background, poll /ready")
     parser.add_argument('--listenport', type=int, default=8010)
 
     opt = parser.parse_args()
@@ -464,23 +633,55 @@ if __name__ == '__main__':
             opt.customopt = json.load(file)
 
 
-
-    from lipreal import LipReal,load_model,load_avatar,warm_up
     print(opt)
-    model = load_model("./models/wav2lip.pth")
-    avatar = load_avatar(opt.avatar_id)
-    warm_up(opt.batch_size,model,256)
-    # for k in range(opt.max_session):
-    #     opt.sessionid=k
-    #     nerfreal = LipReal(opt,model)
-    #     nerfreals.append(nerfreal)
 
-
-    if opt.transport=='rtmp':
-        thread_quit = Event()
-        nerfreals[0] = build_nerfreal(0)
-        rendthrd = Thread(target=nerfreals[0].render,args=(thread_quit,))
-        rendthrd.start()
+    def load_runtime():
+        global model,avatars
+        try:
+            for name in STARTUP_MODULES:
+                timed_import(name)
+            ttsreal = timed_import('ttsreal') #ttsreal经audioframe导入av,放在av之后计时
+            for name in ttsreal.BACKEND_MODULES.get(opt.tts,()):
+                timed_import(name)
+            logger.info('import time(ms): %s, total %.1f', import_times, sum(import_times.values()))
+            import imgloader
+            from avatarpool import AvatarPool
+            from lipreal import load_model,load_compiled_model,load_avatar,warm_up
+            from basereal import discard_avatar
+            imgloader.set_workers(opt.load_workers)
+            startup['stage'] = 'model'
+            if opt.compile_cache: #编译好的模型按权重校验和/batch_size/版本缓存
+                model = load_compiled_model("./models/wav2lip.pth",opt.batch_size,256,opt.compile_cache)
+            else:
+                model = load_model("./models/wav2lip.pth")
+            startup['stage'] = 'avatar'
+            avatars = AvatarPool(lambda avatar_id: load_avatar(avatar_id,opt.frame_cache),
+                                 budget=opt.avatar_budget_mb*1024*1024,on_unload=discard_avatar)
+            avatars.preload(opt.avatar_id) #默认avatar启动时加载
+            startup['stage'] = 'warmup'
+            warm_up(opt.batch_size,model,256)
+            # for k in range(opt.max_session):
+            #     opt.sessionid=k
+            #     nerfreal = LipReal(opt,model)
+            #     nerfreals.append(nerfreal)
+
+            if opt.transport=='rtmp':
+                thread_quit = Event()
+                nerfreals[0] = build_nerfreal(0)
+                rendthrd = Thread(target=nerfreals[0].render,args=(thread_quit,))
+                rendthrd.start()
+        except Exception as e:
+            startup['stage'] = 'failed'
+            startup['error'] = str(e)
+            raise
+        startup['stage'] = 'ready'
+        ready.set()
+        logger.info('server ready')
+
+    if opt.fast_start: #http服务先起来, 模型和avatar在后台加载, 通过/ready查询
+        Thread(target=load_runtime,daemon=True,name='load_runtime').start()
+    else:
+        load_runtime()
 
     #############################################################################
     appasync = web.Application()
@@ -491,6 +692,14 @@ if __name__ == '__main__':
     appasync.router.add_post("/set_audiotype", set_audiotype)
     appasync.router.add_post("/record", record)
     appasync.router.add_post("/is_speaking", is_speaking)
+    appasync.router.add_post("/stats", stats)
+    appasync.router.add_post("/tts_cache", tts_cache)
+    appasync.router.add_post("/tts_http", tts_http)
+    appasync.router.add_post("/avatar/preload", avatar_preload)
+    appasync.router.add_post("/avatar/unload", avatar_unload)
+    appasync.router.add_post("/avatar/list", avatar_list)
+    appasync.router.add_get("/ready", ready_status, allow_head=False)
+    appasync.router.add_post("/ready", ready_status)
     appasync.router.add_static('/',path='web')
 
     # Configure default CORS settings.
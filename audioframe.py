@@ -0,0 +1,136 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 音频从TTS到AudioFrame全程用16khz单声道int16 pcm
+# 只有ASR提取特征时整批转换成float32一次
+
+import collections
+
+import numpy as np
+import av
+from av import AudioFrame
+
+def pcm_to_float(pcm):
+    """int16 pcm -> [-1,1] float32"""
+    return pcm.astype(np.float32) / 32767
+
+def float_to_pcm(stream):
+    """[-1,1] float -> int16 pcm"""
+    return (np.clip(stream, -1.0, 1.0) * 32767).astype(np.int16)
+
+
+class AudioFramePool:
+    """
+    可复用的s16单声道AudioFrame, 渲染线程取出填充, PlayerStreamTrack发送下一帧时归还
+    静音帧预先生成一个, 每次直接发送
+    """
+
+    def __init__(self, samples, sample_rate=16000, size=64):
+        self.samples = samples
+        self.sample_rate = sample_rate
+        self._free = collections.deque(maxlen=size)
+        self.allocated = 0
+        self.silence = self._new()
+        self.silence.planes[0].update(bytes(samples * 2))
+
+    def _new(self):
+        frame = AudioFrame(format='s16', layout='mono', samples=self.samples)
+        frame.sample_rate = self.sample_rate
+        self.allocated += 1
+        return frame
+
+    def get(self, pcm):
+        if pcm.shape[0] != self.samples: #不是标准20ms的帧不复用
+            frame = AudioFrame(format='s16', layout='mono', samples=pcm.shape[0])
+            frame.sample_rate = self.sample_rate
+            frame.planes[0].update(pcm.tobytes())
+            return frame
+        try:
+            frame = self._free.popleft()
+        except IndexError:
+            frame = self._new()
+        frame.planes[0].update(pcm)
+        return frame
+
+    def release(self, frame):
+        if frame is not self.silence and frame.samples == self.samples:
+            self._free.append(frame)
+
+
+class StreamDecoder:
+    """边收边解码压缩音频(mp3等), 输出重采样后的单声道int16 pcm, 解码器和重采样器都保留跨块的状态"""
+
+    def __init__(self, codec='mp3', sample_rate=16000):
+        self._codec = av.CodecContext.create(codec, 'r')
+        self._resampler = av.AudioResampler(format='s16', layout='mono', rate=sample_rate)
+
+    def _resample(self, frame):
+        frames = self._resampler.resample(frame)
+        if frames is None: # 老版本av返回单个帧或None
+            return []
+        return frames if isinstance(frames, list) else [frames]
+
+    def _convert(self, frames):
+        pcm = [f.to_ndarray().reshape(-1) for f in frames]
+        return np.concatenate(pcm) if pcm else np.zeros(0, dtype=np.int16)
+
+    def feed(self, data):
+        frames = []
+        for packet in self._codec.parse(data):
+            for frame in self._codec.decode(packet):
+                frames.extend(self._resample(frame))
+        return self._convert(frames)
+
+    def flush(self):
+        """输入结束, 取出解码器和重采样器里剩下的数据"""
+        frames = []
+        for packet in self._codec.parse(None):
+            for frame in self._codec.decode(packet):
+                frames.extend(self._resample(frame))
+        for frame in self._codec.decode(None):
+            frames.extend(self._resample(frame))
+        frames.extend(self._resample(None))
+        return self._convert(frames)
+
+
+class FrameSplitter:
+    """把不定长的pcm切成定长帧; 最后一帧留到finish()才输出, 这样能给它标上end"""
+
+    def __init__(self, chunk):
+        self.chunk = chunk
+        self._buf = np.zeros(0, dtype=np.int16)
+        self._held = None
+
+    def push(self, pcm):
+        buf = np.concatenate((self._buf, pcm)) if len(self._buf) else pcm
+        count = len(buf) // self.chunk
+        frames = []
+        for i in range(count):
+            if self._held is not None:
+                frames.append(self._held)
+            self._held = buf[i*self.chunk:(i+1)*self.chunk]
+        self._buf = buf[count*self.chunk:]
+        return frames
+
+    def finish(self):
+        """剩下的帧, 不足一帧的尾巴补零, 列表最后一个是最后一帧"""
+        frames = [] if self._held is None else [self._held]
+        if len(self._buf):
+            frames.append(np.pad(self._buf, (0, self.chunk - len(self._buf))))
+        self._buf = np.zeros(0, dtype=np.int16)
+        self._held = None
+        return frames
@@ -0,0 +1,215 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 从视频直接生成wav2lip的avatar包, 代替wav2lip/genavatar.py:
+#   1. 视频按块划分, 多个进程各自解码自己的块并做人脸检测, 每块的检测结果单独保存
+#   2. 中断后重跑会跳过已经完成的块
+#   3. 平滑人脸框后顺序解码一遍, 直接写avatar.pack(full_imgs, face_imgs, face_input, coords)
+#      face_input是模型的图像输入(下半脸遮挡 + 原图, 6通道), 推理时不用再逐批拼接
+#   4. --mirrored时把包转换成ping-pong展开的布局
+#
+#   python avatarbuild.py --video_path video/xxx.mp4 --avatar_id wav2lip256_avatar1 --img_size 256
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+from framestore import VideoFileSource
+from avatarpack import PackWriter, pack_path, mirror_pack
+
+WORK_DIR = 'build'
+
+def model_input(face):
+    """wav2lip的图像输入: 下半脸置零的人脸和原人脸按通道拼接"""
+    masked = face.copy()
+    masked[face.shape[0]//2:] = 0
+    return np.concatenate((masked, face), axis=2)
+
+def get_smoothened_boxes(boxes, T):
+    for i in range(len(boxes)):
+        if i + T > len(boxes):
+            window = boxes[len(boxes) - T:]
+        else:
+            window = boxes[i : i + T]
+        boxes[i] = np.mean(window, axis=0)
+    return boxes
+
+def face_boxes(rects, shape, pads, nosmooth=False):
+    """检测框(x1,y1,x2,y2)加边距并平滑, 返回(y1,y2,x1,x2)"""
+    pady1, pady2, padx1, padx2 = pads
+    boxes = np.stack([np.maximum(0, rects[:, 0] - padx1),
+                      np.maximum(0, rects[:, 1] - pady1),
+                      np.minimum(shape[1], rects[:, 2] + padx2),
+                      np.minimum(shape[0], rects[:, 3] + pady2)], axis=1)
+    if not nosmooth:
+        boxes = get_smoothened_boxes(boxes, T=5)
+    return [(y1, y2, x1, x2) for x1, y1, x2, y2 in boxes]
+
+
+# ---- 检测进程 ----
+_detector = None
+_source = None
+
+def _init_worker(device):
+    global _detector
+    # face_detection内部按顶层包名导入子模块, 需要把wav2lip目录加进路径
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wav2lip'))
+    import face_detection
+    _detector = face_detection.FaceAlignment(face_detection.LandmarksType._2D, flip_input=False, device=device)
+
+def _detect_chunk(video_path, start, stop, batch_size):
+    """解码[start,stop)并检测人脸, 返回(n,4)的x1,y1,x2,y2, 没检测到的行为-1"""
+    global _source
+    if _source is None or _source.path != video_path:
+        _source = VideoFileSource(video_path)
+    frames = _source.read(start, stop)
+    rects = []
+    i = 0
+    while i < len(frames):
+        try:
+            rects.extend(_detector.get_detections_for_batch(np.array(frames[i:i + batch_size])))
+        except RuntimeError:
+            if batch_size == 1:
+                raise RuntimeError('Image too big to run face detection on GPU')
+            batch_size //= 2 #显存不够, 减小batch重试
+            print(f'Recovering from OOM error; New batch size: {batch_size}')
+            continue
+        i += batch_size
+    return np.array([r if r is not None else (-1, -1, -1, -1) for r in rects], dtype=np.int64).reshape(-1, 4)
+
+
+# ---- 断点 ----
+def _chunk_path(work, start):
+    return os.path.join(work, f'rects_{start:08d}.npy')
+
+def _save(path, arr):
+    tmp = path + '.tmp.npy'
+    np.save(tmp, arr)
+    os.replace(tmp, path)
+
+def _prepare_work(work, state):
+    """检查断点是否属于同一个视频和分块, 不是时清空"""
+    state_path = os.path.join(work, 'state.json')
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            if json.load(f) == state:
+                return
+        print('video or chunk size changed, discarding previous progress')
+        shutil.rmtree(work)
+    os.makedirs(work, exist_ok=True)
+    with open(state_path, 'w') as f:
+        json.dump(state, f)
+
+
+def _decode_all(source, total, chunk):
+    for start in range(0, total, chunk):
+        yield from source.read(start, min(start + chunk, total))
+
+def build_avatar(video_path, avatar_path, img_size=256, pads=(0, 10, 0, 0), nosmooth=False,
+                 workers=2, chunk=256, batch_size=16, device=None, keep_work=False, mirrored=False):
+    if device is None:
+        import torch
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    os.makedirs(avatar_path, exist_ok=True)
+    work = os.path.join(avatar_path, WORK_DIR)
+    source = VideoFileSource(video_path)
+    total = len(source)
+    stat = os.stat(video_path)
+    _prepare_work(work, {'video': os.path.abspath(video_path), 'size': stat.st_size,
+                         'mtime': int(stat.st_mtime), 'frames': total, 'chunk': chunk})
+
+    # 1. 分块人脸检测
+    chunks = [(start, min(start + chunk, total)) for start in range(0, total, chunk)]
+    todo = [c for c in chunks if not os.path.exists(_chunk_path(work, c[0]))]
+    print(f'{total} frames, {len(chunks)-len(todo)}/{len(chunks)} chunks already detected, {workers} workers on {device}')
+    if todo:
+        ctx = multiprocessing.get_context('spawn') #cuda不能在fork出来的进程里初始化
+        with ProcessPoolExecutor(workers, mp_context=ctx, initializer=_init_worker, initargs=(device,)) as pool:
+            futures = {pool.submit(_detect_chunk, video_path, start, stop, batch_size): start for start, stop in todo}
+            for future in tqdm(as_completed(futures), total=len(futures), desc='face detect'):
+                _save(_chunk_path(work, futures[future]), future.result())
+
+    rects = np.concatenate([np.load(_chunk_path(work, start)) for start, _ in chunks])
+    if len(rects) < total: # 包数比能解码出的帧多, 以检测时实际解码的帧数为准
+        print(f'video decodes to {len(rects)} frames, not {total}')
+        total = len(rects)
+    missing = np.flatnonzero(rects[:, 0] < 0)
+    if len(missing):
+        raise ValueError(f'Face not detected in {len(missing)} frames, first: {missing[:10].tolist()}. '
+                         'Ensure the video contains a face in all the frames.')
+
+    # 2. 解码一遍写包, 人脸先写到临时文件, 全身帧写完后再拷进包里
+    first = source.read(0, 1)[0]
+    coords = face_boxes(rects, first.shape, pads, nosmooth)
+    faces_path = os.path.join(work, 'faces.raw')
+    face_shape = (img_size, img_size, 3)
+    writer = PackWriter(pack_path(avatar_path), meta={'video': os.path.basename(video_path), 'img_size': img_size,
+                                                      'pads': list(pads), 'nosmooth': nosmooth})
+    try:
+        with open(faces_path, 'wb') as faces:
+            def full_frames():
+                for i, frame in enumerate(tqdm(_decode_all(source, total, chunk), total=total, desc='pack')):
+                    y1, y2, x1, x2 = coords[i]
+                    faces.write(cv2.resize(frame[y1:y2, x1:x2], (img_size, img_size)).tobytes())
+                    yield frame
+            count = writer.add_frames('full_imgs', full_frames())
+        if count != total:
+            raise ValueError(f'decoded {count} frames, expected {total}')
+        face_list = np.memmap(faces_path, dtype=np.uint8, mode='r', shape=(total,) + face_shape)
+        writer.add_frames('face_imgs', face_list)
+        writer.add_frames('face_input', (model_input(face) for face in face_list))
+        writer.add_coords('coords', coords)
+        del face_list
+    except:
+        writer.abort()
+        raise
+    out = writer.close()
+    if mirrored:
+        mirror_pack(out)
+    if not keep_work:
+        shutil.rmtree(work)
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build a wav2lip avatar pack from a video, resumable')
+    parser.add_argument('--video_path', type=str, required=True)
+    parser.add_argument('--avatar_id', type=str, default='wav2lip256_avatar1')
+    parser.add_argument('--img_size', type=int, default=256)
+    parser.add_argument('--pads', nargs='+', type=int, default=[0, 10, 0, 0],
+                        help='Padding (top, bottom, left, right). Please adjust to include chin at least')
+    parser.add_argument('--nosmooth', default=False, action='store_true',
+                        help='Prevent smoothing face detections over a short temporal window')
+    parser.add_argument('--face_det_batch_size', type=int, default=16, help='Batch size for face detection')
+    parser.add_argument('--workers', type=int, default=2, help='face detection processes, each loads its own detector')
+    parser.add_argument('--chunk', type=int, default=256, help='frames per chunk, progress is saved per chunk')
+    parser.add_argument('--mirrored', action='store_true', help='store frames in ping-pong order (2x size) so playback reads sequentially')
+    parser.add_argument('--keep_work', action='store_true', help=f'keep <avatar_path>/{WORK_DIR} after a successful build')
+    args = parser.parse_args()
+
+    avatar_path = f"./data/avatars/{args.avatar_id}"
+    out = build_avatar(args.video_path, avatar_path, args.img_size, tuple(args.pads), args.nosmooth,
+                       args.workers, args.chunk, args.face_det_batch_size, keep_work=args.keep_work, mirrored=args.mirrored)
+    print(f'built {out} ({os.path.getsize(out)/1024/1024:.1f}MB)')
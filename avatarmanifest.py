@@ -0,0 +1,184 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# avatar目录的清单manifest.json: 每个帧组的文件列表, 分辨率, 文件大小和crc32, 以及坐标
+# 生成时解码每一张图, 编号不连续, 图片损坏, 数量和坐标对不上都会报错
+# 加载时按清单取文件列表(不扫描目录), 只stat检查文件大小和数量对齐, --verify时重新计算crc32
+#
+#   python avatarmanifest.py data/avatars/<avatar_id> [--verify]
+
+import os
+import glob
+import json
+import zlib
+import pickle
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from logger import logger
+from avatarpack import FRAME_DIRS, COORD_FILES
+
+MANIFEST_NAME = 'manifest.json'
+
+def manifest_path(avatar_path):
+    return os.path.join(avatar_path, MANIFEST_NAME)
+
+def _crc32(path):
+    with open(path, 'rb') as f:
+        return '%08x' % zlib.crc32(f.read())
+
+def _scan(path):
+    files = glob.glob(os.path.join(path, '*.[jpJP][pnPN]*[gG]'))
+    return sorted(files, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+
+
+class AvatarManifest:
+
+    def __init__(self, avatar_path, data):
+        self.avatar_path = avatar_path
+        self.data = data
+
+    @property
+    def frames(self):
+        return self.data['frames']
+
+    def has(self, name):
+        return name in self.data['groups'] or name in self.data['coords']
+
+    def files(self, name):
+        group = self.data['groups'][name]
+        return [os.path.join(self.avatar_path, name, f) for f in group['files']]
+
+    def shape(self, name):
+        """帧组的(H,W,C), 尺寸不一致时为None"""
+        shape = self.data['groups'][name]['shape']
+        return tuple(shape) if shape else None
+
+    def coords(self, name):
+        return [tuple(c) for c in self.data['coords'][name]]
+
+    def validate(self, deep=False):
+        """检查文件是否存在, 大小是否变化, 各帧组和坐标数量是否对齐, deep时校验crc32"""
+        errors = []
+        for name, group in self.data['groups'].items():
+            if len(group['files']) != self.frames:
+                errors.append(f'{name}: {len(group["files"])} files for {self.frames} frames')
+            for path, size, crc in zip(self.files(name), group['sizes'], group['crc32']):
+                try:
+                    if os.path.getsize(path) != size:
+                        errors.append(f'{path}: size changed')
+                    elif deep and _crc32(path) != crc:
+                        errors.append(f'{path}: checksum mismatch')
+                except OSError:
+                    errors.append(f'{path}: missing')
+        for name, coords in self.data['coords'].items():
+            if len(coords) != self.frames:
+                errors.append(f'{name}: {len(coords)} coords for {self.frames} frames')
+        if errors:
+            more = f' (+{len(errors)-10} more)' if len(errors) > 10 else ''
+            raise ValueError(f'avatar {self.avatar_path} does not match {MANIFEST_NAME}: ' + '; '.join(errors[:10]) + more)
+
+
+def open_manifest(avatar_path):
+    """有manifest.json时打开, 没有返回None"""
+    path = manifest_path(avatar_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return AvatarManifest(avatar_path, json.load(f))
+
+def _describe(path):
+    frame = cv2.imread(path)
+    if frame is None:
+        raise ValueError(f'failed to read image {path}')
+    return frame.shape, os.path.getsize(path), _crc32(path)
+
+def build_manifest(avatar_path, workers=8):
+    """扫描目录生成manifest.json"""
+    data = {'version': 1, 'frames': None, 'groups': {}, 'coords': {}}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for name in FRAME_DIRS:
+            files = _scan(os.path.join(avatar_path, name))
+            if not files:
+                continue
+            numbers = [int(os.path.splitext(os.path.basename(f))[0]) for f in files]
+            gaps = sorted(set(range(len(files))) - set(numbers))
+            if gaps:
+                raise ValueError(f'{name}: frame numbers are not contiguous, missing {gaps[:10]}')
+            shapes, sizes, crcs = zip(*pool.map(_describe, files))
+            data['groups'][name] = {
+                'files': [os.path.basename(f) for f in files],
+                'shape': list(shapes[0]) if all(s == shapes[0] for s in shapes) else None,
+                'sizes': list(sizes),
+                'crc32': list(crcs),
+            }
+    for name in COORD_FILES:
+        path = os.path.join(avatar_path, f'{name}.pkl')
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data['coords'][name] = [[int(v) for v in c] for c in pickle.load(f)]
+    if 'full_imgs' not in data['groups']:
+        raise ValueError(f'{avatar_path} has no full_imgs')
+    data['frames'] = len(data['groups']['full_imgs']['files'])
+    manifest = AvatarManifest(avatar_path, data)
+    manifest.validate()
+    tmp = manifest_path(avatar_path) + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp, manifest_path(avatar_path))
+    return manifest
+
+
+def avatar_images(avatar_path, name, manifest=None):
+    """帧组的图片列表: 有清单时按清单, 否则扫描目录按数字排序"""
+    if manifest is not None:
+        return manifest.files(name)
+    return _scan(os.path.join(avatar_path, name))
+
+def avatar_coords(avatar_path, name, manifest=None):
+    if manifest is not None:
+        return manifest.coords(name)
+    with open(os.path.join(avatar_path, f'{name}.pkl'), 'rb') as f:
+        return pickle.load(f)
+
+def load_manifest(avatar_path):
+    """加载avatar时调用: 有清单时校验后返回, 没有时返回None走目录扫描"""
+    manifest = open_manifest(avatar_path)
+    if manifest is None:
+        logger.info('%s has no %s, scanning directories (python avatarmanifest.py %s)', avatar_path, MANIFEST_NAME, avatar_path)
+        return None
+    manifest.validate()
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='generate or verify the manifest of an avatar directory')
+    parser.add_argument('avatar_path', type=str, help='e.g. data/avatars/wav2lip256_avatar1')
+    parser.add_argument('--verify', action='store_true', help='verify files against the existing manifest including checksums')
+    args = parser.parse_args()
+    if args.verify:
+        manifest = open_manifest(args.avatar_path)
+        if manifest is None:
+            raise SystemExit(f'{manifest_path(args.avatar_path)} not found')
+        manifest.validate(deep=True)
+        print(f'{args.avatar_path}: {manifest.frames} frames ok')
+    else:
+        manifest = build_manifest(args.avatar_path)
+        groups = ', '.join(f'{name} {manifest.shape(name)}' for name in manifest.data['groups'])
+        print(f'{manifest_path(args.avatar_path)}: {manifest.frames} frames, {groups}')
@@ -0,0 +1,224 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 单文件avatar包: 解码好的uint8帧数组 + 坐标 + 元数据, 用mmap打开, 访问时才读入内存页
+#
+# 文件布局:
+#   MAGIC | 帧组数据... | header json | uint64 header偏移 | MAGIC
+# 一个帧组里的帧首尾相连, 尺寸都相同时整组是一个(N,H,W,C)数组
+# mirrored布局(meta.layout)把帧按ping-pong顺序展开成2N帧存储, 播放时顺序读取
+#
+# 从现有目录生成:
+#   python avatarpack.py data/avatars/<avatar_id> [--mirrored]
+
+import os
+import glob
+import json
+import mmap
+import pickle
+import struct
+import argparse
+import itertools
+
+import cv2
+import numpy as np
+
+MAGIC = b'LTAVPK01'
+PACK_NAME = 'avatar.pack'
+ALIGN = 4096
+
+# 目录名 -> 帧组名, pkl文件名 -> 坐标名
+FRAME_DIRS = ('full_imgs', 'face_imgs', 'mask')
+COORD_FILES = ('coords', 'mask_coords')
+
+def pack_path(avatar_path):
+    return os.path.join(avatar_path, PACK_NAME)
+
+def _sorted_imgs(path):
+    files = glob.glob(os.path.join(path, '*.[jpJP][pnPN]*[gG]'))
+    return sorted(files, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+
+
+class AvatarPack:
+    """打开的avatar包, 帧组返回mmap上的数组视图(copy-on-write, 写入不会改动文件)"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        if self._mm[:len(MAGIC)] != MAGIC or self._mm[-len(MAGIC):] != MAGIC:
+            raise ValueError(f'{path} is not an avatar pack')
+        end = len(self._mm) - len(MAGIC)
+        offset, = struct.unpack('<Q', self._mm[end-8:end])
+        self.header = json.loads(self._mm[offset:end-8].decode('utf-8'))
+        self.meta = self.header.get('meta', {})
+
+    @property
+    def mirrored(self):
+        return self.meta.get('layout') == 'mirrored'
+
+    def close(self):
+        """返回的帧数组都释放后才能关闭"""
+        self._mm.close()
+
+    def names(self):
+        return list(self.header['frames'])
+
+    def has(self, name):
+        return name in self.header['frames'] or name in self.header['coords']
+
+    def frames(self, name):
+        """(N,H,W,C)数组, 帧尺寸不一致时返回数组列表"""
+        group = self.header['frames'][name]
+        shapes = [tuple(s) for s in group['shapes']]
+        offset = group['offset']
+        if not shapes:
+            return []
+        if all(s == shapes[0] for s in shapes):
+            count = len(shapes) * int(np.prod(shapes[0]))
+            return np.frombuffer(self._mm, dtype=np.uint8, count=count, offset=offset).reshape((len(shapes),) + shapes[0])
+        frames = []
+        for shape in shapes:
+            size = int(np.prod(shape))
+            frames.append(np.frombuffer(self._mm, dtype=np.uint8, count=size, offset=offset).reshape(shape))
+            offset += size
+        return frames
+
+    def coords(self, name):
+        return [tuple(int(v) for v in c) for c in self.header['coords'][name]]
+
+
+def open_pack(avatar_path):
+    """avatar目录下有avatar.pack时打开, 没有返回None"""
+    path = pack_path(avatar_path)
+    if not os.path.exists(path):
+        return None
+    return AvatarPack(path)
+
+
+def _pad(f):
+    pos = f.tell()
+    if pos % ALIGN:
+        f.write(b'\0' * (ALIGN - pos % ALIGN))
+
+
+class PackWriter:
+    """
+    顺序写入avatar包, 帧组逐帧写入不需要全部放在内存里
+    写到<out>.tmp, close()时写header并替换, 中途失败调用abort()
+    """
+
+    def __init__(self, out, meta=None):
+        self.out = out
+        self.header = {'version': 1, 'frames': {}, 'coords': {}, 'meta': dict(meta or {})}
+        self._tmp = out + '.tmp'
+        self._f = open(self._tmp, 'wb')
+        self._f.write(MAGIC)
+
+    def add_frames(self, name, frames):
+        """frames为uint8帧的可迭代对象, 返回写入的帧数"""
+        _pad(self._f)
+        group = {'offset': self._f.tell(), 'shapes': []}
+        for frame in frames:
+            if frame.dtype != np.uint8:
+                raise ValueError(f'{name}: frames must be uint8, got {frame.dtype}')
+            self._f.write(np.ascontiguousarray(frame).tobytes())
+            group['shapes'].append(list(frame.shape))
+        self.header['frames'][name] = group
+        return len(group['shapes'])
+
+    def add_coords(self, name, coords):
+        self.header['coords'][name] = [[int(v) for v in c] for c in coords]
+
+    def close(self):
+        offset = self._f.tell()
+        self._f.write(json.dumps(self.header).encode('utf-8'))
+        self._f.write(struct.pack('<Q', offset))
+        self._f.write(MAGIC)
+        self._f.close()
+        os.replace(self._tmp, self.out)
+        return self.out
+
+    def abort(self):
+        self._f.close()
+        if os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+
+def _read_dir(name, files):
+    for i, path in enumerate(files):
+        frame = cv2.imread(path)
+        if frame is None:
+            raise ValueError(f'failed to read image {path}')
+        if i % 500 == 0:
+            print(f'{name}: {i}/{len(files)}')
+        yield frame
+
+def _mirrored(frames):
+    return itertools.chain(frames, frames[::-1])
+
+def build_pack(avatar_path, out=None, meta=None, mirrored=False):
+    """把现有目录(full_imgs/face_imgs/mask + coords.pkl/mask_coords.pkl)打包成一个文件"""
+    meta = dict(meta or {})
+    if mirrored:
+        meta['layout'] = 'mirrored'
+    writer = PackWriter(out or pack_path(avatar_path), meta)
+    try:
+        for name in FRAME_DIRS:
+            files = _sorted_imgs(os.path.join(avatar_path, name))
+            if files:
+                writer.add_frames(name, _read_dir(name, files + files[::-1] if mirrored else files))
+        for name in COORD_FILES:
+            path = os.path.join(avatar_path, f'{name}.pkl')
+            if os.path.exists(path):
+                with open(path, 'rb') as pf:
+                    coords = pickle.load(pf)
+                writer.add_coords(name, list(_mirrored(coords)) if mirrored else coords)
+    except:
+        writer.abort()
+        raise
+    return writer.close()
+
+def mirror_pack(path, out=None):
+    """把已有的包转换成mirrored布局, out默认覆盖原文件"""
+    pack = AvatarPack(path)
+    if pack.mirrored:
+        return path
+    writer = PackWriter(out or path, dict(pack.meta, layout='mirrored'))
+    try:
+        for name in pack.names():
+            frames = pack.frames(name)
+            writer.add_frames(name, _mirrored(frames))
+            del frames
+        for name in pack.header['coords']:
+            writer.add_coords(name, list(_mirrored(pack.coords(name))))
+    except:
+        writer.abort()
+        raise
+    finally:
+        pack.close() #windows上文件被映射时不能替换
+    return writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='pack an avatar directory into a single memory-mapped file')
+    parser.add_argument('avatar_path', type=str, help='e.g. data/avatars/wav2lip256_avatar1')
+    parser.add_argument('--out', type=str, default=None, help=f'default <avatar_path>/{PACK_NAME}')
+    parser.add_argument('--mirrored', action='store_true', help='store frames in ping-pong order (2x size) so playback reads sequentially')
+    args = parser.parse_args()
+    out = build_pack(args.avatar_path, args.out, mirrored=args.mirrored)
+    print(f'packed {args.avatar_path} -> {out} ({os.path.getsize(out)/1024/1024:.1f}MB)')
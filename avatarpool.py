@@ -0,0 +1,185 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 一个进程服务多个avatar: 第一次使用时加载, 没有会话使用的avatar按LRU保留在内存预算内
+
+import os
+import re
+import time
+import threading
+import collections
+
+import numpy as np
+
+from logger import logger
+
+AVATAR_ROOT = './data/avatars'
+_AVATAR_ID = re.compile(r'[\w-]+')
+
+def check_avatar_id(avatar_id, root=AVATAR_ROOT):
+    """客户端传来的avatar_id只能是data/avatars下已有的目录名, 防止路径穿越到任意目录加载pickle"""
+    if not isinstance(avatar_id, str) or not _AVATAR_ID.fullmatch(avatar_id):
+        raise ValueError(f'invalid avatar_id: {avatar_id!r}')
+    root = os.path.abspath(root)
+    path = os.path.abspath(os.path.join(root, avatar_id))
+    if os.path.dirname(path) != root or not os.path.isdir(path):
+        raise ValueError(f'avatar {avatar_id} not found')
+    return avatar_id
+
+def _resident(arr):
+    """不是mmap上的视图"""
+    while isinstance(arr.base, np.ndarray):
+        arr = arr.base
+    return arr.base is None
+
+def avatar_nbytes(avatar):
+    """avatar占用的内存估算, 只统计常驻的numpy数组(mmap和按需解码的帧不计)"""
+    total = 0
+    for item in avatar if isinstance(avatar, (tuple, list)) else (avatar,):
+        if isinstance(item, np.ndarray):
+            frames = (item,)
+        elif isinstance(item, (tuple, list)):
+            frames = item
+        else:
+            continue
+        total += sum(f.nbytes for f in frames if isinstance(f, np.ndarray) and _resident(f))
+    return total
+
+
+class _Avatar:
+    __slots__ = ('value', 'refs', 'nbytes', 'ready', 'error', 'last_used')
+
+    def __init__(self):
+        self.value = None
+        self.refs = 0
+        self.nbytes = 0
+        self.ready = threading.Event()
+        self.error = None
+        self.last_used = time.time()
+
+
+class AvatarPool:
+    """
+    loader(avatar_id)返回avatar, on_unload(avatar_id, avatar)在卸载后调用(清理帧缓存)
+    budget为内存预算(字节), 0表示不限制; 正在被会话使用的avatar不会被卸载
+    """
+
+    def __init__(self, loader, budget=0, on_unload=None):
+        self.loader = loader
+        self.budget = budget
+        self.on_unload = on_unload
+        self._lock = threading.Lock()
+        self._avatars = collections.OrderedDict() # 按最近使用排序
+
+    def acquire(self, avatar_id):
+        """会话使用avatar, 没加载时加载, 用完调用release"""
+        return self._get(avatar_id, 1)
+
+    def preload(self, avatar_id):
+        """只加载不占用, 可以被预算淘汰"""
+        self._get(avatar_id, 0)
+
+    def _get(self, avatar_id, ref):
+        with self._lock:
+            entry = self._avatars.get(avatar_id)
+            owner = entry is None
+            if owner:
+                entry = _Avatar()
+                self._avatars[avatar_id] = entry
+            entry.refs += ref
+            entry.last_used = time.time()
+            self._avatars.move_to_end(avatar_id)
+        if owner:
+            t = time.perf_counter()
+            try:
+                entry.value = self.loader(avatar_id)
+                entry.nbytes = avatar_nbytes(entry.value)
+                logger.info('avatar %s loaded in %.2fs, %.1fMB', avatar_id, time.perf_counter()-t, entry.nbytes/1024/1024)
+            except Exception as e:
+                entry.error = e
+                with self._lock:
+                    self._avatars.pop(avatar_id, None)
+                raise
+            finally:
+                entry.ready.set()
+            self._evict(keep=avatar_id)
+        else:
+            entry.ready.wait()
+            if entry.error is not None:
+                with self._lock:
+                    entry.refs -= ref
+                raise entry.error
+        return entry.value
+
+    def release(self, avatar_id):
+        with self._lock:
+            entry = self._avatars.get(avatar_id)
+            if entry is None:
+                return
+            entry.refs = max(0, entry.refs - 1)
+            entry.last_used = time.time()
+        self._evict()
+
+    def unload(self, avatar_id):
+        """卸载没有会话使用的avatar, 正在使用时返回False"""
+        with self._lock:
+            entry = self._avatars.get(avatar_id)
+            if entry is None:
+                return True
+            if entry.refs > 0 or not entry.ready.is_set():
+                return False
+            del self._avatars[avatar_id]
+        self._unloaded(avatar_id, entry)
+        return True
+
+    def _evict(self, keep=None):
+        if self.budget <= 0:
+            return
+        victims = []
+        with self._lock:
+            total = sum(e.nbytes for e in self._avatars.values())
+            for avatar_id, entry in list(self._avatars.items()): #最久没用的在前面
+                if total <= self.budget:
+                    break
+                if avatar_id == keep or entry.refs > 0 or not entry.ready.is_set():
+                    continue
+                del self._avatars[avatar_id]
+                total -= entry.nbytes
+                victims.append((avatar_id, entry))
+        for avatar_id, entry in victims:
+            self._unloaded(avatar_id, entry)
+        if total > self.budget:
+            logger.warning('avatars in use take %.1fMB, over the budget %.1fMB', total/1024/1024, self.budget/1024/1024)
+
+    def _unloaded(self, avatar_id, entry):
+        logger.info('avatar %s unloaded, %.1fMB', avatar_id, entry.nbytes/1024/1024)
+        if self.on_unload is not None:
+            self.on_unload(avatar_id, entry.value)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'budget_mb': round(self.budget/1024/1024, 1),
+                'avatars': {
+                    avatar_id: {
+                        'sessions': entry.refs,
+                        'loaded': entry.ready.is_set(),
+                        'mb': round(entry.nbytes/1024/1024, 1),
+                        'idle_s': 0 if entry.refs else round(time.time() - entry.last_used, 1),
+                    } for avatar_id, entry in self._avatars.items()
+                },
+            }
@@ -49,10 +49,10 @@ class BaseASR:
     def flush_talk(self):
         self.queue.queue.clear()
 
-    def put_audio_frame(self,audio_chunk,eventpoint=None): #16khz 20ms pcm
+    def put_audio_frame(self,audio_chunk,eventpoint=None): #16khz 20ms int16 pcm
         self.queue.put((audio_chunk,eventpoint))
 
-    #return frame:audio pcm; type: 0-normal speak, 1-silence; eventpoint:custom event sync with audio
+    #return frame:audio int16 pcm; type: 0-normal speak, 1-silence; eventpoint:custom event sync with audio
     def get_audio_frame(self):        
         try:
             frame,eventpoint = self.queue.get(block=True,timeout=0.01)
@@ -63,7 +63,7 @@ class BaseASR:
                 frame = self.parent.get_audio_stream(self.parent.curr_state)
                 type = self.parent.curr_state
             else:
-                frame = np.zeros(self.chunk, dtype=np.float32)
+                frame = np.zeros(self.chunk, dtype=np.int16)
                 type = 1
             eventpoint = None
 
@@ -19,23 +19,31 @@ import math
 import torch
 import numpy as np
 
-import subprocess
 import os
 import time
-import cv2
 import glob
-import resampy
 
 import queue
 from queue import Queue
+import threading
 from threading import Thread, Event
 from io import BytesIO
 import soundfile as sf
 
 import av
+from av import VideoFrame
 from fractions import Fraction
 
-from ttsreal import EdgeTTS,VoitsTTS,XTTS,CosyVoiceTTS,FishTTS,LocalEdgeTTS
+from ttsreal import create_tts
+from resampler import resample
+from idlestream import idle_cache,IdleCursor
+from yuvframe import yuv_cache,paste_i420,even_size
+from outputprofile import scaled_cache,profile_height
+from audioframe import float_to_pcm
+from recorder import Recorder,PacketRecorder
+from framestore import open_clip,PlaySchedule,mirror_index
+from registry import registry
+import imgloader
 
 from tqdm import tqdm
 
@@ -46,20 +54,39 @@ def try_int(s):
         return s
 
 def read_imgs(img_list):
-    frames = []
-    print('reading images...')
-    target_size = None
-    for img_path in sorted(img_list, key=try_int):
-        frame = cv2.imread(img_path)
-        if frame is None:
-            print(f"[ERROR] Failed to read image: {img_path}")
-        else:
-            if target_size is None:
-                target_size = (frame.shape[1], frame.shape[0])
-            if (frame.shape[1], frame.shape[0]) != target_size:
-                frame = cv2.resize(frame, target_size)
-            frames.append(frame)
-    return frames
+    '''按文件名数字排序读取,尺寸统一到第一帧,读取失败的跳过'''
+    return imgloader.read_imgs(sorted(img_list, key=try_int), target_size='first', drop_failed=True)
+
+def discard_frame_caches(key):
+    '''帧序列卸载后删除它在缩放/I420/待机编码缓存里的条目, key为frames_key的前缀'''
+    for cache in (scaled_cache,yuv_cache,idle_cache):
+        cache.discard(key)
+
+def discard_avatar(avatar_id,avatar):
+    '''AvatarPool的on_unload: avatar[0]是frame_list_cycle, 按需解码的帧序列要关闭预取线程'''
+    discard_frame_caches(('avatar',id(avatar[0])))
+    for item in avatar:
+        close = getattr(item,'close',None)
+        if close is not None:
+            close()
+
+def load_custom_clip(item,prefetch=0):
+    '''自定义动作的帧序列,有videopath或者prefetch>0时按需解码,否则预先读取图片目录'''
+    if item.get('videopath') or prefetch>0:
+        return open_clip(item.get('videopath') or item['imgpath'],window=prefetch or 50)
+    input_img_list = glob.glob(os.path.join(item['imgpath'], '*.[jpJP][pnPN]*[gG]'))
+    if len(input_img_list) == 0:
+        print(f"[WARN] No images found in {item['imgpath']} for audiotype {item['audiotype']}")
+    frames = read_imgs(input_img_list)
+    if isinstance(frames,np.ndarray): #会话间共享,只读
+        frames.flags.writeable = False
+        return frames
+    return tuple(frames)
+
+def load_custom_audio(path):
+    stream, sample_rate = sf.read(path, dtype='int16')
+    stream.flags.writeable = False
+    return stream
 
 class BaseReal:
     def __init__(self, opt):
@@ -68,32 +95,30 @@ class BaseReal:
         self.chunk = self.sample_rate // opt.fps # 320 samples per chunk (20ms * 16000 / 1000)
         self.sessionid = self.opt.sessionid
 
-        if opt.tts == "edgetts":
-            self.tts = EdgeTTS(opt,self)
-        elif opt.tts == "local_edgetts":
-            self.tts = LocalEdgeTTS(opt,self)
-        elif opt.tts == "gpt-sovits":
-            self.tts = VoitsTTS(opt,self)
-        elif opt.tts == "xtts":
-            self.tts = XTTS(opt,self)
-        elif opt.tts == "cosyvoice":
-            self.tts = CosyVoiceTTS(opt,self)
-        elif opt.tts == "fishtts":
-            self.tts = FishTTS(opt,self)
-        
+        self.tts = create_tts(opt,self)
+        self.schedule = None #avatar帧的播放顺序(PlaySchedule), None为ping-pong
+
         self.speaking = False
 
         self.recording = False
-        self._record_video_pipe = None
-        self._record_audio_pipe = None
-        self.width = self.height = 0
+        self._recorder = None
+        self._record_lock = threading.Lock() #start/stop可能同时来自http请求和会话关闭
+
+        self.yuv_output = getattr(opt,'yuv_output',False) #合成器直接输出I420,不再整帧做颜色空间转换
+        self.output_profile = 'native'
+        self.output_height = None #None表示按avatar原始分辨率输出
+
+        self.idle_passthrough = False #静音帧直接发送共享的已编码H264包,由HumanPlayer在协商到H264时打开
+        self._idle_cursor = IdleCursor()
 
         self.curr_state=0
         self.custom_img_cycle = {}
         self.custom_audio_cycle = {}
         self.custom_audio_index = {}
         self.custom_index = {}
+        self.custom_schedule = {} #自定义动作的播放顺序, 每帧直接查表
         self.custom_opt = {}
+        self._registry_keys = []
         self.__loadcustom()
 
     def put_msg_txt(self, msg, eventpoint=None):  
@@ -117,6 +142,7 @@ class BaseReal:
             idx += self.chunk
     
     def __create_bytes_stream(self,byte_stream):
+        '''解码上传的音频, 返回16khz int16 pcm'''
         #byte_stream=BytesIO(buffer)
         stream, sample_rate = sf.read(byte_stream) # [T*sample_rate,] float64
         print(f'[INFO]put audio stream {sample_rate}: {stream.shape}')
@@ -128,9 +154,9 @@ class BaseReal:
     
         if sample_rate != self.sample_rate and stream.shape[0]>0:
             print(f'[WARN] audio sample rate is {sample_rate}, resampling into {self.sample_rate}.')
-            stream = resampy.resample(x=stream, sr_orig=sample_rate, sr_new=self.sample_rate)
+            stream = resample(stream, sample_rate, self.sample_rate)
 
-        return stream
+        return float_to_pcm(stream)
 
     def flush_talk(self):
         self.tts.flush_talk()
@@ -140,17 +166,35 @@ class BaseReal:
         return self.speaking
     
     def __loadcustom(self):
-        for item in self.opt.customopt:
-            print(item)
-            input_img_list = glob.glob(os.path.join(item['imgpath'], '*.[jpJP][pnPN]*[gG]'))
-            input_img_list = sorted(input_img_list)
-            if len(input_img_list) == 0:
-                print(f"[WARN] No images found in {item['imgpath']} for audiotype {item['audiotype']}")
-            self.custom_img_cycle[item['audiotype']] = read_imgs(input_img_list)
-            self.custom_audio_cycle[item['audiotype']], sample_rate = sf.read(item['audiopath'], dtype='float32')
-            self.custom_audio_index[item['audiotype']] = 0
-            self.custom_index[item['audiotype']] = 0
-            self.custom_opt[item['audiotype']] = item
+        '''自定义动作从进程级注册表取,同一路径只加载一次,所有会话共享'''
+        prefetch = getattr(self.opt,'custom_prefetch',0)
+        try:
+            for item in self.opt.customopt:
+                print(item)
+                clipkey = ('clip',item.get('videopath') or item['imgpath'],prefetch)
+                audiokey = ('audio',item['audiopath'])
+                self.custom_img_cycle[item['audiotype']] = registry.acquire(clipkey,lambda: load_custom_clip(item,prefetch))
+                self._registry_keys.append(clipkey) #每取到一个就记下, 失败时只释放已经取到的
+                self.custom_audio_cycle[item['audiotype']] = registry.acquire(audiokey,lambda: load_custom_audio(item['audiopath']))
+                self._registry_keys.append(audiokey)
+                self.custom_audio_index[item['audiotype']] = 0
+                self.custom_index[item['audiotype']] = 0
+                self.custom_schedule[item['audiotype']] = PlaySchedule(len(self.custom_img_cycle[item['audiotype']]) or 1) #空的返回0, 同mirror_index
+                self.custom_opt[item['audiotype']] = item
+        except:
+            self.__releasecustom()
+            raise
+
+    def __releasecustom(self):
+        for key in self._registry_keys:
+            if registry.release(key) and key[0]=='clip':
+                discard_frame_caches(('custom',key[1]))
+        self._registry_keys = []
+
+    def close(self):
+        '''会话结束,停止录制并释放共享的自定义动作'''
+        self.stop_recording()
+        self.__releasecustom()
 
     def init_customindex(self):
         self.curr_state=0
@@ -159,111 +203,120 @@ class BaseReal:
         for key in self.custom_index:
             self.custom_index[key]=0
 
+    def frames_key(self,height,audiotype=None):
+        '''帧序列在进程级缓存里的key,同一avatar/同一路径的自定义视频在同一档位下所有会话共享'''
+        if audiotype is not None:
+            item = self.custom_opt[audiotype]
+            return ('custom',item.get('videopath') or item['imgpath'],height)
+        return ('avatar',id(self.frame_list_cycle),height)
+
+    def set_output_profile(self,profile):
+        '''设置输出档位(1080p/720p/480p/360p/native)
+        渲染线程每帧开始时读一次output_height,下面的方法都传这个值,切换档位从下一帧生效'''
+        self.output_profile = profile
+        self.output_height = profile_height(profile)
+
+    def scaled_frames(self,height,audiotype=None):
+        '''height档位下的帧序列,背景按档位缩放一次后共享'''
+        if audiotype is not None:
+            frames = self.custom_img_cycle[audiotype]
+        else:
+            frames = self.frame_list_cycle
+        return scaled_cache.get(self.frames_key(height,audiotype),frames,height)
+
+    def scale_box(self,height,x1,y1,x2,y2):
+        '''avatar原始坐标换算到height档位'''
+        frames = self.scaled_frames(height)
+        sx = getattr(frames,'scale_x',1.0)
+        sy = getattr(frames,'scale_y',1.0)
+        if sx == 1.0 and sy == 1.0:
+            return x1,y1,x2,y2
+        return int(x1*sx),int(y1*sy),int(x2*sx),int(y2*sy)
+
+    def idle_packet(self,height,audiotype,idx):
+        '''静音帧返回共享的已编码包,缓存未就绪或不在关键帧边界时返回None,走正常编码'''
+        if not self.idle_passthrough:
+            return None
+        if self.custom_index.get(audiotype) is not None:
+            key = self.frames_key(height,audiotype)
+            loop = idle_cache.get(key,self.scaled_frames(height,audiotype))
+            if not loop:
+                return None
+            return self._idle_cursor.next_packet(key,loop,pos=self.custom_index[audiotype])
+        key = self.frames_key(height)
+        loop = idle_cache.get(key,self.scaled_frames(height),self.schedule)
+        if not loop:
+            return None
+        return self._idle_cursor.next_packet(key,loop,idx=idx)
+
+    def output_frame(self,height,idx,audiotype=None):
+        '''静音时直接输出的整帧,yuv输出时取缓存好的I420帧'''
+        frames = self.scaled_frames(height,audiotype)
+        if self.yuv_output and even_size(frames[idx]):
+            return yuv_cache.get(self.frames_key(height,audiotype),frames)[idx]
+        return frames[idx]
+
+    def paste_frame(self,height,idx,patch,x1,y1):
+        '''把推理结果贴回avatar原图,坐标是scale_box换算到height档位的坐标,yuv输出时只转换贴图区域'''
+        frames = self.scaled_frames(height)
+        if self.yuv_output and even_size(frames[idx]):
+            return paste_i420(yuv_cache.get(self.frames_key(height),frames)[idx],frames[idx],patch,x1,y1)
+        combine_frame = frames[idx].copy()
+        ph,pw = patch.shape[:2]
+        combine_frame[y1:y1+ph, x1:x1+pw] = patch
+        return combine_frame
+
+    def video_frame(self,image):
+        if image.ndim == 2: #I420
+            return VideoFrame.from_ndarray(image, format="yuv420p")
+        return VideoFrame.from_ndarray(image, format="bgr24")
+
+    def reset_idle(self):
+        '''开始说话,下次静音要从关键帧重新进入透传'''
+        self._idle_cursor.reset()
+
     def notify(self,eventpoint):
         print("notify:",eventpoint)
 
-    def start_recording(self):
-        """开始录制视频"""
-        if self.recording:
-            return
-
-        command = ['ffmpeg',
-                    '-y', '-an',
-                    '-f', 'rawvideo',
-                    '-vcodec','rawvideo',
-                    '-pix_fmt', 'bgr24', #像素格式
-                    '-s', "{}x{}".format(self.width, self.height),
-                    '-r', str(25),
-                    '-i', '-',
-                    '-pix_fmt', 'yuv420p', 
-                    '-vcodec', "h264",
-                    #'-f' , 'flv',                  
-                    f'temp{self.opt.sessionid}.mp4']
-        self._record_video_pipe = subprocess.Popen(command, shell=False, stdin=subprocess.PIPE)
-
-        acommand = ['ffmpeg',
-                    '-y', '-vn',
-                    '-f', 's16le',
-                    #'-acodec','pcm_s16le',
-                    '-ac', '1',
-                    '-ar', '16000',
-                    '-i', '-',
-                    '-acodec', 'aac',
-                    #'-f' , 'wav',                  
-                    f'temp{self.opt.sessionid}.aac']
-        self._record_audio_pipe = subprocess.Popen(acommand, shell=False, stdin=subprocess.PIPE)
+    def start_recording(self,tracks=None):
+        """开始录制视频, 输出到 record_dir/<sessionid>/
+        tracks为协商到H264的webrtc会话的音视频轨道, 打开record_passthrough时webrtc和录制共用一次编码"""
+        with self._record_lock:
+            if self._recorder is None:
+                self._start_recording(tracks)
 
+    def _start_recording(self,tracks):
+        opt = self.opt
+        directory = os.path.join(getattr(opt,'record_dir','data/record'),str(self.sessionid))
+        segment_time = getattr(opt,'record_segment',0)
+        keep = getattr(opt,'record_keep',0)
+        if tracks and getattr(opt,'record_passthrough',False):
+            recorder = PacketRecorder(directory,tracks,fps=25,segment_time=segment_time,keep=keep)
+        else:
+            recorder = Recorder(directory,fps=25,sample_rate=self.sample_rate,
+                                      segment_time=segment_time,keep=keep)
+        recorder.start()
+        self._recorder = recorder
         self.recording = True
-        # self.recordq_video.queue.clear()
-        # self.recordq_audio.queue.clear()
-        # self.container = av.open(path, mode="w")
-    
-        # process_thread = Thread(target=self.record_frame, args=())
-        # process_thread.start()
     
     def record_video_data(self,image):
-        if self.width == 0:
-            print("image.shape:",image.shape)
-            self.height,self.width,_ = image.shape
-        if self.recording:
-            self._record_video_pipe.stdin.write(image.tostring())
-
-    def record_audio_data(self,frame):
-        if self.recording:
-            self._record_audio_pipe.stdin.write(frame.tostring())
-    
-    # def record_frame(self): 
-    #     videostream = self.container.add_stream("libx264", rate=25)
-    #     videostream.codec_context.time_base = Fraction(1, 25)
-    #     audiostream = self.container.add_stream("aac")
-    #     audiostream.codec_context.time_base = Fraction(1, 16000)
-    #     init = True
-    #     framenum = 0       
-    #     while self.recording:
-    #         try:
-    #             videoframe = self.recordq_video.get(block=True, timeout=1)
-    #             videoframe.pts = framenum #int(round(framenum*0.04 / videostream.codec_context.time_base))
-    #             videoframe.dts = videoframe.pts
-    #             if init:
-    #                 videostream.width = videoframe.width
-    #                 videostream.height = videoframe.height
-    #                 init = False
-    #             for packet in videostream.encode(videoframe):
-    #                 self.container.mux(packet)
-    #             for k in range(2):
-    #                 audioframe = self.recordq_audio.get(block=True, timeout=1)
-    #                 audioframe.pts = int(round((framenum*2+k)*0.02 / audiostream.codec_context.time_base))
-    #                 audioframe.dts = audioframe.pts
-    #                 for packet in audiostream.encode(audioframe):
-    #                     self.container.mux(packet)
-    #             framenum += 1
-    #         except queue.Empty:
-    #             print('record queue empty,')
-    #             continue
-    #         except Exception as e:
-    #             print(e)
-    #             #break
-    #     for packet in videostream.encode(None):
-    #         self.container.mux(packet)
-    #     for packet in audiostream.encode(None):
-    #         self.container.mux(packet)
-    #     self.container.close()
-    #     self.recordq_video.queue.clear()
-    #     self.recordq_audio.queue.clear()
-    #     print('record thread stop')
+        recorder = self._recorder #stop_recording在别的线程里清空, 只读一次
+        if recorder is not None:
+            recorder.put_video(image)
+
+    def record_audio_data(self,frame): #int16 pcm
+        recorder = self._recorder
+        if recorder is not None:
+            recorder.put_audio(frame)
 		
     def stop_recording(self):
-        """停止录制视频"""
-        if not self.recording:
-            return
-        self.recording = False 
-        self._record_video_pipe.stdin.close()  #wait() 
-        self._record_video_pipe.wait()
-        self._record_audio_pipe.stdin.close()
-        self._record_audio_pipe.wait()
-        cmd_combine_audio = f"ffmpeg -y -i temp{self.opt.sessionid}.aac -i temp{self.opt.sessionid}.mp4 -c:v copy -c:a copy data/record.mp4"
-        os.system(cmd_combine_audio) 
-        #os.remove(output_path)
+        """停止录制视频, 返回录制的文件列表"""
+        with self._record_lock:
+            recorder, self._recorder = self._recorder, None
+            self.recording = False
+        if recorder is None:
+            return []
+        return recorder.stop()
 
     # def mirror_index(self,size, index):
     #     #size = len(self.coord_list_cycle)
@@ -278,12 +331,7 @@ class BaseReal:
         if size == 0:
            print("[ERROR] mirror_index: size is 0! Check custom_img_cycle resource.")
            return 0  # 或 raise Exception("No images loaded for this audiotype")
-        turn = index // size
-        res = index % size
-        if turn % 2 == 0:
-           return res
-        else:
-           return size - res - 1
+        return mirror_index(size, index)
     
     
     def get_audio_stream(self,audiotype):
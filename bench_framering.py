@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+渲染线程 -> PlayerStreamTrack 的帧交接对比: 原来每帧 run_coroutine_threadsafe(asyncio.Queue.put) 和 FrameRing
+统计渲染线程每帧的耗时和事件循环被唤醒的次数, 同时检查消费者是否收到了全部帧(唤醒丢失时会超时)
+
+    python bench_framering.py [--items 30000] [--batch 3]
+"""
+import time
+import asyncio
+import argparse
+import threading
+
+from webrtc import FrameRing
+
+def produce(push, items, batch):
+    t = time.perf_counter()
+    for i in range(0, items, batch):
+        push(list(range(i, min(i + batch, items))))
+        if i % (batch * 50) == 0:
+            time.sleep(0) #让出GIL, 模拟渲染线程在两批之间做别的事
+    return time.perf_counter() - t
+
+async def run_queue(items, batch):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    def push(frames):
+        for frame in frames:
+            asyncio.run_coroutine_threadsafe(queue.put(frame), loop)
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault('cost', produce(push, items, batch)))
+    thread.start()
+    for _ in range(items):
+        await asyncio.wait_for(queue.get(), 5)
+    thread.join()
+    return result['cost'], items
+
+async def run_ring(items, batch):
+    ring = FrameRing()
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault('cost', produce(ring.push_many, items, batch)))
+    thread.start()
+    for _ in range(items):
+        await asyncio.wait_for(ring.get(), 5)
+    thread.join()
+    return result['cost'], ring.wakeups
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the render thread -> track frame handoff')
+    parser.add_argument('--items', type=int, default=30000)
+    parser.add_argument('--batch', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    print(f'{args.items}帧, 每批{args.batch}帧, 取{args.repeat}次中最快的一次')
+    for name, fn in (('asyncio.Queue + run_coroutine_threadsafe', run_queue), ('FrameRing', run_ring)):
+        best = None
+        for _ in range(args.repeat):
+            cost, wakeups = asyncio.run(fn(args.items, args.batch))
+            if best is None or cost < best[0]:
+                best = (cost, wakeups)
+        cost, wakeups = best
+        print(f'  {name:42s} 生产者每帧 {cost/args.items*1e6:6.2f}us  唤醒事件循环 {wakeups}次')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+重采样对比: resampler.StreamResampler 和 resampy
+按TTS后端实际的网络块大小分块处理, 统计耗时, 以及和整段resampy结果的差异(块边界断点会体现在最大误差上)
+
+    python bench_resampler.py [--seconds 10] [--repeat 5]
+"""
+import time
+import argparse
+
+import numpy as np
+
+from resampler import StreamResampler, resample
+
+# (原采样率, 每块采样数): fishtts 44.1k 17640字节, cosyvoice/xtts 24k 9600字节
+CASES = [(44100, 8820), (24000, 4800), (32000, 6400), (48000, 9600)]
+SR_NEW = 16000
+
+def make_signal(sr, seconds, seed=0):
+    """语音频段的正弦扫频加噪声"""
+    t = np.arange(int(sr * seconds)) / sr
+    sweep = np.sin(2 * np.pi * (100 * t + (3500 - 100) / (2 * seconds) * t * t))
+    noise = np.random.default_rng(seed).standard_normal(len(t)) * 0.05
+    return (0.5 * sweep + noise).astype(np.float32)
+
+def chunks(x, size):
+    return [x[i:i + size] for i in range(0, len(x), size)]
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        out = fn()
+        cost = time.perf_counter() - t
+        best = cost if best is None else min(best, cost)
+    return best, out
+
+def diff(a, b, skip=200):
+    """去掉两端后的最大误差和信噪比(dB)"""
+    n = min(len(a), len(b))
+    a, b = a[skip:n - skip], b[skip:n - skip]
+    err = a - b
+    snr = 10 * np.log10(np.sum(b * b) / max(np.sum(err * err), 1e-20))
+    return np.abs(err).max(), snr
+
+def run_stream(blocks, sr):
+    r = StreamResampler(sr, SR_NEW)
+    return np.concatenate([r.process(b) for b in blocks] + [r.flush()])
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the streaming resampler against resampy')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    try:
+        import resampy
+    except ImportError:
+        resampy = None
+        print('resampy未安装, 只测试StreamResampler')
+
+    print(f'{args.seconds}s音频 -> {SR_NEW}, 取{args.repeat}次中最快的一次')
+    for sr, size in CASES:
+        x = make_signal(sr, args.seconds)
+        blocks = chunks(x, size)
+        print(f'\n{sr} -> {SR_NEW}, {len(blocks)}块 x {size}采样')
+        cost, stream = timed(lambda: run_stream(blocks, sr), args.repeat)
+        whole = resample(x, sr, SR_NEW)
+        print(f'  StreamResampler 分块   {cost*1000:8.1f}ms  实时倍数{args.seconds/cost:7.0f}x  和整段自身相差 {np.abs(stream-whole).max():.2e}')
+        if resampy is None:
+            continue
+        ref = resampy.resample(x, sr, SR_NEW)
+        cost, out = timed(lambda: np.concatenate([resampy.resample(b, sr, SR_NEW) for b in blocks]), args.repeat)
+        err, snr = diff(out, ref)
+        print(f'  resampy 分块(原做法)   {cost*1000:8.1f}ms  实时倍数{args.seconds/cost:7.0f}x  和整段resampy最大误差 {err:.4f} SNR {snr:5.1f}dB')
+        cost, _ = timed(lambda: resampy.resample(x, sr, SR_NEW), args.repeat)
+        print(f'  resampy 整段           {cost*1000:8.1f}ms  实时倍数{args.seconds/cost:7.0f}x')
+        err, snr = diff(stream, ref)
+        print(f'  StreamResampler和整段resampy: 最大误差 {err:.4f} SNR {snr:5.1f}dB')
+
+if __name__ == '__main__':
+    main()
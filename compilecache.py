@@ -0,0 +1,111 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 编译后模型的磁盘缓存: 第一次启动trace+freeze后保存TorchScript, 之后直接加载
+# key包含权重文件校验和, 输入形状, 设备和torch/cuda/python版本, 任何一个变化都会重新编译
+# 同一个模型最多保留KEEP份(不同batch_size/分辨率), 按使用时间淘汰
+
+import os
+import sys
+import json
+import glob
+import time
+import hashlib
+
+import torch
+
+from logger import logger
+
+KEEP = 4
+
+def file_checksum(path):
+    '''权重文件的sha256, 结果按(大小,修改时间)记在旁边的.sha256文件里, 文件没变时不用重算'''
+    stat = os.stat(path)
+    stamp = f'{stat.st_size}:{int(stat.st_mtime)}'
+    side = path + '.sha256'
+    if os.path.exists(side):
+        with open(side) as f:
+            saved = f.read().split()
+        if len(saved) == 2 and saved[0] == stamp:
+            return saved[1]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    digest = h.hexdigest()
+    try:
+        with open(side, 'w') as f:
+            f.write(f'{stamp} {digest}')
+    except OSError: #权重目录只读时每次重算
+        pass
+    return digest
+
+def artifact_meta(model_path, device, **shape):
+    device = str(device)
+    meta = {
+        'model': os.path.basename(model_path),
+        'checksum': file_checksum(model_path),
+        'device': device,
+        'torch': torch.__version__,
+        'cuda': torch.version.cuda,
+        'python': '%d.%d' % sys.version_info[:2],
+    }
+    if device.startswith('cuda'):
+        meta['gpu'] = torch.cuda.get_device_name(torch.device(device))
+    meta.update(shape)
+    return meta
+
+def artifact_path(cache_dir, meta):
+    digest = hashlib.sha1(json.dumps(meta, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    name = os.path.splitext(meta['model'])[0]
+    return os.path.join(cache_dir, f'{name}-{digest}.ts')
+
+def load_or_compile(cache_dir, model_path, builder, example_inputs, device, **shape):
+    '''
+    返回编译好的模型, 缓存里有对应的TorchScript时直接加载(不用再读权重), 否则用builder()构建eager模型后trace并保存
+    shape: batch_size, 分辨率等参与key的参数
+    '''
+    meta = artifact_meta(model_path, device, **shape)
+    path = artifact_path(cache_dir, meta)
+    if os.path.exists(path):
+        t = time.perf_counter()
+        try:
+            model = torch.jit.load(path, map_location=device)
+            os.utime(path) #记录使用时间
+            logger.info('load compiled model %s in %.2fs', path, time.perf_counter() - t)
+            return model
+        except Exception:
+            logger.exception('compiled model %s is broken, compiling again', path)
+            os.remove(path)
+
+    model = builder()
+    t = time.perf_counter()
+    try:
+        with torch.no_grad():
+            compiled = torch.jit.freeze(torch.jit.trace(model, example_inputs))
+    except Exception:
+        logger.exception('compile %s failed, using the eager model', meta['model'])
+        return model
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = path + '.tmp'
+    torch.jit.save(compiled, tmp, _extra_files={'meta.json': json.dumps(meta)})
+    os.replace(tmp, path)
+    artifacts = glob.glob(os.path.join(cache_dir, os.path.splitext(meta['model'])[0] + '-*.ts'))
+    for old in sorted(artifacts, key=os.path.getmtime, reverse=True)[KEEP:]:
+        os.remove(old)
+    logger.info('compiled %s in %.2fs -> %s', meta['model'], time.perf_counter() - t, path)
+    return compiled
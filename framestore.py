@@ -0,0 +1,308 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 自定义动作视频按需解码, 不再把所有帧预先读进内存
+# 来源可以是图片目录, 视频文件或者.npy帧数组, 后台线程按播放方向预取一个有界窗口
+
+import os
+import glob
+import time
+import functools
+import threading
+import collections
+from threading import Thread
+
+import cv2
+import numpy as np
+
+from logger import logger
+
+def try_int(s):
+    try:
+        return int(os.path.splitext(os.path.basename(s))[0])
+    except:
+        return s
+
+
+class ImageDirSource:
+    """图片目录, 文件名按数字排序(或者由files给出), 尺寸统一到第一帧"""
+
+    def __init__(self, path, files=None):
+        self.path = path
+        if files is None:
+            files = sorted(glob.glob(os.path.join(path, '*.[jpJP][pnPN]*[gG]')), key=try_int)
+        self.files = files
+        self.size = None
+        if self.files:
+            first = cv2.imread(self.files[0])
+            self.size = (first.shape[1], first.shape[0])
+
+    def __len__(self):
+        return len(self.files)
+
+    def read(self, start, stop):
+        frames = []
+        for path in self.files[start:stop]:
+            frame = cv2.imread(path)
+            if frame is None:
+                logger.error('Failed to read image: %s', path)
+                frame = np.zeros((self.size[1], self.size[0], 3), dtype=np.uint8)
+            elif (frame.shape[1], frame.shape[0]) != self.size:
+                frame = cv2.resize(frame, self.size)
+            frames.append(frame)
+        return frames
+
+
+class VideoFileSource:
+    """
+    视频文件, 一段连续的帧先seek到前面的关键帧再顺序解码
+    帧数按包数统计(stream.frames是文件头的估计值, 可能偏大), 解码到结尾还不够时按实际解码出的帧数截短
+    """
+
+    def __init__(self, path):
+        import av
+        self.path = path
+        self._container = av.open(path)
+        self._stream = self._container.streams.video[0]
+        self._stream.thread_type = 'AUTO'
+        self._rate = self._stream.average_rate
+        self._tb = self._stream.time_base
+        self._start = self._stream.start_time or 0 # 第一帧的pts不一定是0
+        self._count = sum(1 for packet in self._container.demux(self._stream) if packet.size > 0)
+        self._container.seek(0)
+        self._next = None # 解码器下一帧的序号, 顺序读取时不用seek
+
+    def __len__(self):
+        return self._count
+
+    def _index(self, frame):
+        return int(round(float((frame.pts - self._start) * self._tb * self._rate)))
+
+    def read(self, start, stop):
+        """返回[start,stop)的帧, 到文件结尾时可能不够"""
+        if self._next != start:
+            self._container.seek(self._start + int(start / self._rate / self._tb), stream=self._stream, backward=True)
+        frames = []
+        last = None
+        end = 0 # 解码到的最大帧号+1
+        for frame in self._container.decode(self._stream):
+            idx = self._index(frame)
+            end = max(end, idx + 1)
+            if idx < start + len(frames): # seek到的关键帧之后, start之前的帧, 或者重复的时间戳
+                continue
+            image = frame.to_ndarray(format='bgr24')
+            while start + len(frames) <= min(idx, stop - 1): # 时间戳有空缺时重复当前帧, 帧号和序号保持一一对应
+                frames.append(image)
+            last = idx
+            if start + len(frames) >= stop:
+                break
+        else:
+            if end < self._count:
+                logger.warning('%s: decoded %d frames, container reports %d', self.path, end, self._count)
+                self._count = end
+            last = None # 解码器已经到结尾, 下次要重新seek
+        self._next = start + len(frames) if last == start + len(frames) - 1 else None
+        return frames
+
+
+class ArraySource:
+    """打包好的帧数组(.npy, mmap方式打开), 按需换页"""
+
+    def __init__(self, path):
+        self.path = path
+        self._frames = np.load(path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self._frames)
+
+    def read(self, start, stop):
+        return [np.ascontiguousarray(f) for f in self._frames[start:stop]]
+
+
+def mirror_index(size, index):
+    turn = index // size
+    res = index % size
+    if turn % 2 == 0:
+        return res
+    else:
+        return size - res - 1
+
+
+class PlaySchedule:
+    """
+    帧序列的播放顺序表, 播放位置pos对应帧号order[pos % period]
+    默认ping-pong(0..n-1,n-1..0); materialized表示帧已经按ping-pong顺序展开存储, 直接顺序播放
+    order用tuple保存, 每帧查表比numpy取元素再转int快
+    """
+
+    def __init__(self, size, materialized=False):
+        self.size = size
+        self.materialized = materialized
+        forward = tuple(range(size))
+        self.order = forward if materialized else forward + forward[::-1]
+        self.period = len(self.order)
+
+    def __len__(self):
+        return self.period
+
+    def __getitem__(self, pos):
+        return self.order[pos % self.period]
+
+    def window(self, pos, n):
+        """从pos开始n个位置的帧号"""
+        pos %= self.period
+        if pos + n <= self.period:
+            return self.order[pos:pos + n]
+        return tuple(self.order[(pos + i) % self.period] for i in range(n))
+
+@functools.lru_cache(maxsize=16)
+def play_schedule(size, materialized=False):
+    """加载avatar时用, 同样长度的序列共用一张表; 每帧查表的地方应该把表保存在自己身上"""
+    return PlaySchedule(size, materialized)
+
+
+class PrefetchedFrames:
+    """
+    帧序列接口(len/[]), 内存里最多保留capacity帧(LRU)
+    播放顺序是镜像循环(0..n-1,n-1..0), 后台线程按镜像顺序预取后面window帧
+    同一序列会被多个线程读(共享avatar/自定义动作的各个会话, 静音编码线程), 每个读线程单独记录位置和方向,
+    预取时合并所有读线程的窗口
+    """
+
+    STALE = 5.0 #秒, 读线程这么久没访问就不再为它预取
+
+    streaming = True
+
+    def __init__(self, source, window=50, capacity=0):
+        self.source = source
+        self.window = window
+        self.capacity = max(capacity, 2 * window)
+        self._len = len(source)
+        self._frames = collections.OrderedDict()
+        self._lock = threading.Lock()   # 保护_frames
+        self._io = threading.Lock()     # 解码器不能并发使用
+        self._wanted = threading.Event()
+        self._cursors = {} # 读线程id -> [上次帧号, 方向, 访问时间]
+        self._limit = self.capacity
+        self.hits = 0
+        self.misses = 0
+        self._closed = False
+        Thread(target=self._prefetch, daemon=True, name='prefetch').start()
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self._len
+        reader = threading.get_ident()
+        cursor = self._cursors.get(reader)
+        if cursor is None:
+            with self._lock:
+                cursor = self._cursors.setdefault(reader, [idx, 1, 0.0])
+        elif idx != cursor[0]:
+            cursor[1] = 1 if idx > cursor[0] else -1
+            cursor[0] = idx
+        cursor[2] = time.monotonic()
+        with self._lock:
+            frame = self._frames.get(idx)
+            if frame is not None:
+                self._frames.move_to_end(idx)
+        if frame is None:
+            self.misses += 1
+            self._load(idx, idx + 1)
+            with self._lock:
+                frame = self._frames.get(idx)
+            if frame is None: # 视频实际能解码出的帧比统计的少, 用最后一帧代替
+                size = self._len = len(self.source)
+                if size == 0:
+                    raise IndexError(idx)
+                self._load(size - 1, size)
+                with self._lock:
+                    frame = self._frames[size - 1]
+        else:
+            self.hits += 1
+        self._wanted.set()
+        return frame
+
+    def _load(self, start, stop):
+        with self._io:
+            with self._lock:
+                missing = [i for i in range(start, stop) if i not in self._frames]
+            if not missing:
+                return
+            start, stop = missing[0], missing[-1] + 1
+            frames = self.source.read(start, stop)
+        with self._lock:
+            for i, frame in enumerate(frames, start):
+                self._frames[i] = frame
+                self._frames.move_to_end(i)
+            while len(self._frames) > self._limit:
+                self._frames.popitem(last=False)
+
+    def schedule(self, idx, direction):
+        """idx之后将要播放的window帧, 按镜像循环展开"""
+        pos = idx if direction > 0 else 2 * self._len - 1 - idx
+        return [mirror_index(self._len, pos + k) for k in range(1, self.window + 1)]
+
+    def close(self):
+        self._closed = True
+        self._wanted.set()
+        with self._lock:
+            self._frames.clear()
+
+    def _prefetch(self):
+        while True:
+            self._wanted.wait()
+            self._wanted.clear()
+            if self._closed:
+                break
+            now = time.monotonic()
+            with self._lock:
+                for reader in [r for r, c in self._cursors.items() if now - c[2] > self.STALE]:
+                    del self._cursors[reader]
+                cursors = [(c[0], c[1]) for c in self._cursors.values()]
+                # 每个读线程的窗口都要放得下
+                self._limit = max(self.capacity, self.window * (len(cursors) + 1))
+                wanted = set()
+                for idx, direction in cursors:
+                    wanted.update(self.schedule(idx, direction))
+                missing = sorted(i for i in wanted if i not in self._frames)
+            # 连续的帧一次读取, 视频文件只seek一次
+            runs = []
+            for i in missing:
+                if runs and runs[-1][1] == i:
+                    runs[-1][1] = i + 1
+                else:
+                    runs.append([i, i + 1])
+            try:
+                for start, stop in runs:
+                    self._load(start, stop)
+            except Exception:
+                logger.exception('prefetch %s', getattr(self.source, 'path', ''))
+
+
+def open_clip(path, window=50, capacity=0, files=None):
+    """按路径打开帧序列: 图片目录(files为已知的文件列表), .npy帧数组或者视频文件, 内存里最多保留capacity帧"""
+    if os.path.isdir(path):
+        source = ImageDirSource(path, files)
+    elif path.endswith('.npy'):
+        source = ArraySource(path)
+    else:
+        source = VideoFileSource(path)
+    logger.info('open clip %s: %d frames, prefetch window %d', path, len(source), window)
+    return PrefetchedFrames(source, window, capacity)
@@ -0,0 +1,124 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 远程TTS服务的HTTP连接池: 每个服务地址(scheme://host:port)一个requests.Session, 进程内所有会话和合成线程共享
+# keep-alive复用连接, 每句话不用再做TCP/TLS握手
+# 按TTS后端统计请求数, 新建连接数(请求前后urllib3连接池的连接数之差), 复用率和收到响应头的平均时间
+# 同一地址的多个后端共用连接, 统计仍然分开
+
+import time
+import threading
+from urllib.parse import urlsplit
+
+from logger import logger
+
+
+class HTTPPool:
+
+    def __init__(self, pool_size=8, connect_timeout=3.0, read_timeout=60.0):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout) #read_timeout是两次收到数据之间的最长间隔
+        self._lock = threading.Lock()
+        self._sessions = {} # origin -> requests.Session
+        self._stats = {}    # 后端名 -> 统计
+
+    def session(self, url):
+        origin = '{0.scheme}://{0.netloc}'.format(urlsplit(url))
+        with self._lock:
+            session = self._sessions.get(origin)
+            if session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                #合成线程数可能超过pool_size, pool_block=False时多出来的请求临时建连接, 用完不放回
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[origin] = session
+                logger.info('http pool for %s, %d connections', origin, self.pool_size)
+            return origin, session
+
+    def request(self, backend, method, url, **kwargs):
+        '''同requests.request, 连接走共享的池, 没传timeout时用池的超时设置'''
+        origin, session = self.session(url)
+        kwargs.setdefault('timeout', self.timeout)
+        connections = self._connections(session)
+        start = time.perf_counter()
+        try:
+            res = session.request(method, url, **kwargs)
+        except Exception:
+            self._count(backend, origin, errors=1, connections=self._connections(session) - connections)
+            raise
+        #同一地址上别的后端同时建的连接也可能算进来, 并发不高时基本准确
+        self._count(backend, origin, requests=1, wait=time.perf_counter() - start,
+                    connections=self._connections(session) - connections)
+        return res
+
+    def _count(self, backend, origin, **delta):
+        with self._lock:
+            stats = self._stats.get(backend)
+            if stats is None:
+                stats = self._stats[backend] = {'servers': set(), 'requests': 0, 'errors': 0, 'connections': 0, 'wait': 0.0}
+            stats['servers'].add(origin)
+            for key, value in delta.items():
+                stats[key] += max(0, value)
+
+    def _connections(self, session):
+        '''urllib3连接池里累计新建的连接数'''
+        count = 0
+        adapters = {id(adapter): adapter for adapter in session.adapters.values()} #http和https挂的是同一个
+        for adapter in adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                count += getattr(pool, 'num_connections', 0)
+        return count
+
+    def stats(self):
+        with self._lock:
+            items = [(backend, dict(stats)) for backend, stats in self._stats.items()]
+        backends = {}
+        for backend, stats in items:
+            requests = stats['requests']
+            connections = stats['connections']
+            backends[backend] = {
+                'servers': sorted(stats['servers']),
+                'requests': requests,
+                'errors': stats['errors'],
+                'connections': connections,
+                'reused': max(0, requests - connections),
+                'reuse_rate': round(max(0, requests - connections) / requests, 3) if requests else 0,
+                'avg_wait_ms': round(stats['wait'] / requests * 1000, 1) if requests else 0,
+            }
+        return {'pool_size': self.pool_size, 'timeout': list(self.timeout), 'backends': backends}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool(opt):
+    """进程级的连接池, 第一次调用时按opt创建"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = HTTPPool(getattr(opt, 'tts_pool_size', 8),
+                             getattr(opt, 'tts_connect_timeout', 3.0),
+                             getattr(opt, 'tts_read_timeout', 60.0))
+        return _pool
+
+def pool_stats():
+    return _pool.stats() if _pool else {'backends': {}}
@@ -2,6 +2,7 @@ import time
 import torch
 import numpy as np
 from baseasr import BaseASR
+from audioframe import pcm_to_float
 
 # hubert audio feature
 class HubertASR(BaseASR):
@@ -25,7 +26,7 @@ class HubertASR(BaseASR):
         if len(self.frames) <= self.stride_left_size + self.stride_right_size:
             return
         
-        inputs = np.concatenate(self.frames)  # [N * chunk]
+        inputs = pcm_to_float(np.concatenate(self.frames))  # [N * chunk]
 
         mel = self.audio_processor.get_hubert_from_16k_speech(inputs)
         mel_chunks=self.audio_processor.feature2chunks(feature_array=mel,fps=self.fps/2,batch_size=self.batch_size,audio_feat_length = self.audio_feat_length, start=self.stride_left_size/2)
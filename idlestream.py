@@ -0,0 +1,169 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 静音时的待机循环视频(frame_list_cycle / custom_img_cycle)只编码一次H264,
+# 所有会话共享编码后的包, 直接透传给RTCRtpSender, 不再每个会话重复编码
+
+import time
+import threading
+from threading import Thread
+from fractions import Fraction
+
+import av
+from av.packet import Packet
+
+from logger import logger
+from framestore import play_schedule
+
+IDLE_FPS = 25
+IDLE_GOP = 25  # 每秒一个关键帧, 说话结束后最多等待1s切到透传
+
+class EncodedLoop:
+    """按播放顺序表编码好的一个循环, 位置pos对应帧号schedule[pos]"""
+
+    def __init__(self, packets, keyframes, schedule):
+        self.packets = packets      # list[bytes], 长度schedule.period
+        self.keyframes = keyframes  # list[bool]
+        self.schedule = schedule
+
+    def __len__(self):
+        return len(self.packets)
+
+    def is_keyframe(self, pos):
+        return self.keyframes[pos % len(self.packets)]
+
+    def packet(self, pos):
+        # 每次发送新建Packet, pts/time_base由PlayerStreamTrack.recv改写
+        pos %= len(self.packets)
+        packet = Packet(self.packets[pos])
+        packet.is_keyframe = self.keyframes[pos] #FrameRing丢帧时按关键帧对齐
+        return packet
+
+    def position(self, idx, last_pos):
+        """根据帧号idx和上一次的位置推算循环内的位置"""
+        n = len(self.packets)
+        if last_pos is not None:
+            nextpos = (last_pos + 1) % n
+            if self.schedule[nextpos] == idx:
+                return nextpos
+        return idx
+
+def encode_loop(frames, schedule=None, fps=IDLE_FPS, gop=IDLE_GOP, bitrate=1000000):
+    """把一个帧序列按播放顺序(默认ping-pong)编码成H264 Annex-B包, 参数和aiortc的H264Encoder保持一致"""
+    schedule = schedule or play_schedule(len(frames))
+    height, width = frames[0].shape[:2]
+    codec = av.CodecContext.create('libx264', 'w')
+    codec.width = width - width % 2
+    codec.height = height - height % 2
+    codec.bit_rate = bitrate
+    codec.pix_fmt = 'yuv420p'
+    codec.framerate = Fraction(fps, 1)
+    codec.time_base = Fraction(1, fps)
+    codec.options = {
+        'profile': 'baseline',
+        'level': '31',
+        'tune': 'zerolatency',
+        'x264-params': f'keyint={gop}:min-keyint={gop}:scenecut=0',
+    }
+
+    packets = []
+    keyframes = []
+    for pos in range(schedule.period):
+        image = frames[schedule[pos]]
+        frame = av.VideoFrame.from_ndarray(image[:codec.height, :codec.width], format='bgr24')
+        frame.pts = pos
+        for packet in codec.encode(frame):
+            packets.append(bytes(packet))
+            keyframes.append(packet.is_keyframe)
+    for packet in codec.encode(None):
+        packets.append(bytes(packet))
+        keyframes.append(packet.is_keyframe)
+
+    if len(packets) != schedule.period or not keyframes[0]:
+        raise ValueError(f'idle loop encode mismatch: {len(packets)} packets for {schedule.period} frames')
+    return EncodedLoop(packets, keyframes, schedule)
+
+
+class IdleStreamCache:
+    """进程级缓存, key -> EncodedLoop, 第一次请求时在后台线程编码"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loops = {}
+        self._pending = set()
+
+    def get(self, key, frames, schedule=None):
+        """返回已编码的循环, 还没编码好时返回None并启动后台编码, schedule为None时按ping-pong顺序"""
+        loop = self._loops.get(key)
+        if loop is not None or len(frames) == 0:
+            return loop
+        with self._lock:
+            if key in self._loops or key in self._pending:
+                return self._loops.get(key)
+            self._pending.add(key)
+        Thread(target=self._encode, args=(key, frames, schedule), daemon=True).start()
+        return None
+
+    def _encode(self, key, frames, schedule):
+        t = time.perf_counter()
+        try:
+            loop = encode_loop(frames, schedule)
+            logger.info('idle loop %s encoded: %d packets in %.2fs', key, len(loop), time.perf_counter()-t)
+        except Exception:
+            logger.exception('idle loop encode')
+            loop = False  # 编码失败不再重试, 走正常编码
+        with self._lock:
+            self._loops[key] = loop
+            self._pending.discard(key)
+
+    def discard(self, key):
+        """删除key开头的所有缓存"""
+        with self._lock:
+            for k in [k for k in self._loops if k[:len(key)] == key]:
+                del self._loops[k]
+
+idle_cache = IdleStreamCache()
+
+
+class IdleCursor:
+    """每个会话每个循环一个游标, 只在关键帧处进入透传, 之后必须逐帧连续"""
+
+    def __init__(self):
+        self.key = None
+        self.pos = None
+        self.streaming = False
+
+    def reset(self):
+        self.pos = None
+        self.streaming = False
+
+    def next_packet(self, key, loop, idx=None, pos=None):
+        """idx为镜像后的帧号(avatar循环), pos为循环内的原始位置(自定义视频的custom_index)"""
+        if key != self.key:
+            self.key = key
+            self.reset()
+        if pos is None:
+            pos = loop.position(idx, self.pos)
+        pos = pos % len(loop)
+        if self.streaming and pos != (self.pos + 1) % len(loop):
+            self.streaming = False  # 跳帧了, 等下一个关键帧
+        self.pos = pos
+        if not self.streaming and loop.is_keyframe(pos):
+            self.streaming = True
+        if self.streaming:
+            return loop.packet(pos)
+        return None
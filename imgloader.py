@@ -0,0 +1,87 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 多线程读取图片序列, cv2.imread解码时释放GIL, 线程数基本线性加速
+# 尺寸一致时结果直接写进预分配的(N,H,W,C)数组
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+from logger import logger
+
+_workers = min(32, os.cpu_count() or 1)
+
+def set_workers(n):
+    """设置默认的解码线程数, 0表示按cpu核数"""
+    global _workers
+    _workers = n if n > 0 else min(32, os.cpu_count() or 1)
+
+def _decode(path, size):
+    frame = cv2.imread(path)
+    if frame is not None and size is not None and (frame.shape[1], frame.shape[0]) != size:
+        frame = cv2.resize(frame, size)
+    return frame
+
+def read_imgs(img_list, workers=None, target_size=None, drop_failed=False):
+    """
+    按img_list的顺序读取图片
+    target_size: (w,h), 或者'first'表示统一到第一张图的尺寸, None不缩放
+    drop_failed: 读取失败的图片跳过, 否则抛出ValueError
+    返回(N,H,W,C)的uint8数组, 不缩放且尺寸不一致时返回数组列表
+    """
+    logger.info('reading %d images...', len(img_list))
+    if len(img_list) == 0:
+        return []
+    workers = workers or _workers
+    size = target_size
+    if size == 'first':
+        first = cv2.imread(img_list[0])
+        size = (first.shape[1], first.shape[0]) if first is not None else None
+
+    out = None # 尺寸一致时的预分配数组
+    frames = None # 出现尺寸不一致后改用列表
+    failed = set() # 每帧都要查, 用set
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(lambda path: _decode(path, size), img_list)
+        for i, frame in enumerate(tqdm(results, total=len(img_list))):
+            if frame is None:
+                logger.error('Failed to read image: %s', img_list[i])
+                failed.add(i)
+                continue
+            if frames is None:
+                if out is None:
+                    out = np.empty((len(img_list),) + frame.shape, dtype=frame.dtype)
+                if frame.shape == out.shape[1:]:
+                    out[i] = frame
+                    continue
+                frames = [None if j in failed else out[j] for j in range(i)] + [None] * (len(img_list) - i)
+                out = None
+            frames[i] = frame
+
+    if failed and not drop_failed:
+        raise ValueError(f'failed to read {len(failed)} images, first: {img_list[min(failed)]}')
+    if out is not None:
+        if failed:
+            out = np.delete(out, sorted(failed), axis=0)
+        return out
+    if frames is None: # 全部读取失败
+        return []
+    return [frame for frame in frames if frame is not None]
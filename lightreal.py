@@ -20,12 +20,8 @@ import torch
 import numpy as np
 
 #from .utils import *
-import os
 import time
 import cv2
-import glob
-import pickle
-import copy
 
 import queue
 from queue import Queue
@@ -34,16 +30,15 @@ import torch.multiprocessing as mp
 
 
 from hubertasr import HubertASR
-import asyncio
-from av import AudioFrame, VideoFrame
 from basereal import BaseReal
+from imgloader import read_imgs
+from framestore import open_clip
+from avatarpack import open_pack
+from avatarmanifest import load_manifest,avatar_images,avatar_coords
 
 #from imgcache import ImgCache
 
-from tqdm import tqdm
-
 #new
-import os
 import cv2
 import torch
 import numpy as np
@@ -65,23 +60,27 @@ def load_model(opt):
     audio_processor = Audio2Feature()
     return audio_processor
 
-def load_avatar(avatar_id):
+def load_avatar(avatar_id,frame_cache=0):
+    '''frame_cache>0时全身帧按需解码,内存里最多保留frame_cache帧'''
     avatar_path = f"./data/avatars/{avatar_id}"
     full_imgs_path = f"{avatar_path}/full_imgs" 
-    face_imgs_path = f"{avatar_path}/face_imgs" 
-    coords_path = f"{avatar_path}/coords.pkl" 
     
     model = Model(6, 'hubert').to(device)  # 假设Model是你自定义的类
     model.load_state_dict(torch.load(f"{avatar_path}/ultralight.pth"))
+
+    pack = open_pack(avatar_path) #有打包文件时直接mmap打开
+    if pack is not None:
+        return model.eval(),pack.frames('full_imgs'),pack.frames('face_imgs'),pack.coords('coords')
     
-    with open(coords_path, 'rb') as f:
-        coord_list_cycle = pickle.load(f)
-    input_img_list = glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-    input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    frame_list_cycle = read_imgs(input_img_list)
+    manifest = load_manifest(avatar_path) #有清单时不扫描目录,先检查文件和坐标是否对齐
+    coord_list_cycle = avatar_coords(avatar_path,'coords',manifest)
+    input_img_list = avatar_images(avatar_path,'full_imgs',manifest)
+    if frame_cache>0:
+        frame_list_cycle = open_clip(full_imgs_path,window=min(50,frame_cache//2),capacity=frame_cache,files=input_img_list)
+    else:
+        frame_list_cycle = read_imgs(input_img_list)
     #self.imagecache = ImgCache(len(self.coord_list_cycle),self.full_imgs_path,1000)
-    input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-    input_face_list = sorted(input_face_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+    input_face_list = avatar_images(avatar_path,'face_imgs',manifest)
     face_list_cycle = read_imgs(input_face_list)
 
     return model.eval(),frame_list_cycle,face_list_cycle,coord_list_cycle
@@ -95,14 +94,6 @@ def warm_up(batch_size,avatar,modelres):
     mel_batch = torch.ones(batch_size, 32, 32, 32).to(device)
     model(img_batch, mel_batch)
 
-def read_imgs(img_list):
-    frames = []
-    logger.info('reading images...')
-    for img_path in tqdm(img_list):
-        frame = cv2.imread(img_path)
-        frames.append(frame)
-    return frames
-
 def get_audio_features(features, index):
     left = index - 8
     right = index + 8
@@ -258,23 +249,26 @@ class LightReal(BaseReal):
                 res_frame,idx,audio_frames = self.res_frame_queue.get(block=True, timeout=1)
             except queue.Empty:
                 continue
+            height = self.output_height #每帧只读一次档位,中途切换从下一帧生效
             if audio_frames[0][1]!=0 and audio_frames[1][1]!=0: #全为静音数据，只需要取fullimg
                 self.speaking = False
                 audiotype = audio_frames[0][1]
+                packet = self.idle_packet(height,audiotype,idx)
                 if self.custom_index.get(audiotype) is not None: #有自定义视频
-                    mirindex = self.mirror_index(len(self.custom_img_cycle[audiotype]),self.custom_index[audiotype])
-                    combine_frame = self.custom_img_cycle[audiotype][mirindex]
+                    mirindex = self.custom_schedule[audiotype][self.custom_index[audiotype]]
+                    combine_frame = self.output_frame(height,mirindex,audiotype)
                     self.custom_index[audiotype] += 1
                     # if not self.custom_opt[audiotype].loop and self.custom_index[audiotype]>=len(self.custom_img_cycle[audiotype]):
                     #     self.curr_state = 1  #当前视频不循环播放，切换到静音状态
                 else:
-                    combine_frame = self.frame_list_cycle[idx]
+                    combine_frame = self.output_frame(height,idx)
                     #combine_frame = self.imagecache.get_img(idx)
             else:
                 self.speaking = True
+                self.reset_idle()
+                packet = None
                 bbox = self.coord_list_cycle[idx]
-                combine_frame = copy.deepcopy(self.frame_list_cycle[idx])
-                x1, y1, x2, y2 = bbox
+                x1, y1, x2, y2 = self.scale_box(height,*bbox) #在输出档位下贴图
 
                 crop_img = self.face_list_cycle[idx]
                 crop_img_ori = crop_img.copy()
@@ -284,24 +278,29 @@ class LightReal(BaseReal):
                     crop_img_ori = cv2.resize(crop_img_ori, (x2-x1,y2-y1))
                 except:
                     continue
-                combine_frame[y1:y2, x1:x2] = crop_img_ori
+                combine_frame = self.paste_frame(height,idx,crop_img_ori,x1,y1)
                 #print('blending time:',time.perf_counter()-t)
 
-            new_frame = VideoFrame.from_ndarray(combine_frame, format="bgr24")
-            asyncio.run_coroutine_threadsafe(video_track._queue.put((new_frame,None)), loop)
+            if packet is not None:
+                new_frame = packet
+            else:
+                new_frame = self.video_frame(combine_frame)
+            video_track._queue.push((new_frame,None))
             self.record_video_data(combine_frame)
 
+            audio_batch = []
             for audio_frame in audio_frames:
                 frame,type_,eventpoint = audio_frame
-                frame = (frame * 32767).astype(np.int16)
-                new_frame = AudioFrame(format='s16', layout='mono', samples=frame.shape[0])
-                new_frame.planes[0].update(frame.tobytes())
-                new_frame.sample_rate=16000
+                if type_ == 1: #静音直接发送预先生成的帧
+                    new_frame = audio_track.pool.silence
+                else:
+                    new_frame = audio_track.pool.get(frame)
                 # if audio_track._queue.qsize()>10:
                 #     time.sleep(0.1)
-                asyncio.run_coroutine_threadsafe(audio_track._queue.put((new_frame,eventpoint)), loop)
+                audio_batch.append((new_frame,eventpoint))
                 self.record_audio_data(frame)
                 #self.notify(eventpoint)
+            audio_track._queue.push_many(audio_batch)
         logger.info('lightreal process_frames thread stop') 
             
     def render(self,quit_event,loop=None,audio_track=None,video_track=None):
@@ -330,9 +329,8 @@ class LightReal(BaseReal):
             # if video_track._queue.qsize()>=2*self.opt.batch_size:
             #     print('sleep qsize=',video_track._queue.qsize())
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
-            if video_track._queue.qsize()>=5:
-                logger.debug('sleep qsize=%d',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
+            #等track消费腾出额度,超时说明客户端卡住,drop策略下继续生产由track丢弃旧帧
+            video_track._queue.wait_credit(timeout=video_track.buffer_ms/1000)
                 
             # delay = _starttime+_totalframe*0.04-time.perf_counter() #40ms
             # if delay > 0:
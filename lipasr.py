@@ -24,6 +24,7 @@ from queue import Queue
 #import multiprocessing as mp
 
 from baseasr import BaseASR
+from audioframe import pcm_to_float
 from wav2lip import audio
 
 class LipASR(BaseASR):
@@ -40,7 +41,7 @@ class LipASR(BaseASR):
         if len(self.frames) <= self.stride_left_size + self.stride_right_size:
             return
         
-        inputs = np.concatenate(self.frames) # [N * chunk]
+        inputs = pcm_to_float(np.concatenate(self.frames)) # [N * chunk]
         mel = audio.melspectrogram(inputs)
         #print(mel.shape[0],mel.shape,len(mel[0]),len(self.frames))
         # cut off stride
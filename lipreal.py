@@ -20,12 +20,8 @@ import torch
 import numpy as np
 
 #from .utils import *
-import os
 import time
 import cv2
-import glob
-import pickle
-import copy
 
 import queue
 from queue import Queue
@@ -34,17 +30,17 @@ import torch.multiprocessing as mp
 
 
 from lipasr import LipASR
-import asyncio
-from av import AudioFrame, VideoFrame
 from wav2lip.models import Wav2Lip
 from basereal import BaseReal
+from imgloader import read_imgs
+from framestore import open_clip,play_schedule
+from avatarpack import open_pack
+from avatarmanifest import load_manifest,avatar_images,avatar_coords
+from compilecache import load_or_compile
 
 #from imgcache import ImgCache
 
-from tqdm import tqdm
-
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
-print('Using {} for inference.'.format(device))
 
 def _load(checkpoint_path):
 	if device == 'cuda':
@@ -55,6 +51,7 @@ def _load(checkpoint_path):
 	return checkpoint
 
 def load_model(path):
+	print('Using {} for inference.'.format(device))
 	model = Wav2Lip()
 	print("Load checkpoint from: {}".format(path))
 	checkpoint = _load(path)
@@ -67,23 +64,36 @@ def load_model(path):
 	model = model.to(device)
 	return model.eval()
 
-def load_avatar(avatar_id):
+def load_avatar(avatar_id,frame_cache=0):
+    '''frame_cache>0时全身帧按需解码,内存里最多保留frame_cache帧'''
     avatar_path = f"./data/avatars/{avatar_id}"
     full_imgs_path = f"{avatar_path}/full_imgs" 
-    face_imgs_path = f"{avatar_path}/face_imgs" 
-    coords_path = f"{avatar_path}/coords.pkl"
+
+    pack = open_pack(avatar_path) #有打包文件时直接mmap打开
+    if pack is not None:
+        faces = pack.frames('face_input') if pack.has('face_input') else pack.frames('face_imgs') #avatarbuild.py生成的包带模型输入
+        frames = pack.frames('full_imgs')
+        return frames,faces,pack.coords('coords'),play_schedule(len(frames),pack.mirrored)
     
-    with open(coords_path, 'rb') as f:
-        coord_list_cycle = pickle.load(f)
-    input_img_list = glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-    input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    frame_list_cycle = read_imgs(input_img_list)
+    manifest = load_manifest(avatar_path) #有清单时不扫描目录,先检查文件和坐标是否对齐
+    coord_list_cycle = avatar_coords(avatar_path,'coords',manifest)
+    input_img_list = avatar_images(avatar_path,'full_imgs',manifest)
+    if frame_cache>0:
+        frame_list_cycle = open_clip(full_imgs_path,window=min(50,frame_cache//2),capacity=frame_cache,files=input_img_list)
+    else:
+        frame_list_cycle = read_imgs(input_img_list)
     #self.imagecache = ImgCache(len(self.coord_list_cycle),self.full_imgs_path,1000)
-    input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-    input_face_list = sorted(input_face_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+    input_face_list = avatar_images(avatar_path,'face_imgs',manifest)
     face_list_cycle = read_imgs(input_face_list)
 
-    return frame_list_cycle,face_list_cycle,coord_list_cycle
+    return frame_list_cycle,face_list_cycle,coord_list_cycle,play_schedule(len(frame_list_cycle))
+
+def load_compiled_model(path,batch_size,modelres,cache_dir):
+    '''trace+freeze成TorchScript并缓存到cache_dir, 重启时直接加载编译好的模型'''
+    img_batch = torch.ones(batch_size, 6, modelres, modelres).to(device)
+    mel_batch = torch.ones(batch_size, 1, 80, 16).to(device)
+    return load_or_compile(cache_dir,path,lambda: load_model(path),(mel_batch,img_batch),device,
+                           batch_size=batch_size,modelres=modelres)
 
 @torch.no_grad()
 def warm_up(batch_size,model,modelres):
@@ -91,26 +101,12 @@ def warm_up(batch_size,model,modelres):
     print('warmup model...')
     img_batch = torch.ones(batch_size, 6, modelres, modelres).to(device)
     mel_batch = torch.ones(batch_size, 1, 80, 16).to(device)
-    model(mel_batch, img_batch)
+    #TorchScript模块(不论刚trace还是从缓存加载)在每个进程的前两次调用时做profile和优化, eager模型跑一次即可
+    passes = 2 if isinstance(model, torch.jit.ScriptModule) else 1
+    for _ in range(passes):
+        model(mel_batch, img_batch)
 
-def read_imgs(img_list):
-    frames = []
-    print('reading images...')
-    for img_path in tqdm(img_list):
-        frame = cv2.imread(img_path)
-        frames.append(frame)
-    return frames
-
-def __mirror_index(size, index):
-    #size = len(self.coord_list_cycle)
-    turn = index // size
-    res = index % size
-    if turn % 2 == 0:
-        return res
-    else:
-        return size - res - 1 
-
-def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_queue,res_frame_queue,model):
+def inference(quit_event,batch_size,face_list_cycle,schedule,audio_feat_queue,audio_out_queue,res_frame_queue,model):
     
     #model = load_model("./models/wav2lip.pth")
     # input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
@@ -118,8 +114,8 @@ def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_q
     # face_list_cycle = read_imgs(input_face_list)
     
     #input_latent_list_cycle = torch.load(latents_out_path)
-    length = len(face_list_cycle)
-    index = 0
+    period = len(schedule)
+    index = 0 #播放位置, 帧号为schedule[index]
     count=0
     counttime=0
     print('start inference')
@@ -141,22 +137,26 @@ def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_q
 
         if is_all_silence:
             for i in range(batch_size):
-                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
+                res_frame_queue.put((None,schedule[index],audio_frames[i*2:i*2+2]))
+                index = (index + 1) % period
         else:
             # print('infer=======')
             t=time.perf_counter()
-            img_batch = []
-            for i in range(batch_size):
-                idx = __mirror_index(length,index+i)
-                face = face_list_cycle[idx]
-                img_batch.append(face)
-            img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
+            idxs = schedule.window(index,batch_size)
+            if idxs[-1]-idxs[0]==batch_size-1: #连续的帧直接切片,mmap上顺序读取
+                img_batch = np.asarray(face_list_cycle[idxs[0]:idxs[-1]+1])
+            else:
+                img_batch = np.asarray([face_list_cycle[idx] for idx in idxs])
+            mel_batch = np.asarray(mel_batch)
+            face = img_batch[0]
 
-            img_masked = img_batch.copy()
-            img_masked[:, face.shape[0]//2:] = 0
+            if face.shape[2]==6: #已经是遮挡后拼接好的模型输入
+                img_batch = img_batch / 255.
+            else:
+                img_masked = img_batch.copy()
+                img_masked[:, face.shape[0]//2:] = 0
 
-            img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
+                img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
             mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
             
             img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
@@ -175,8 +175,8 @@ def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_q
                 counttime=0
             for i,res_frame in enumerate(pred):
                 #self.__pushmedia(res_frame,loop,audio_track,video_track)
-                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
+                res_frame_queue.put((res_frame,int(idxs[i]),audio_frames[i*2:i*2+2]))
+                index = (index + 1) % period
             #print('total batch time:',time.perf_counter()-starttime)            
     print('lipreal inference processor stop')
 
@@ -195,10 +195,14 @@ class LipReal(BaseReal):
         self.res_frame_queue = Queue(self.batch_size*2)  #mp.Queue
         #self.__loadavatar()
         self.model = model
-        self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle = avatar
+        self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle,self.schedule = avatar
 
-        self.asr = LipASR(opt,self)
-        self.asr.warm_up()
+        try:
+            self.asr = LipASR(opt,self)
+            self.asr.warm_up()
+        except:
+            self.close() #构造失败时调用方拿不到对象, 在这里释放已取到的自定义动作
+            raise
         
         self.render_event = mp.Event()
     
@@ -213,49 +217,58 @@ class LipReal(BaseReal):
                 res_frame,idx,audio_frames = self.res_frame_queue.get(block=True, timeout=1)
             except queue.Empty:
                 continue
+            height = self.output_height #每帧只读一次档位,中途切换从下一帧生效
             if audio_frames[0][1]!=0 and audio_frames[1][1]!=0: #全为静音数据，只需要取fullimg
                 self.speaking = False
                 audiotype = audio_frames[0][1]
+                packet = self.idle_packet(height,audiotype,idx)
                 if self.custom_index.get(audiotype) is not None: #有自定义视频
-                    mirindex = self.mirror_index(len(self.custom_img_cycle[audiotype]),self.custom_index[audiotype])
-                    combine_frame = self.custom_img_cycle[audiotype][mirindex]
+                    mirindex = self.custom_schedule[audiotype][self.custom_index[audiotype]]
+                    combine_frame = self.output_frame(height,mirindex,audiotype)
                     self.custom_index[audiotype] += 1
                     # if not self.custom_opt[audiotype].loop and self.custom_index[audiotype]>=len(self.custom_img_cycle[audiotype]):
                     #     self.curr_state = 1  #当前视频不循环播放，切换到静音状态
                 else:
-                    combine_frame = self.frame_list_cycle[idx]
+                    combine_frame = self.output_frame(height,idx)
                     #combine_frame = self.imagecache.get_img(idx)
             else:
                 self.speaking = True
+                self.reset_idle()
+                packet = None
                 bbox = self.coord_list_cycle[idx]
-                combine_frame = copy.deepcopy(self.frame_list_cycle[idx])
                 #combine_frame = copy.deepcopy(self.imagecache.get_img(idx))
                 y1, y2, x1, x2 = bbox
+                x1, y1, x2, y2 = self.scale_box(height, x1, y1, x2, y2) #在输出档位下贴图
                 try:
                     res_frame = cv2.resize(res_frame.astype(np.uint8),(x2-x1,y2-y1))
                 except:
                     continue
                 #combine_frame = get_image(ori_frame,res_frame,bbox)
                 #t=time.perf_counter()
-                combine_frame[y1:y2, x1:x2] = res_frame
+                combine_frame = self.paste_frame(height,idx,res_frame,x1,y1)
                 #print('blending time:',time.perf_counter()-t)
 
             image = combine_frame #(outputs['image'] * 255).astype(np.uint8)
-            new_frame = VideoFrame.from_ndarray(image, format="bgr24")
-            asyncio.run_coroutine_threadsafe(video_track._queue.put((new_frame,None)), loop)
+            if packet is not None: #静音帧透传共享的已编码包
+                new_frame = packet
+            else:
+                new_frame = self.video_frame(image)
+            video_track._queue.push((new_frame,None))
             self.record_video_data(image)
 
+            audio_batch = []
             for audio_frame in audio_frames:
                 frame,type,eventpoint = audio_frame
-                frame = (frame * 32767).astype(np.int16)
-                new_frame = AudioFrame(format='s16', layout='mono', samples=frame.shape[0])
-                new_frame.planes[0].update(frame.tobytes())
-                new_frame.sample_rate=16000
+                if type == 1: #静音直接发送预先生成的帧
+                    new_frame = audio_track.pool.silence
+                else:
+                    new_frame = audio_track.pool.get(frame)
                 # if audio_track._queue.qsize()>10:
                 #     time.sleep(0.1)
-                asyncio.run_coroutine_threadsafe(audio_track._queue.put((new_frame,eventpoint)), loop)
+                audio_batch.append((new_frame,eventpoint))
                 self.record_audio_data(frame)
                 #self.notify(eventpoint)
+            audio_track._queue.push_many(audio_batch)
         print('lipreal process_frames thread stop') 
             
     def render(self,quit_event,loop=None,audio_track=None,video_track=None):
@@ -267,7 +280,7 @@ class LipReal(BaseReal):
         process_thread = Thread(target=self.process_frames, args=(quit_event,loop,audio_track,video_track))
         process_thread.start()
 
-        Thread(target=inference, args=(quit_event,self.batch_size,self.face_list_cycle,
+        Thread(target=inference, args=(quit_event,self.batch_size,self.face_list_cycle,self.schedule,
                                            self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
                                            self.model,)).start()  #mp.Process
 
@@ -285,9 +298,8 @@ class LipReal(BaseReal):
             # if video_track._queue.qsize()>=2*self.opt.batch_size:
             #     print('sleep qsize=',video_track._queue.qsize())
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
-            if video_track._queue.qsize()>=5:
-                print('sleep qsize=',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
+            #等track消费腾出额度,超时说明客户端卡住,drop策略下继续生产由track丢弃旧帧
+            video_track._queue.wait_credit(timeout=video_track.buffer_ms/1000)
                 
             # delay = _starttime+_totalframe*0.04-time.perf_counter() #40ms
             # if delay > 0:
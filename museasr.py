@@ -22,6 +22,7 @@ import queue
 from queue import Queue
 #import multiprocessing as mp
 from baseasr import BaseASR
+from audioframe import pcm_to_float
 from musetalk.whisper.audio2feature import Audio2Feature
 
 class MuseASR(BaseASR):
@@ -40,7 +41,7 @@ class MuseASR(BaseASR):
         if len(self.frames) <= self.stride_left_size + self.stride_right_size:
             return
         
-        inputs = np.concatenate(self.frames) # [N * chunk]
+        inputs = pcm_to_float(np.concatenate(self.frames)) # [N * chunk]
         whisper_feature = self.audio_processor.audio2feat(inputs)
         # for feature in whisper_feature:
         #     self.audio_feats.append(feature)        
@@ -21,12 +21,9 @@ import numpy as np
 
 #from .utils import *
 import subprocess
-import os
 import time
 import torch.nn.functional as F
 import cv2
-import glob
-import pickle
 import copy
 
 import queue
@@ -41,11 +38,12 @@ from musetalk.utils.utils import load_all_model,load_diffusion_model,load_audio_
 from musetalk.whisper.audio2feature import Audio2Feature
 
 from museasr import MuseASR
-import asyncio
-from av import AudioFrame, VideoFrame
 from basereal import BaseReal
+from imgloader import read_imgs
+from framestore import open_clip
+from avatarpack import open_pack
+from avatarmanifest import load_manifest,avatar_images,avatar_coords
 
-from tqdm import tqdm
 from logger import logger
 
 def load_model():
@@ -60,16 +58,14 @@ def load_model():
     #unet.model.share_memory()
     return vae, unet, pe, timesteps, audio_processor
 
-def load_avatar(avatar_id):
+def load_avatar(avatar_id,frame_cache=0):
+    '''frame_cache>0时全身帧按需解码,内存里最多保留frame_cache帧'''
     #self.video_path = '' #video_path
     #self.bbox_shift = opt.bbox_shift
     avatar_path = f"./data/avatars/{avatar_id}"
     full_imgs_path = f"{avatar_path}/full_imgs" 
-    coords_path = f"{avatar_path}/coords.pkl"
     latents_out_path= f"{avatar_path}/latents.pt"
     video_out_path = f"{avatar_path}/vid_output/"
-    mask_out_path =f"{avatar_path}/mask"
-    mask_coords_path =f"{avatar_path}/mask_coords.pkl"
     avatar_info_path = f"{avatar_path}/avator_info.json"
     # self.avatar_info = {
     #     "avatar_id":self.avatar_id,
@@ -78,15 +74,18 @@ def load_avatar(avatar_id):
     # }
 
     input_latent_list_cycle = torch.load(latents_out_path)  #,weights_only=True
-    with open(coords_path, 'rb') as f:
-        coord_list_cycle = pickle.load(f)
-    input_img_list = glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-    input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    frame_list_cycle = read_imgs(input_img_list)
-    with open(mask_coords_path, 'rb') as f:
-        mask_coords_list_cycle = pickle.load(f)
-    input_mask_list = glob.glob(os.path.join(mask_out_path, '*.[jpJP][pnPN]*[gG]'))
-    input_mask_list = sorted(input_mask_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+    pack = open_pack(avatar_path) #有打包文件时直接mmap打开,latents仍然单独加载
+    if pack is not None:
+        return pack.frames('full_imgs'),pack.frames('mask'),pack.coords('coords'),pack.coords('mask_coords'),input_latent_list_cycle
+    manifest = load_manifest(avatar_path) #有清单时不扫描目录,先检查文件和坐标是否对齐
+    coord_list_cycle = avatar_coords(avatar_path,'coords',manifest)
+    input_img_list = avatar_images(avatar_path,'full_imgs',manifest)
+    if frame_cache>0:
+        frame_list_cycle = open_clip(full_imgs_path,window=min(50,frame_cache//2),capacity=frame_cache,files=input_img_list)
+    else:
+        frame_list_cycle = read_imgs(input_img_list)
+    mask_coords_list_cycle = avatar_coords(avatar_path,'mask_coords',manifest)
+    input_mask_list = avatar_images(avatar_path,'mask',manifest)
     mask_list_cycle = read_imgs(input_mask_list)
     return frame_list_cycle,mask_list_cycle,coord_list_cycle,mask_coords_list_cycle,input_latent_list_cycle
 
@@ -109,14 +108,6 @@ def warm_up(batch_size,model):
                               encoder_hidden_states=audio_feature_batch).sample
     vae.decode_latents(pred_latents)
 
-def read_imgs(img_list):
-    frames = []
-    logger.info('reading images...')
-    for img_path in tqdm(img_list):
-        frame = cv2.imread(img_path)
-        frames.append(frame)
-    return frames
-
 def __mirror_index(size, index):
     #size = len(self.coord_list_cycle)
     turn = index // size
@@ -273,19 +264,23 @@ class MuseReal(BaseReal):
                 res_frame,idx,audio_frames = self.res_frame_queue.get(block=True, timeout=1)
             except queue.Empty:
                 continue
+            height = self.output_height #每帧只读一次档位,中途切换从下一帧生效
             if audio_frames[0][1]!=0 and audio_frames[1][1]!=0: #全为静音数据，只需要取fullimg
                 self.speaking = False
                 audiotype = audio_frames[0][1]
+                packet = self.idle_packet(height,audiotype,idx)
                 if self.custom_index.get(audiotype) is not None: #有自定义视频
-                    mirindex = self.mirror_index(len(self.custom_img_cycle[audiotype]),self.custom_index[audiotype])
-                    combine_frame = self.custom_img_cycle[audiotype][mirindex]
+                    mirindex = self.custom_schedule[audiotype][self.custom_index[audiotype]]
+                    combine_frame = self.output_frame(height,mirindex,audiotype)
                     self.custom_index[audiotype] += 1
                     # if not self.custom_opt[audiotype].loop and self.custom_index[audiotype]>=len(self.custom_img_cycle[audiotype]):
                     #     self.curr_state = 1  #当前视频不循环播放，切换到静音状态
                 else:
-                    combine_frame = self.frame_list_cycle[idx]
+                    combine_frame = self.output_frame(height,idx)
             else:
                 self.speaking = True
+                self.reset_idle()
+                packet = None
                 bbox = self.coord_list_cycle[idx]
                 ori_frame = copy.deepcopy(self.frame_list_cycle[idx])
                 x1, y1, x2, y2 = bbox
@@ -298,26 +293,39 @@ class MuseReal(BaseReal):
                 #combine_frame = get_image(ori_frame,res_frame,bbox)
                 #t=time.perf_counter()
                 combine_frame = get_image_blending(ori_frame,res_frame,bbox,mask,mask_crop_box)
+                if self.yuv_output or height is not None: #融合只改动了mask_crop_box区域,只转换/缩放这一块
+                    x_s, y_s, x_e, y_e = mask_crop_box
+                    x_s, y_s = max(x_s,0), max(y_s,0)
+                    region = combine_frame[y_s:y_e, x_s:x_e]
+                    x_s, y_s, x_e, y_e = self.scale_box(height, x_s, y_s, x_s+region.shape[1], y_s+region.shape[0])
+                    if (x_e-x_s, y_e-y_s) != (region.shape[1], region.shape[0]):
+                        region = cv2.resize(region,(x_e-x_s,y_e-y_s))
+                    combine_frame = self.paste_frame(height,idx,region,x_s,y_s)
                 #print('blending time:',time.perf_counter()-t)
 
             image = combine_frame #(outputs['image'] * 255).astype(np.uint8)
-            new_frame = VideoFrame.from_ndarray(image, format="bgr24")
-            asyncio.run_coroutine_threadsafe(video_track._queue.put((new_frame,None)), loop)
+            if packet is not None: #静音帧透传共享的已编码包
+                new_frame = packet
+            else:
+                new_frame = self.video_frame(image)
+            video_track._queue.push((new_frame,None))
             self.record_video_data(image)
             #self.recordq_video.put(new_frame)  
 
+            audio_batch = []
             for audio_frame in audio_frames:
                 frame,type,eventpoint = audio_frame
-                frame = (frame * 32767).astype(np.int16)
-                new_frame = AudioFrame(format='s16', layout='mono', samples=frame.shape[0])
-                new_frame.planes[0].update(frame.tobytes())
-                new_frame.sample_rate=16000
+                if type == 1: #静音直接发送预先生成的帧
+                    new_frame = audio_track.pool.silence
+                else:
+                    new_frame = audio_track.pool.get(frame)
                 # if audio_track._queue.qsize()>10:
                 #     time.sleep(0.1)
-                asyncio.run_coroutine_threadsafe(audio_track._queue.put((new_frame,eventpoint)), loop)
+                audio_batch.append((new_frame,eventpoint))
                 self.record_audio_data(frame)
                 #self.notify(eventpoint)
                 #self.recordq_audio.put(new_frame)
+            audio_track._queue.push_many(audio_batch)
         logger.info('musereal process_frames thread stop') 
             
     def render(self,quit_event,loop=None,audio_track=None,video_track=None):
@@ -349,9 +357,8 @@ class MuseReal(BaseReal):
             #     print(f"------actual avg infer fps:{count/totaltime:.4f}")
             #     count=0
             #     totaltime=0
-            if video_track._queue.qsize()>=1.5*self.opt.batch_size:
-                logger.debug('sleep qsize=%d',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
+            #等track消费腾出额度,超时说明客户端卡住,drop策略下继续生产由track丢弃旧帧
+            video_track._queue.wait_credit(timeout=video_track.buffer_ms/1000)
             # if video_track._queue.qsize()>=5:
             #     print('sleep qsize=',video_track._queue.qsize())
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
@@ -25,6 +25,7 @@ from queue import Queue
 #from collections import deque
 
 from baseasr import BaseASR
+from audioframe import pcm_to_float
 
 class NerfASR(BaseASR):
     def __init__(self, opt, parent, audio_processor,audio_model):
@@ -48,7 +49,7 @@ class NerfASR(BaseASR):
 
         # pad left frames
         if self.stride_left_size > 0:
-            self.frames.extend([np.zeros(self.chunk, dtype=np.float32)] * self.stride_left_size)
+            self.frames.extend([np.zeros(self.chunk, dtype=np.int16)] * self.stride_left_size)
 
         # create wav2vec model
         # print(f'[INFO] loading ASR model {self.opt.asr_model}...')
@@ -140,7 +141,7 @@ class NerfASR(BaseASR):
         if len(self.frames) < self.stride_left_size + self.context_size + self.stride_right_size:
             return
         
-        inputs = np.concatenate(self.frames) # [N * chunk]
+        inputs = pcm_to_float(np.concatenate(self.frames)) # [N * chunk]
 
         # discard the old part to save memory
         self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
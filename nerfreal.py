@@ -28,9 +28,10 @@ import glob
 
 from nerfasr import NerfASR
 
-import asyncio
-from av import AudioFrame, VideoFrame
+from av import VideoFrame
 from basereal import BaseReal
+from imgloader import read_imgs
+from audioframe import pcm_to_float
 
 #from imgcache import ImgCache
 from ernerf.nerf_triplane.provider import NeRFDataset_Test
@@ -39,15 +40,6 @@ from ernerf.nerf_triplane.network import NeRFNetwork
 from transformers import AutoModelForCTC, AutoProcessor, Wav2Vec2Processor, HubertModel
 
 from logger import logger
-from tqdm import tqdm
-def read_imgs(img_list):
-    frames = []
-    logger.info('reading images...')
-    for img_path in tqdm(img_list):
-        frame = cv2.imread(img_path)
-        frames.append(frame)
-    return frames
-
 def load_model(opt):
     # assert test mode
     opt.test = True
@@ -243,13 +235,10 @@ class NeRFReal(BaseReal):
                 audiotype2 = type
             #print(f'[INFO] get_audio_out shape ',frame.shape)
             if self.opt.transport=='rtmp':                
-                self.streamer.stream_frame_audio(frame)
+                self.streamer.stream_frame_audio(pcm_to_float(frame))
             else: #webrtc
-                frame = (frame * 32767).astype(np.int16)
-                new_frame = AudioFrame(format='s16', layout='mono', samples=frame.shape[0])
-                new_frame.planes[0].update(frame.tobytes())
-                new_frame.sample_rate=16000
-                asyncio.run_coroutine_threadsafe(audio_track._queue.put((new_frame,eventpoint)), loop)
+                new_frame = audio_track.pool.silence if type == 1 else audio_track.pool.get(frame)
+                audio_track._queue.push((new_frame,eventpoint))
 
         # if self.opt.transport=='rtmp':
         #     for _ in range(2):
@@ -275,7 +264,7 @@ class NeRFReal(BaseReal):
             self.speaking = True
             
         if audiotype1!=0 and audiotype2!=0 and self.custom_index.get(audiotype1) is not None: #不为推理视频并且有自定义视频
-            mirindex = self.mirror_index(len(self.custom_img_cycle[audiotype1]),self.custom_index[audiotype1])
+            mirindex = self.custom_schedule[audiotype1][self.custom_index[audiotype1]]
             #imgindex  = self.mirror_index(self.customimg_index)
             #print('custom img index:',imgindex)
             #image = cv2.imread(os.path.join(self.opt.customvideo_img, str(int(imgindex))+'.png'))
@@ -286,7 +275,7 @@ class NeRFReal(BaseReal):
                 self.streamer.stream_frame(image)
             else:
                 new_frame = VideoFrame.from_ndarray(image, format="rgb24")
-                asyncio.run_coroutine_threadsafe(video_track._queue.put((new_frame,None)), loop)
+                video_track._queue.push((new_frame,None))
         else: #推理视频+贴回
             outputs = self.trainer.test_gui_with_data(data, self.W, self.H)
             #print('-------ernerf time: ',time.time()-t)
@@ -297,7 +286,7 @@ class NeRFReal(BaseReal):
                     self.streamer.stream_frame(image)
                 else:
                     new_frame = VideoFrame.from_ndarray(image, format="rgb24")
-                    asyncio.run_coroutine_threadsafe(video_track._queue.put((new_frame,None)), loop)
+                    video_track._queue.push((new_frame,None))
             else: #fullbody human
                 #print("frame index:",data['index'])
                 #image_fullbody = cv2.imread(os.path.join(self.opt.fullbody_img, str(data['index'][0])+'.jpg'))
@@ -311,7 +300,7 @@ class NeRFReal(BaseReal):
                     self.streamer.stream_frame(image_fullbody)
                 else:
                     new_frame = VideoFrame.from_ndarray(image_fullbody, format="rgb24")
-                    asyncio.run_coroutine_threadsafe(video_track._queue.put((new_frame,None)), loop)
+                    video_track._queue.push((new_frame,None))
             #self.pipe.stdin.write(image.tostring())        
        
         #ender.record()
@@ -374,9 +363,8 @@ class NeRFReal(BaseReal):
                 if delay > 0:
                     time.sleep(delay)
             else:
-                if video_track._queue.qsize()>=5:
-                    #print('sleep qsize=',video_track._queue.qsize())
-                    time.sleep(0.04*video_track._queue.qsize()*0.8)
+                #等track消费腾出额度,超时说明客户端卡住,drop策略下继续生产由track丢弃旧帧
+                video_track._queue.wait_credit(timeout=video_track.buffer_ms/1000)
         logger.info('nerfreal thread stop')
             
             
\ No newline at end of file
@@ -0,0 +1,139 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 每个会话的输出分辨率档位, 背景帧按档位缩放一次后所有会话共享
+
+import asyncio
+import threading
+
+import cv2
+
+from logger import logger
+
+PROFILES = {
+    '1080p': 1080,
+    '720p': 720,
+    '480p': 480,
+    '360p': 360,
+}
+LADDER = ['native', '1080p', '720p', '480p', '360p']
+
+def profile_height(name):
+    """native或未知档位返回None, 表示不缩放"""
+    return PROFILES.get(name)
+
+
+class ScaledCycle:
+    """按目标高度缩放的帧序列, 第一次访问某帧时缩放"""
+
+    def __init__(self, frames, height):
+        h, w = frames[0].shape[:2]
+        self.frames = frames
+        self.height = height - height % 2
+        self.width = max(2, int(round(w * height / h / 2)) * 2)
+        self.scale_x = self.width / w
+        self.scale_y = self.height / h
+        self._scaled = [None] * len(frames)
+        self.streaming = getattr(frames, 'streaming', False) #按需解码的帧序列不缓存缩放结果
+
+    def __len__(self):
+        return len(self._scaled)
+
+    def __getitem__(self, idx):
+        frame = self._scaled[idx]
+        if frame is None:
+            frame = cv2.resize(self.frames[idx], (self.width, self.height), interpolation=cv2.INTER_AREA)
+            if not self.streaming:
+                self._scaled[idx] = frame
+        return frame
+
+
+class ScaledCycleCache:
+    """进程级缓存, key为帧序列的key加上目标高度"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cycles = {}
+
+    def get(self, key, frames, height):
+        if height is None or len(frames) == 0 or height >= frames[0].shape[0]:
+            return frames  # 不放大
+        cycle = self._cycles.get(key)
+        if cycle is None:
+            with self._lock:
+                cycle = self._cycles.get(key)
+                if cycle is None:
+                    cycle = ScaledCycle(frames, height)
+                    self._cycles[key] = cycle
+        return cycle
+
+    def discard(self, key):
+        with self._lock:
+            for k in [k for k in self._cycles if k[:len(key)] == key]:
+                del self._cycles[k]
+
+scaled_cache = ScaledCycleCache()
+
+
+class ProfileAdapter:
+    """
+    根据RTCP接收端报告的丢包率调整会话的输出档位
+    丢包高时降一档, 连续几次丢包很低时升一档, 不超过offer时请求的档位
+    """
+
+    def __init__(self, nerfreal, sender, max_profile='native', interval=5,
+                 down_loss=0.08, up_loss=0.01, up_after=3):
+        self.nerfreal = nerfreal
+        self.sender = sender
+        self.top = LADDER.index(max_profile) if max_profile in LADDER else 0
+        self.interval = interval
+        self.down_loss = down_loss
+        self.up_loss = up_loss
+        self.up_after = up_after
+        self._good = 0
+
+    def _fraction_lost(self, report):
+        for stats in report.values():
+            if getattr(stats, 'type', None) == 'remote-inbound-rtp' and getattr(stats, 'kind', None) == 'video':
+                return stats.fractionLost / 256 #aiortc给的是RTCP报告里的8位原始值(0-255)
+        return None
+
+    async def run(self):
+        while self.sender.track is not None and self.sender.track.readyState == 'live':
+            await asyncio.sleep(self.interval)
+            try:
+                lost = self._fraction_lost(await self.sender.getStats())
+            except Exception:
+                logger.exception('profile adapter')
+                continue
+            if lost is None:
+                continue
+            cur = LADDER.index(self.nerfreal.output_profile) if self.nerfreal.output_profile in LADDER else self.top
+            if lost > self.down_loss and cur < len(LADDER) - 1:
+                self._good = 0
+                self.set(LADDER[cur + 1], lost)
+            elif lost < self.up_loss and cur > self.top:
+                self._good += 1
+                if self._good >= self.up_after:
+                    self._good = 0
+                    self.set(LADDER[cur - 1], lost)
+            else:
+                self._good = 0
+
+    def set(self, profile, lost):
+        logger.info('session %s fraction lost %.3f, switch output profile to %s', self.nerfreal.sessionid, lost, profile)
+        self.nerfreal.set_output_profile(profile)
@@ -0,0 +1,357 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 进程内录制, 渲染线程只把帧放进有界队列, 独立的写线程用PyAV编码并封装音视频
+# 队列满时丢帧, 录制不会阻塞推流
+
+import io
+import os
+import time
+import queue
+import struct
+import collections
+from threading import Thread
+from fractions import Fraction
+
+import av
+from av import AudioFrame, VideoFrame
+from aiortc.codecs.h264 import H264Encoder, H264PayloadDescriptor
+from aiortc.codecs.opus import OpusEncoder
+
+from logger import logger
+
+class Recorder:
+    """
+    一个会话的录制, 输出到 directory/<开始时间>_<段号>.mp4
+    segment_time>0时按视频时长切段, keep>0时只保留最近keep段
+    """
+
+    def __init__(self, directory, fps=25, sample_rate=16000, segment_time=0, keep=0, maxsize=250):
+        self.directory = directory
+        self.fps = fps
+        self.sample_rate = sample_rate
+        self.segment_frames = int(segment_time * fps)
+        self.keep = keep
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._prefix = time.strftime('%Y%m%d-%H%M%S')
+        self.files = []
+        # pts在放入队列时分配, 丢帧不会造成音画错位
+        self._vpts = 0
+        self._apts = 0
+        self.dropped = 0
+
+        self._container = None
+        self._vstream = None
+        self._astream = None
+        self._seg_start = 0
+        self._anext = 0
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = Thread(target=self._run, daemon=True, name='recorder')
+        self._thread.start()
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def put_video(self, image):
+        """bgr24 (h,w,3) 或 I420 (h*3/2,w)"""
+        self._put(('video', image, self._vpts))
+        self._vpts += 1
+
+    def put_audio(self, pcm):
+        """16khz int16 pcm"""
+        self._put(('audio', pcm, self._apts))
+        self._apts += pcm.shape[0]
+
+    def stop(self):
+        """等写线程把队列里的帧写完, 返回录制的文件列表"""
+        if self._thread is None:
+            return self.files
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        if self.dropped:
+            logger.warning('recorder %s dropped %d frames', self.directory, self.dropped)
+        return self.files
+
+    def _open(self, image, pts):
+        path = os.path.join(self.directory, f'{self._prefix}_{len(self.files):03d}.mp4')
+        self._container = av.open(path, mode='w')
+        height, width = image.shape[:2]
+        if image.ndim == 2: #I420
+            height = height * 2 // 3
+        self._vstream = self._container.add_stream('libx264', rate=self.fps)
+        self._vstream.width = width
+        self._vstream.height = height
+        self._vstream.pix_fmt = 'yuv420p'
+        self._vstream.codec_context.time_base = Fraction(1, self.fps)
+        self._vstream.options = {'preset': 'veryfast'}
+        self._astream = self._container.add_stream('aac', rate=self.sample_rate)
+        self._astream.codec_context.time_base = Fraction(1, self.sample_rate)
+        self._seg_start = pts
+        self._anext = 0
+        self.files.append(path)
+        logger.info('recording to %s', path)
+        if self.keep > 0 and len(self.files) > self.keep:
+            old = self.files.pop(0)
+            try:
+                os.remove(old)
+            except OSError:
+                logger.exception('remove old record segment')
+
+    def _close(self):
+        if self._container is None:
+            return
+        for packet in self._vstream.encode(None):
+            self._container.mux(packet)
+        for packet in self._astream.encode(None):
+            self._container.mux(packet)
+        self._container.close()
+        self._container = None
+
+    def _write_video(self, image, pts):
+        if self._container is not None and self.segment_frames > 0 and pts - self._seg_start >= self.segment_frames:
+            self._close()
+        if self._container is None:
+            self._open(image, pts)
+        if image.ndim == 2:
+            frame = VideoFrame.from_ndarray(image, format='yuv420p')
+        else:
+            frame = VideoFrame.from_ndarray(image, format='bgr24')
+        frame.pts = pts - self._seg_start
+        frame.time_base = Fraction(1, self.fps)
+        for packet in self._vstream.encode(frame):
+            self._container.mux(packet)
+
+    def _write_audio(self, pcm, pts):
+        if self._container is None:
+            return # 段以视频帧开始
+        pts -= self._seg_start * self.sample_rate // self.fps
+        if pts < self._anext:
+            return
+        if pts > self._anext: # 丢过帧, 补静音保持编码器输入的pts连续
+            self._encode_audio(bytes((pts - self._anext) * 2), pts - self._anext)
+        self._encode_audio(pcm.tobytes(), pcm.shape[0])
+
+    def _encode_audio(self, data, samples):
+        frame = AudioFrame(format='s16', layout='mono', samples=samples)
+        frame.planes[0].update(data)
+        frame.sample_rate = self.sample_rate
+        frame.pts = self._anext
+        frame.time_base = Fraction(1, self.sample_rate)
+        self._anext += samples
+        for packet in self._astream.encode(frame):
+            self._container.mux(packet)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            kind, data, pts = item
+            try:
+                if kind == 'video':
+                    self._write_video(data, pts)
+                else:
+                    self._write_audio(data, pts)
+            except Exception:
+                logger.exception('recorder')
+        try:
+            self._close()
+        except Exception:
+            logger.exception('recorder close')
+        logger.info('recorder %s stop', self.directory)
+
+
+OPUS_HEAD = struct.pack('<8sBBHIhB', b'OpusHead', 1, 2, 312, 48000, 0, 0) # aiortc的Opus: 48k双声道
+
+def add_template_stream(container, template):
+    """按已有的流(编码参数和extradata)添加输出流, 不打开编码器"""
+    add = getattr(container, 'add_stream_from_template', None) # PyAV>=13
+    if add is not None:
+        return add(template)
+    return container.add_stream(template=template)
+
+def check_recording(path, frames=50):
+    """
+    重新打开录制的文件解码前frames个视频帧和音频帧, 再seek到中间解码一帧
+    返回(视频帧数, 音频帧数), 文件不能播放或不能seek时抛出av的异常
+    """
+    with av.open(path) as container:
+        video = sum(1 for _, _ in zip(range(frames), container.decode(video=0)))
+    with av.open(path) as container:
+        audio = sum(1 for _, _ in zip(range(frames), container.decode(audio=0))) if container.streams.audio else 0
+        if container.duration:
+            container.seek(container.duration // 2)
+            next(container.decode(video=0))
+    return video, audio
+
+
+class PacketRecorder(Recorder):
+    """
+    WebRTC和录制共用一次编码: 包装视频/音频轨道的recv, 用和RTCRtpSender相同的aiortc编码器编码,
+    同一个包交给sender(收到Packet只做RTP打包)并封装进mkv; 待机透传的已编码包直接写入
+    从第一个关键帧开始写, 切段也在关键帧处; 只支持协商到H264的视频
+    录制期间sender自己的编码器不工作, 码率固定为aiortc的默认值, 每gop帧一个关键帧代替接收端的PLI
+    """
+
+    VIDEO_RATE = 90000
+    AUDIO_RATE = 48000
+
+    def __init__(self, directory, tracks, fps=25, segment_time=0, keep=0, maxsize=500, gop=50):
+        super().__init__(directory, fps=fps, segment_time=segment_time, keep=keep, maxsize=maxsize)
+        self.tracks = tracks
+        self.gop = gop
+        self._untaps = []
+        self._h264 = H264Encoder()
+        self._opus = OpusEncoder()
+        self._force = True   # 下一帧编码成关键帧
+        self._since_key = 0
+        self._size = None    # 最近一帧的分辨率, 透传包沿用
+        self._pending = collections.deque() # 已编码还没交给sender的opus包
+        self._vsize = None   # 当前段的分辨率
+        self.checked = {}    # 文件 -> check_recording的结果
+
+    def start(self):
+        super().start()
+        self._untaps = [self.tracks['video'].tap(self._tap_video), self.tracks['audio'].tap(self._tap_audio)]
+
+    def stop(self):
+        for untap in self._untaps:
+            untap()
+        self._untaps = []
+        return super().stop()
+
+    def put_video(self, image):
+        pass # 帧从轨道取
+
+    def put_audio(self, pcm):
+        pass
+
+    def _tap_video(self, data):
+        """在线程池里执行, 返回交给sender的Packet, None表示这一帧没有输出"""
+        t = float(data.pts * data.time_base)
+        if isinstance(data, av.Packet): # 待机透传的包
+            self._force = True # 回到正常编码时从关键帧开始
+            annexb = bytes(data)
+            self._put(('video', (annexb, has_idr(annexb), self._size), t))
+            return data
+        self._size = (data.width, data.height)
+        payloads, _ = self._h264.encode(data, self._force or self._since_key + 1 >= self.gop)
+        annexb = b''.join(H264PayloadDescriptor.parse(payload)[1] for payload in payloads)
+        if not annexb:
+            return None
+        keyframe = has_idr(annexb)
+        if keyframe:
+            self._force = False
+            self._since_key = 0
+        else:
+            self._since_key += 1
+        self._put(('video', (annexb, keyframe, self._size), t))
+        packet = av.Packet(annexb)
+        packet.pts = data.pts
+        packet.time_base = data.time_base
+        return packet
+
+    def _tap_audio(self, frame):
+        t = float(frame.pts * frame.time_base)
+        payloads, _ = self._opus.encode(frame)
+        for i, payload in enumerate(payloads): # 每个包20ms
+            self._put(('audio', payload, t + i * 0.02))
+            self._pending.append((payload, t + i * 0.02))
+        if not self._pending:
+            return None # 重采样缓冲, 还没有输出
+        payload, t = self._pending.popleft()
+        packet = av.Packet(payload)
+        packet.pts = int(round(t * self.AUDIO_RATE))
+        packet.time_base = Fraction(1, self.AUDIO_RATE)
+        return packet
+
+    def _open(self, keyframe, t):
+        # 视频流的参数和extradata(SPS/PPS)从第一个关键帧解析, 音频流写OpusHead
+        path = os.path.join(self.directory, f'{self._prefix}_{len(self.files):03d}.mkv')
+        with av.open(io.BytesIO(keyframe), format='h264') as probe:
+            self._container = av.open(path, mode='w')
+            self._vstream = add_template_stream(self._container, probe.streams.video[0])
+        self._vstream.time_base = Fraction(1, self.VIDEO_RATE)
+        self._astream = self._container.add_stream('libopus', rate=self.AUDIO_RATE)
+        self._astream.layout = 'stereo'
+        self._astream.time_base = Fraction(1, self.AUDIO_RATE)
+        self._astream.codec_context.extradata = OPUS_HEAD
+        self._seg_start = t
+        self.files.append(path)
+        logger.info('recording encoded packets to %s', path)
+        if self.keep > 0 and len(self.files) > self.keep:
+            old = self.files.pop(0)
+            self.checked.pop(old, None)
+            try:
+                os.remove(old)
+            except OSError:
+                logger.exception('remove old record segment')
+
+    def _close(self):
+        if self._container is None:
+            return
+        self._container.close()
+        self._container = None
+        path = self.files[-1]
+        try:
+            self.checked[path] = check_recording(path)
+        except Exception:
+            logger.exception('record segment %s is not decodable', path)
+            self.checked[path] = None
+
+    def _mux(self, stream, data, t, rate, keyframe=True):
+        packet = av.Packet(data)
+        packet.stream = stream
+        packet.time_base = Fraction(1, rate)
+        packet.pts = packet.dts = int(round((t - self._seg_start) * rate))
+        packet.is_keyframe = keyframe # mkv按关键帧写索引, 没有的话文件不能seek
+        self._container.mux(packet)
+
+    def _write_video(self, item, t):
+        data, keyframe, size = item
+        resized = size is not None and self._vsize is not None and size != self._vsize
+        if self._container is not None and keyframe and (resized or self.segment_frames > 0
+                and t - self._seg_start >= self.segment_frames / self.fps):
+            self._close() # 到切段时间或者输出档位变了
+        if self._container is None:
+            if not keyframe:
+                return # 等关键帧
+            self._open(data, t)
+        if size is not None:
+            self._vsize = size
+        self._mux(self._vstream, data, t, self.VIDEO_RATE, keyframe)
+
+    def _write_audio(self, payload, t):
+        if self._container is None or t < self._seg_start:
+            return
+        self._mux(self._astream, payload, t, self.AUDIO_RATE)
+
+def has_idr(annexb):
+    """Annex-B数据里是否有IDR(nal type 5)"""
+    pos = annexb.find(b'\x00\x00\x01')
+    while pos >= 0:
+        if pos + 3 < len(annexb) and annexb[pos+3] & 0x1f == 5:
+            return True
+        pos = annexb.find(b'\x00\x00\x01', pos + 3)
+    return False
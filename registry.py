@@ -0,0 +1,92 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 进程级资源注册表: avatar和自定义动作视频/音频只加载一次, 所有会话共享只读数据
+# 按引用计数管理, 最后一个会话释放后卸载
+
+import time
+import threading
+
+from logger import logger
+
+class _Entry:
+    __slots__ = ('value', 'refs', 'ready', 'error')
+
+    def __init__(self):
+        self.value = None
+        self.refs = 0
+        self.ready = threading.Event()
+        self.error = None
+
+
+class Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def acquire(self, key, loader):
+        """
+        返回key对应的资源, 没有时调用loader()加载, 同一个key并发请求只加载一次
+        每次acquire都要对应一次release
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = _Entry()
+                self._entries[key] = entry
+            entry.refs += 1
+        if owner:
+            t = time.perf_counter()
+            try:
+                entry.value = loader()
+                logger.info('registry load %s in %.2fs', key, time.perf_counter() - t)
+            except Exception as e:
+                entry.error = e
+                with self._lock:
+                    self._entries.pop(key, None)
+                raise
+            finally:
+                entry.ready.set()
+        else:
+            entry.ready.wait()
+            if entry.error is not None:
+                raise entry.error
+        return entry.value
+
+    def release(self, key):
+        """引用计数减一, 资源被卸载时返回True"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            entry.refs -= 1
+            if entry.refs > 0:
+                return False
+            del self._entries[key]
+        close = getattr(entry.value, 'close', None)
+        if close is not None:
+            close()
+        logger.info('registry unload %s', key)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {str(key): entry.refs for key, entry in self._entries.items()}
+
+registry = Registry()
@@ -0,0 +1,115 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 有状态的多相FIR重采样, 纯numpy, 代替resampy
+# 采样率比化成L/M(44100->16000是160/441), kaiser窗sinc滤波器按相位拆成L组, 每个输出点只算一组
+# 按块输入时保留滤波器历史和输出相位, 分块处理的结果和整段一次处理一致, 块边界没有断点
+# 滤波器参数接近resampy的kaiser_fast, 每对采样率只设计一次
+
+import math
+import functools
+
+import numpy as np
+
+ZEROS = 16       # 滤波器单边过零点数
+ROLLOFF = 0.85   # 截止频率占新旧采样率较低一方奈奎斯特频率的比例
+BETA = 8.555     # kaiser窗参数
+
+@functools.lru_cache(maxsize=16)
+def polyphase_filter(up, down, zeros=ZEROS, rolloff=ROLLOFF, beta=BETA):
+    '''
+    返回(L,K)的多相滤波器和中心位置, 第p行是相位p的K个抽头(已反序, 直接和输入窗口做点积)
+    滤波器在L倍上采样的速率下设计, 中心对齐, 重采样没有延迟
+    '''
+    cutoff = rolloff / max(up, down)            # 相对上采样后的奈奎斯特频率
+    half = int(math.ceil(zeros * max(1, down / up))) # 单边覆盖的输入采样数
+    taps = 2 * half + 1
+    center = half * up
+    n = np.arange(taps * up) - center
+    window = np.zeros(taps * up)
+    window[:2 * center + 1] = np.kaiser(2 * center + 1, beta)
+    h = cutoff * np.sinc(cutoff * n) * window * up
+    # h[p + k*up]是相位p的第k个抽头, 作用在输入x[i-k]上
+    bank = h.reshape(taps, up).T[:, ::-1]
+    return np.ascontiguousarray(bank, dtype=np.float32), center
+
+
+class StreamResampler:
+    '''
+    按块重采样float32单声道音频, 每条语音创建一个
+        r = StreamResampler(24000, 16000)
+        out = [r.process(chunk) for chunk in chunks] + [r.flush()]
+    '''
+
+    def __init__(self, sr_orig, sr_new):
+        self.sr_orig = sr_orig
+        self.sr_new = sr_new
+        g = math.gcd(int(sr_orig), int(sr_new))
+        self.up = int(sr_new) // g
+        self.down = int(sr_orig) // g
+        self.passthrough = self.up == self.down
+        if not self.passthrough:
+            self.bank, self.center = polyphase_filter(self.up, self.down)
+            self.taps = self.bank.shape[1]
+            self._buf = np.zeros(self.taps - 1, dtype=np.float32) # 历史, 开头补零
+            self._offset = -(self.taps - 1) # _buf[0]对应的输入位置
+        self._n = 0      # 下一个输出点
+        self._total = 0  # 已输入的采样数
+
+    def _run(self, x, limit=None):
+        buf = np.concatenate((self._buf, x)) if len(x) else self._buf
+        end = self._offset + len(buf)
+        # 输出点n需要输入到 (n*down+center)//up 为止
+        stop = (end * self.up - self.center - 1) // self.down + 1
+        if limit is not None:
+            stop = min(stop, limit)
+        if stop > self._n:
+            m = np.arange(self._n, stop, dtype=np.int64) * self.down + self.center
+            first = m // self.up - (self.taps - 1) - self._offset
+            windows = np.lib.stride_tricks.sliding_window_view(buf, self.taps)
+            y = np.einsum('ij,ij->i', windows[first], self.bank[m % self.up])
+            self._n = stop
+        else:
+            y = np.zeros(0, dtype=np.float32)
+        keep = self.taps - 1
+        self._buf = buf[len(buf) - keep:].copy()
+        self._offset = end - keep
+        return y.astype(np.float32, copy=False)
+
+    def process(self, x):
+        x = np.asarray(x, dtype=np.float32).reshape(-1)
+        self._total += len(x)
+        if self.passthrough:
+            return x
+        return self._run(x)
+
+    def flush(self):
+        '''输入结束, 补零输出剩下的点, 总输出长度为ceil(输入长度*up/down)'''
+        if self.passthrough:
+            return np.zeros(0, dtype=np.float32)
+        total = -(-self._total * self.up // self.down)
+        pad = np.zeros(self.center // self.up + 1, dtype=np.float32)
+        return self._run(pad, limit=total)
+
+
+def resample(x, sr_orig, sr_new):
+    '''整段重采样'''
+    if sr_orig == sr_new:
+        return np.asarray(x, dtype=np.float32)
+    r = StreamResampler(sr_orig, sr_new)
+    y = r.process(x)
+    return np.concatenate((y, r.flush()))
@@ -0,0 +1,191 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 合成语音缓存, 进程内所有会话共享: 内存LRU(按字节) + 磁盘(.npy, 按字节淘汰最久没用的)
+# 缓存的是重采样后的16k int16 pcm, key由后端, 音色, 参考音频和归一化后的文本决定
+# 开关和内存大小读local_tts_config.json的performance_settings(enable_cache, cache_size单位MB), --tts_cache_mb大于0时覆盖cache_size
+
+import os
+import json
+import glob
+import hashlib
+import threading
+import collections
+import unicodedata
+
+import numpy as np
+
+from logger import logger
+
+CONFIG_FILE = 'local_tts_config.json'
+
+def normalize_text(text):
+    """全半角统一, 合并空白"""
+    return ' '.join(unicodedata.normalize('NFKC', text).split())
+
+def cache_key(**parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def file_stamp(path):
+    """参考音频的(路径,大小,修改时间), 文件换了缓存自动失效"""
+    if not path or not os.path.isfile(path):
+        return path
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, int(stat.st_mtime)]
+
+
+class TTSCache:
+
+    def __init__(self, max_bytes, directory='', max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+        self._mem = collections.OrderedDict()   # key -> pcm
+        self._mem_bytes = 0
+        self._disk = collections.OrderedDict()  # key -> 文件大小, 最久没用的在前面
+        self._disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            files = sorted(glob.glob(os.path.join(directory, '*.npy')), key=os.path.getmtime)
+            for path in files:
+                size = os.path.getsize(path)
+                self._disk[os.path.splitext(os.path.basename(path))[0]] = size
+                self._disk_bytes += size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        with self._lock:
+            pcm = self._mem.get(key)
+            if pcm is not None:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                self.bytes_saved += pcm.nbytes
+                return pcm
+            on_disk = key in self._disk
+        if on_disk:
+            try:
+                pcm = np.load(self._path(key))
+                os.utime(self._path(key))
+            except OSError:
+                logger.warning('tts cache file %s is gone', self._path(key))
+                pcm = None
+            with self._lock:
+                if pcm is None:
+                    self._disk_bytes -= self._disk.pop(key, 0)
+                else:
+                    if key in self._disk:
+                        self._disk.move_to_end(key)
+                    self.disk_hits += 1
+                    self.bytes_saved += pcm.nbytes
+                    self._remember(key, pcm)
+                    return pcm
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, key, pcm):
+        if pcm.nbytes > self.max_bytes:
+            return
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._mem_bytes -= old.nbytes
+        self._mem[key] = pcm
+        self._mem_bytes += pcm.nbytes
+        while self._mem_bytes > self.max_bytes:
+            _, old = self._mem.popitem(last=False)
+            self._mem_bytes -= old.nbytes
+
+    def put(self, key, pcm):
+        pcm = np.ascontiguousarray(pcm, dtype=np.int16)
+        pcm.flags.writeable = False # 所有会话共享
+        with self._lock:
+            self._remember(key, pcm)
+            if not self.directory or key in self._disk:
+                return
+        path = self._path(key)
+        tmp = path + '.tmp.npy'
+        try:
+            np.save(tmp, pcm)
+            os.replace(tmp, path)
+        except OSError:
+            logger.exception('tts cache write')
+            return
+        victims = []
+        with self._lock:
+            self._disk[key] = os.path.getsize(path)
+            self._disk_bytes += self._disk[key]
+            while self.max_disk_bytes > 0 and self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+                old, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                victims.append(old)
+        for old in victims:
+            try:
+                os.remove(self._path(old))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.hits + self.disk_hits) / lookups, 3) if lookups else 0,
+                'bytes_saved': self.bytes_saved,
+                'seconds_saved': round(self.bytes_saved / 2 / 16000, 1),
+                'memory': {'entries': len(self._mem), 'bytes': self._mem_bytes, 'max_bytes': self.max_bytes},
+                'disk': {'entries': len(self._disk), 'bytes': self._disk_bytes, 'max_bytes': self.max_disk_bytes,
+                         'directory': self.directory},
+            }
+
+
+def performance_settings(config_file=CONFIG_FILE):
+    try:
+        with open(config_file, encoding='utf-8') as f:
+            return json.load(f).get('tts_settings', {}).get('performance_settings', {})
+    except (OSError, ValueError):
+        return {}
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache(opt):
+    """进程级的缓存, 第一次调用时按配置创建, 关闭时返回None"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            settings = performance_settings()
+            if not settings.get('enable_cache', False):
+                _cache = False
+            else:
+                mb = getattr(opt, 'tts_cache_mb', 0) or settings.get('cache_size', 100)
+                directory = getattr(opt, 'tts_cache_dir', '')
+                disk_mb = getattr(opt, 'tts_cache_disk_mb', 0)
+                _cache = TTSCache(mb * 1024 * 1024, directory, disk_mb * 1024 * 1024)
+                logger.info('tts cache: memory %dMB, disk %s %dMB', mb, directory or '-', disk_mb)
+        return _cache or None
+
+def cache_stats():
+    return _cache.stats() if _cache else {'enabled': False}
@@ -18,9 +18,7 @@ from __future__ import annotations
 import time
 import numpy as np
 import soundfile as sf
-import resampy
 import asyncio
-import edge_tts
 
 import os
 import hmac
@@ -31,11 +29,12 @@ import uuid
 
 from typing import Iterator
 
-import requests
 
 import queue
 from queue import Queue
 from io import BytesIO
+import threading
+import collections
 from threading import Thread, Event
 from enum import Enum
 
@@ -44,11 +43,63 @@ if TYPE_CHECKING:
     from basereal import BaseReal
 
 from logger import logger
+from audioframe import float_to_pcm,pcm_to_float,StreamDecoder,FrameSplitter
+from resampler import StreamResampler,resample
+from ttscache import get_cache,cache_key,normalize_text,file_stamp
+
+# 第三方依赖在用到的后端里才导入, BACKEND_MODULES供启动时预先导入并统计耗时
+BACKENDS = {
+    'edgetts': 'EdgeTTS',
+    'local_edgetts': 'LocalEdgeTTS',
+    'gpt-sovits': 'VoitsTTS',
+    'xtts': 'XTTS',
+    'cosyvoice': 'CosyVoiceTTS',
+    'fishtts': 'FishTTS',
+}
+BACKEND_MODULES = {
+    'edgetts': ('edge_tts',),
+    'local_edgetts': ('edge_tts','local_edge_tts'),
+    'gpt-sovits': ('requests',),
+    'xtts': ('requests',),
+    'cosyvoice': ('requests',),
+    'fishtts': ('requests',),
+}
+
+def create_tts(opt, parent):
+    '''按opt.tts创建后端, 未知的后端返回None'''
+    name = BACKENDS.get(opt.tts)
+    if name is None:
+        return None
+    return globals()[name](opt, parent)
+
+def pcm16_chunks(audio_stream, sample_rate):
+    '''网络块里的16bit pcm转成(float32, 采样率), 块末尾多出的奇数字节留给下一块'''
+    rest = b''
+    for chunk in audio_stream:
+        if not chunk:
+            continue
+        data = rest + chunk
+        even = len(data) & ~1
+        rest = data[even:]
+        if even:
+            yield pcm_to_float(np.frombuffer(data[:even], dtype=np.int16)), sample_rate
+
 class State(Enum):
     RUNNING=0
     PAUSE=1
 
+class SpeechJob:
+    '''一条消息的合成任务: 合成线程把帧放进frames, 播放线程按消息顺序取出, 结束时放入None'''
+    def __init__(self,msg):
+        self.msg = msg
+        self.frames = Queue()
+        self.cancelled = False
+        self.recording = None #完整合成后写入缓存的帧
+        self.ended = False
+
 class BaseTTS:
+    workers = None #后端不能并发合成时设为1
+
     def __init__(self, opt, parent:BaseReal):
         self.opt=opt
         self.parent = parent
@@ -56,12 +107,33 @@ class BaseTTS:
         self.fps = opt.fps # 20 ms per frame
         self.sample_rate = 16000
         self.chunk = self.sample_rate // self.fps # 320 samples per chunk (20ms * 16000 / 1000)
-        self.input_stream = BytesIO()
 
         self.msgqueue = Queue()
-        self.state = State.RUNNING
+        self._state = State.RUNNING
         self._completion_callbacks = []  # 新增: 回调队列
 
+        self.cache = get_cache(opt) #进程共享的合成结果缓存, 关闭时为None
+
+        #播放当前消息时, 后面最多lookahead条消息同时在合成, 按顺序播放
+        self.lookahead = max(0, getattr(opt,'tts_lookahead',1))
+        self._jobs = Queue() #等待合成
+        self._playing = collections.deque() #当前消息 + 提前合成的消息
+        self._lock = threading.Lock()
+        self._generation = 0 #flush_talk一次加一, 消息入队时记下
+        self._local = threading.local() #合成线程当前的任务和事件循环
+
+    @property
+    def state(self):
+        '''合成线程里看的是当前任务有没有被打断'''
+        job = getattr(self._local,'job',None)
+        if job is not None:
+            return State.PAUSE if job.cancelled else State.RUNNING
+        return self._state
+
+    @state.setter
+    def state(self,value):
+        self._state = value
+
     def add_completion_callback(self, callback):
         self._completion_callbacks.append(callback)
 
@@ -74,99 +146,264 @@ class BaseTTS:
         self._completion_callbacks.clear()
 
     def flush_talk(self):
-        self.msgqueue.queue.clear()
-        self.state = State.PAUSE
+        with self._lock:
+            self._generation += 1 #已经从msgqueue取出但还没提交的消息也作废
+            self.msgqueue.queue.clear()
+            self.state = State.PAUSE
+            for job in self._playing:
+                job.cancelled = True
+            self._playing.clear()
 
     def put_msg_txt(self,msg:str,eventpoint=None): 
         if len(msg)>0:
-            self.msgqueue.put((msg,eventpoint))
+            with self._lock:
+                self.msgqueue.put((self._generation,(msg,eventpoint)))
 
     def render(self,quit_event):
+        workers = self.lookahead+1 if self.workers is None else self.workers
+        for _ in range(workers):
+            Thread(target=self.synthesize, args=(quit_event,)).start()
         process_thread = Thread(target=self.process_tts, args=(quit_event,))
         process_thread.start()
-    
-    def process_tts(self,quit_event):        
-        while not quit_event.is_set():
+
+    def _submit(self):
+        '''从msgqueue取消息交给合成线程, 直到当前消息加lookahead条'''
+        while True:
+            with self._lock:
+                if len(self._playing) > self.lookahead:
+                    return
+                idle = not self._playing
             try:
-                msg = self.msgqueue.get(block=True, timeout=1)
+                generation,msg = self.msgqueue.get(block=idle, timeout=1)
+            except queue.Empty:
+                return
+            job = SpeechJob(msg)
+            with self._lock:
+                if generation!=self._generation: #取出后被flush_talk打断了
+                    continue
                 self.state=State.RUNNING
+                self._playing.append(job)
+            self._jobs.put(job)
+
+    def process_tts(self,quit_event):
+        '''按消息顺序把合成好的帧交给parent'''
+        while not quit_event.is_set():
+            self._submit()
+            with self._lock:
+                job = self._playing[0] if self._playing else None
+            if job is None:
+                continue
+            try:
+                item = job.frames.get(timeout=0.05)
             except queue.Empty:
                 continue
-            self.txt_to_audio(msg)
-            self._run_completion_callbacks()  # 新增: 每次朗读完毕后调用回调
+            if job.cancelled:
+                continue
+            if item is None:
+                with self._lock:
+                    if self._playing and self._playing[0] is job:
+                        self._playing.popleft()
+                self._run_completion_callbacks()  # 新增: 每次朗读完毕后调用回调
+                continue
+            self.parent.put_audio_frame(*item)
         logger.info('ttsreal thread stop')
+
+    def synthesize(self,quit_event):
+        '''合成线程'''
+        while not quit_event.is_set():
+            try:
+                job = self._jobs.get(timeout=1)
+            except queue.Empty:
+                continue
+            if not job.cancelled:
+                self._local.job = job
+                try:
+                    self.speak(job.msg)
+                except Exception:
+                    logger.exception('tts')
+                finally:
+                    self._local.job = None
+            job.frames.put(None)
+        loop = getattr(self._local,'loop',None)
+        if loop is not None:
+            loop.close()
+        logger.info('tts worker stop')
+
+    def event_loop(self):
+        '''合成线程自己的事件循环, 线程内一直复用, 线程退出时关闭'''
+        loop = getattr(self._local,'loop',None)
+        if loop is None:
+            loop = self._local.loop = asyncio.new_event_loop()
+        return loop
     
     def txt_to_audio(self,msg):
         pass
-    
 
-###########################################################################################
-class EdgeTTS(BaseTTS):
-    def txt_to_audio(self,msg):
-        voicename = "zh-CN-XiaoxiaoNeural"
+    def stream_audio(self,chunks,msg):
+        '''
+        (float32音频, 采样率)块依次重采样到16k切帧输出, 整条语音共用一个有状态的重采样器, 块之间不丢采样
+        最后补一个静音帧标记end
+        '''
         text,textevent = msg
-        t = time.time()
-        asyncio.new_event_loop().run_until_complete(self.__main(voicename,text))
-        logger.info(f'-------edge tts time:{time.time()-t:.4f}s')
-        if self.input_stream.getbuffer().nbytes<=0: #edgetts err
-            logger.error('edgetts err!!!!!')
+        first = True
+        resampler = None
+        pending = np.zeros(0,np.int16)
+        def put(pcm):
+            nonlocal first
+            count = len(pcm)//self.chunk
+            for i in range(count):
+                eventpoint=None
+                if first:
+                    eventpoint={'status':'start','text':text,'msgenvent':textevent}
+                    first = False
+                self.put_audio_frame(pcm[i*self.chunk:(i+1)*self.chunk],eventpoint)
+            return pcm[count*self.chunk:]
+        for stream,sample_rate in chunks:
+            if self.state!=State.RUNNING: #被打断, 关掉生成器(和里面的http响应)
+                chunks.close()
+                return
+            if resampler is None or resampler.sr_orig!=sample_rate:
+                if resampler is not None:
+                    pending = np.concatenate((pending,float_to_pcm(resampler.flush())))
+                resampler = StreamResampler(sample_rate,self.sample_rate)
+            pending = put(np.concatenate((pending,float_to_pcm(resampler.process(stream)))))
+        if resampler is not None:
+            pending = np.concatenate((pending,float_to_pcm(resampler.flush())))
+            if len(pending):
+                put(np.pad(pending,(0,-len(pending)%self.chunk)))
+        eventpoint={'status':'end','text':text,'msgenvent':textevent}
+        self.put_audio_frame(np.zeros(self.chunk,np.int16),eventpoint)
+
+    def http(self,method,url,**kwargs):
+        '''远程后端的请求走共享的keep-alive连接池'''
+        from httppool import get_pool
+        return get_pool(self.opt).request(type(self).__name__,method,url,**kwargs)
+
+    def cache_voice(self):
+        '''决定音色的参数, 参与缓存key'''
+        return {'ref_file':file_stamp(self.opt.REF_FILE),'ref_text':self.opt.REF_TEXT,'server':self.opt.TTS_SERVER}
+
+    def speak(self,msg):
+        '''合成一条消息, 缓存命中时直接回放, 否则合成并在完整输出后写入缓存'''
+        job = getattr(self._local,'job',None)
+        if self.cache is None or job is None:
+            self.txt_to_audio(msg)
             return
-        
-        self.input_stream.seek(0)
-        stream = self.__create_bytes_stream(self.input_stream)
-        streamlen = stream.shape[0]
-        idx=0
-        while streamlen >= self.chunk and self.state==State.RUNNING:
-            eventpoint=None
-            streamlen -= self.chunk
-            if idx==0:
+        text,textevent = msg
+        key = cache_key(backend=type(self).__name__,voice=self.cache_voice(),
+                        sample_rate=self.sample_rate,text=normalize_text(text))
+        pcm = self.cache.get(key)
+        if pcm is not None:
+            self.replay(pcm,msg)
+            return
+        job.recording = []
+        self.txt_to_audio(msg)
+        recording = job.recording
+        #被打断或者出错的不缓存; 只有结尾静音帧(服务返回200但没有音频)的也不缓存, 否则这句话以后一直回放静音
+        if recording and job.ended and not job.cancelled and any(frame.any() for frame in recording):
+            self.cache.put(key,np.concatenate(recording))
+
+    def mark_failed(self):
+        '''后端出错时调用, 这次合成的结果不写入缓存'''
+        job = getattr(self._local,'job',None)
+        if job is not None:
+            job.recording = None
+
+    def put_audio_frame(self,frame,eventpoint=None):
+        '''后端统一从这里输出音频帧'''
+        job = getattr(self._local,'job',None)
+        if job is None:
+            self.parent.put_audio_frame(frame,eventpoint)
+            return
+        if job.recording is not None:
+            job.recording.append(frame)
+            if eventpoint and eventpoint.get('status')=='end':
+                job.ended = True
+        job.frames.put((frame,eventpoint))
+
+    def replay(self,pcm,msg):
+        text,textevent = msg
+        job = self._local.job
+        frames = [pcm[i*self.chunk:(i+1)*self.chunk] for i in range(len(pcm)//self.chunk)]
+        if len(frames)<2: #start和end要分别标在两帧上, 不够时补静音帧
+            frames += [np.zeros(self.chunk,np.int16)]*(2-len(frames))
+        for i,frame in enumerate(frames):
+            if self.state!=State.RUNNING:
+                break
+            eventpoint = None
+            if i==0:
                 eventpoint={'status':'start','text':text,'msgenvent':textevent}
-            elif streamlen<self.chunk:
+            elif i==len(frames)-1:
                 eventpoint={'status':'end','text':text,'msgenvent':textevent}
-            self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-            idx += self.chunk
-        #if streamlen>0:  #skip last frame(not 20ms)
-        #    self.queue.put(stream[idx:])
-        self.input_stream.seek(0)
-        self.input_stream.truncate() 
-
-    def __create_bytes_stream(self,byte_stream):
-        #byte_stream=BytesIO(buffer)
-        stream, sample_rate = sf.read(byte_stream) # [T*sample_rate,] float64
-        logger.info(f'[INFO]tts audio stream {sample_rate}: {stream.shape}')
-        stream = stream.astype(np.float32)
+            job.frames.put((frame,eventpoint))
 
-        if stream.ndim > 1:
-            logger.info(f'[WARN] audio has {stream.shape[1]} channels, only use the first.')
-            stream = stream[:, 0]
-    
-        if sample_rate != self.sample_rate and stream.shape[0]>0:
-            logger.info(f'[WARN] audio sample rate is {sample_rate}, resampling into {self.sample_rate}.')
-            stream = resampy.resample(x=stream, sr_orig=sample_rate, sr_new=self.sample_rate)
+###########################################################################################
+class EdgeTTS(BaseTTS):
+    voice_name = "zh-CN-XiaoxiaoNeural"
 
-        return stream
-    
-    async def __main(self,voicename: str, text: str):
+    def cache_voice(self):
+        return {'voice':self.voice_name}
+
+    def txt_to_audio(self,msg):
+        t = time.time()
+        self.event_loop().run_until_complete(self.__main(self.voice_name,msg))
+        logger.info(f'-------edge tts time:{time.time()-t:.4f}s')
+
+    def __emit(self,frame,first,last,msg):
+        text,textevent = msg
+        eventpoint=None
+        if first:
+            eventpoint={'status':'start','text':text,'msgenvent':textevent}
+        elif last:
+            eventpoint={'status':'end','text':text,'msgenvent':textevent}
+        self.put_audio_frame(frame,eventpoint)
+
+    async def __main(self,voicename: str, msg):
+        #mp3边收边解码重采样, 凑够一帧就输出, 最后一帧留到结束时标上end
+        text,textevent = msg
+        decoder = StreamDecoder('mp3',self.sample_rate)
+        splitter = FrameSplitter(self.chunk)
+        start = time.perf_counter()
+        first = True
         try:
+            import edge_tts
             communicate = edge_tts.Communicate(text, voicename)
-
-            #with open(OUTPUT_FILE, "wb") as file:
-            first = True
             async for chunk in communicate.stream():
-                if first:
-                    first = False
-                if chunk["type"] == "audio" and self.state==State.RUNNING:
-                    #self.push_audio(chunk["data"])
-                    self.input_stream.write(chunk["data"])
-                    #file.write(chunk["data"])
+                if self.state!=State.RUNNING:
+                    break
+                if chunk["type"] == "audio":
+                    for frame in splitter.push(decoder.feed(chunk["data"])):
+                        if first:
+                            logger.info(f'edge tts time to first frame:{time.perf_counter()-start:.4f}s')
+                        self.__emit(frame,first,False,msg)
+                        first = False
                 elif chunk["type"] == "WordBoundary":
                     pass
         except Exception as e:
             logger.exception('edgetts')
+            self.mark_failed()
+        if self.state!=State.RUNNING:
+            return
+        try:
+            frames = splitter.push(decoder.flush())
+        except Exception:
+            logger.exception('edgetts decode')
+            self.mark_failed()
+            frames = []
+        frames += splitter.finish()
+        if first and not frames: #edgetts err
+            logger.error('edgetts err!!!!!')
+            return
+        if first and len(frames)<2: #只有一帧时start和end要分别标在两帧上
+            frames.append(np.zeros(self.chunk,np.int16))
+        for i,frame in enumerate(frames):
+            self.__emit(frame,first,i==len(frames)-1,msg)
+            first = False
 
 ###########################################################################################
 class LocalEdgeTTS(BaseTTS):
     """本地EdgeTTS实现，无需联网"""
+    workers = 1 #pyttsx3引擎不能多线程使用
     
     def __init__(self, opt, parent:BaseReal):
         super().__init__(opt, parent)
@@ -188,6 +425,9 @@ class LocalEdgeTTS(BaseTTS):
             logger.error(f"本地EdgeTTS初始化失败: {e}")
             self.local_tts = None
     
+    def cache_voice(self):
+        return {'voice':self.voice_name,'fallback':bool(getattr(self.local_tts,'fallback_tts',None))}
+
     def set_voice(self, voice_name: str):
         """设置语音"""
         if self.local_tts:
@@ -224,12 +464,8 @@ class LocalEdgeTTS(BaseTTS):
                 logger.error('本地EdgeTTS转换失败，无音频数据')
                 return
             
-            # 将音频数据写入输入流
-            self.input_stream.write(audio_data)
-            
             # 处理音频流
-            self.input_stream.seek(0)
-            stream = self.__create_bytes_stream(self.input_stream)
+            stream = self.__create_bytes_stream(BytesIO(audio_data))
             streamlen = stream.shape[0]
             idx = 0
             
@@ -240,16 +476,13 @@ class LocalEdgeTTS(BaseTTS):
                     eventpoint = {'status': 'start', 'text': text, 'msgenvent': textevent}
                 elif streamlen < self.chunk:
                     eventpoint = {'status': 'end', 'text': text, 'msgenvent': textevent}
-                self.parent.put_audio_frame(stream[idx:idx+self.chunk], eventpoint)
+                self.put_audio_frame(stream[idx:idx+self.chunk], eventpoint)
                 idx += self.chunk
             
-            # 重置输入流
-            self.input_stream.seek(0)
-            self.input_stream.truncate()
-            
         except Exception as e:
             logger.error(f'本地EdgeTTS转换失败: {e}')
             logger.exception('local_edgetts')
+            self.mark_failed()
     
     def __create_bytes_stream(self, byte_stream):
         """创建字节流"""
@@ -263,9 +496,9 @@ class LocalEdgeTTS(BaseTTS):
     
         if sample_rate != self.sample_rate and stream.shape[0] > 0:
             logger.info(f'[WARN] audio sample rate is {sample_rate}, resampling into {self.sample_rate}.')
-            stream = resampy.resample(x=stream, sr_orig=sample_rate, sr_new=self.sample_rate)
+            stream = resample(stream, sample_rate, self.sample_rate)
 
-        return stream
+        return float_to_pcm(stream)
 
 ###########################################################################################
 class FishTTS(BaseTTS):
@@ -291,8 +524,10 @@ class FishTTS(BaseTTS):
             'streaming':True,
             'use_memory_cache':'on'
         }
+        res = None
         try:
-            res = requests.post(
+            res = self.http(
+                "POST",
                 f"{server_url}/v1/tts",
                 json=req,
                 stream=True,
@@ -305,6 +540,7 @@ class FishTTS(BaseTTS):
 
             if res.status_code != 200:
                 logger.error("Error:%s", res.text)
+                self.mark_failed()
                 return
                 
             first = True
@@ -315,33 +551,20 @@ class FishTTS(BaseTTS):
                     end = time.perf_counter()
                     logger.info(f"fish_speech Time to first chunk: {end-start}s")
                     first = False
-                if chunk and self.state==State.RUNNING:
+                if self.state!=State.RUNNING: #被打断, 不再读剩下的响应, finally里关掉连接
+                    break
+                if chunk:
                     yield chunk
             #print("gpt_sovits response.elapsed:", res.elapsed)
         except Exception as e:
             logger.exception('fishtts')
+            self.mark_failed()
+        finally:
+            if res is not None:
+                res.close() #没读完时关掉连接, 读完的已经放回池里
 
     def stream_tts(self,audio_stream,msg):
-        text,textevent = msg
-        first = True
-        for chunk in audio_stream:
-            if chunk is not None and len(chunk)>0:          
-                stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                stream = resampy.resample(x=stream, sr_orig=44100, sr_new=self.sample_rate)
-                #byte_stream=BytesIO(buffer)
-                #stream = self.__create_bytes_stream(byte_stream)
-                streamlen = stream.shape[0]
-                idx=0
-                while streamlen >= self.chunk:
-                    eventpoint=None
-                    if first:
-                        eventpoint={'status':'start','text':text,'msgenvent':textevent}
-                        first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-                    streamlen -= self.chunk
-                    idx += self.chunk
-        eventpoint={'status':'end','text':text,'msgenvent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
+        self.stream_audio(pcm16_chunks(audio_stream,44100),msg)
 
 ###########################################################################################
 class VoitsTTS(BaseTTS):
@@ -390,8 +613,10 @@ class VoitsTTS(BaseTTS):
         req["prompt_language"] = language
 
 
+        res = None
         try:
-            res = requests.post(
+            res = self.http(
+                "POST",
                 f"{server_url}/tts",
                 json=req,
                 stream=True,
@@ -401,6 +626,7 @@ class VoitsTTS(BaseTTS):
 
             if res.status_code != 200:
                 logger.error("Error:%s", res.text)
+                self.mark_failed()
                 return
                 
             first = True
@@ -411,52 +637,45 @@ class VoitsTTS(BaseTTS):
                     end = time.perf_counter()
                     logger.info(f"gpt_sovits Time to first chunk: {end-start}s")
                     first = False
-                if chunk and self.state==State.RUNNING:
+                if self.state!=State.RUNNING: #被打断, 不再读剩下的响应, finally里关掉连接
+                    break
+                if chunk:
                     yield chunk
             #print("gpt_sovits response.elapsed:", res.elapsed)
         except Exception as e:
             logger.exception('sovits')
+            self.mark_failed()
+        finally:
+            if res is not None:
+                res.close()
 
-    def __create_bytes_stream(self,byte_stream):
-        #byte_stream=BytesIO(buffer)
-        stream, sample_rate = sf.read(byte_stream) # [T*sample_rate,] float64
-        logger.info(f'[INFO]tts audio stream {sample_rate}: {stream.shape}')
-        stream = stream.astype(np.float32)
-
-        if stream.ndim > 1:
-            logger.info(f'[WARN] audio has {stream.shape[1]} channels, only use the first.')
-            stream = stream[:, 0]
-    
-        if sample_rate != self.sample_rate and stream.shape[0]>0:
-            logger.info(f'[WARN] audio sample rate is {sample_rate}, resampling into {self.sample_rate}.')
-            stream = resampy.resample(x=stream, sr_orig=sample_rate, sr_new=self.sample_rate)
-
-        return stream
+    def __decode_chunks(self,audio_stream):
+        '''每个网络块是一段完整的音频, 单独解码, 重采样交给stream_audio'''
+        for chunk in audio_stream:
+            if chunk is not None and len(chunk)>0:
+                stream, sample_rate = sf.read(BytesIO(chunk)) # [T*sample_rate,] float64
+                stream = stream.astype(np.float32)
+                if stream.ndim > 1:
+                    logger.info(f'[WARN] audio has {stream.shape[1]} channels, only use the first.')
+                    stream = stream[:, 0]
+                yield stream, sample_rate
 
     def stream_tts(self,audio_stream,msg):
-        text,textevent = msg
-        first = True
-        for chunk in audio_stream:
-            if chunk is not None and len(chunk)>0:          
-                #stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                #stream = resampy.resample(x=stream, sr_orig=32000, sr_new=self.sample_rate)
-                byte_stream=BytesIO(chunk)
-                stream = self.__create_bytes_stream(byte_stream)
-                streamlen = stream.shape[0]
-                idx=0
-                while streamlen >= self.chunk:
-                    eventpoint=None
-                    if first:
-                        eventpoint={'status':'start','text':text,'msgenvent':textevent}
-                        first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-                    streamlen -= self.chunk
-                    idx += self.chunk
-        eventpoint={'status':'end','text':text,'msgenvent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)
+        self.stream_audio(self.__decode_chunks(audio_stream),msg)
 
 ###########################################################################################
 class CosyVoiceTTS(BaseTTS):
+    _reference = None #(file_stamp, 参考音频内容)
+
+    def reference_wav(self, reffile):
+        '''参考音频只读一次, 文件变了才重新读'''
+        stamp = file_stamp(reffile)
+        reference = self._reference
+        if reference is None or reference[0] != stamp:
+            with open(reffile, 'rb') as f:
+                reference = self._reference = (stamp, f.read())
+        return reference[1]
+
     def txt_to_audio(self,msg):
         text,textevent = msg 
         self.stream_tts(
@@ -476,15 +695,17 @@ class CosyVoiceTTS(BaseTTS):
             'tts_text': text,
             'prompt_text': reftext
         }
+        res = None
         try:
-            files = [('prompt_wav', ('prompt_wav', open(reffile, 'rb'), 'application/octet-stream'))]
-            res = requests.request("GET", f"{server_url}/inference_zero_shot", data=payload, files=files, stream=True)
+            files = [('prompt_wav', ('prompt_wav', self.reference_wav(reffile), 'application/octet-stream'))]
+            res = self.http("GET", f"{server_url}/inference_zero_shot", data=payload, files=files, stream=True)
             
             end = time.perf_counter()
             logger.info(f"cosy_voice Time to make POST: {end-start}s")
 
             if res.status_code != 200:
                 logger.error("Error:%s", res.text)
+                self.mark_failed()
                 return
                 
             first = True
@@ -494,32 +715,19 @@ class CosyVoiceTTS(BaseTTS):
                     end = time.perf_counter()
                     logger.info(f"cosy_voice Time to first chunk: {end-start}s")
                     first = False
-                if chunk and self.state==State.RUNNING:
+                if self.state!=State.RUNNING: #被打断, 不再读剩下的响应, finally里关掉连接
+                    break
+                if chunk:
                     yield chunk
         except Exception as e:
             logger.exception('cosyvoice')
+            self.mark_failed()
+        finally:
+            if res is not None:
+                res.close()
 
     def stream_tts(self,audio_stream,msg):
-        text,textevent = msg
-        first = True
-        for chunk in audio_stream:
-            if chunk is not None and len(chunk)>0:          
-                stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                stream = resampy.resample(x=stream, sr_orig=24000, sr_new=self.sample_rate)
-                #byte_stream=BytesIO(buffer)
-                #stream = self.__create_bytes_stream(byte_stream)
-                streamlen = stream.shape[0]
-                idx=0
-                while streamlen >= self.chunk:
-                    eventpoint=None
-                    if first:
-                        eventpoint={'status':'start','text':text,'msgenvent':textevent}
-                        first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-                    streamlen -= self.chunk
-                    idx += self.chunk
-        eventpoint={'status':'end','text':text,'msgenvent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
+        self.stream_audio(pcm16_chunks(audio_stream,24000),msg)
 
 ###########################################################################################
 _PROTOCOL = "https://"
@@ -593,8 +801,9 @@ class TencentTTS(BaseTTS):
             "Authorization": str(signature)
         }
         url = _PROTOCOL + _HOST + _PATH
+        res = None
         try:
-            res = requests.post(url, headers=headers,
+            res = self.http("POST", url, headers=headers,
                           data=json.dumps(params), stream=True)
             
             end = time.perf_counter()
@@ -610,23 +819,33 @@ class TencentTTS(BaseTTS):
                         #response["Code"] = rsp["Response"]["Error"]["Code"]
                         #response["Message"] = rsp["Response"]["Error"]["Message"]
                         logger.error("tencent tts:%s",rsp["Response"]["Error"]["Message"])
+                        self.mark_failed()
                         return
                     except:
                         end = time.perf_counter()
                         logger.info(f"tencent Time to first chunk: {end-start}s")
                         first = False                    
-                if chunk and self.state==State.RUNNING:
+                if self.state!=State.RUNNING: #被打断, 不再读剩下的响应, finally里关掉连接
+                    break
+                if chunk:
                     yield chunk
         except Exception as e:
             logger.exception('tencent')
+            self.mark_failed()
+        finally:
+            if res is not None:
+                res.close()
 
     def stream_tts(self,audio_stream,msg):
         text,textevent = msg
         first = True
-        last_stream = np.array([],dtype=np.float32)
+        last_stream = np.array([],dtype=np.int16)
         for chunk in audio_stream:
+            if self.state!=State.RUNNING:
+                audio_stream.close()
+                return
             if chunk is not None and len(chunk)>0:          
-                stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
+                stream = np.frombuffer(chunk, dtype=np.int16) #16k pcm, 不用转换
                 stream = np.concatenate((last_stream,stream))
                 #stream = resampy.resample(x=stream, sr_orig=24000, sr_new=self.sample_rate)
                 #byte_stream=BytesIO(buffer)
@@ -638,12 +857,12 @@ class TencentTTS(BaseTTS):
                     if first:
                         eventpoint={'status':'start','text':text,'msgenvent':textevent}
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
+                    self.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
                     streamlen -= self.chunk
                     idx += self.chunk
                 last_stream = stream[idx:] #get the remain stream
         eventpoint={'status':'end','text':text,'msgenvent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
+        self.put_audio_frame(np.zeros(self.chunk,np.int16),eventpoint) 
 
 ###########################################################################################
 
@@ -666,17 +885,21 @@ class XTTS(BaseTTS):
         )
 
     def get_speaker(self,ref_audio,server_url):
-        files = {"wav_file": ("reference.wav", open(ref_audio, "rb"))}
-        response = requests.post(f"{server_url}/clone_speaker", files=files)
+        with open(ref_audio, "rb") as f:
+            files = {"wav_file": ("reference.wav", f.read())}
+        response = self.http("POST", f"{server_url}/clone_speaker", files=files)
         return response.json()
 
     def xtts(self,text, speaker, language, server_url, stream_chunk_size) -> Iterator[bytes]:
         start = time.perf_counter()
+        speaker = dict(speaker) #合成线程共用self.speaker, 不能原地修改
         speaker["text"] = text
         speaker["language"] = language
         speaker["stream_chunk_size"] = stream_chunk_size  # you can reduce it to get faster response, but degrade quality
+        res = None
         try:
-            res = requests.post(
+            res = self.http(
+                "POST",
                 f"{server_url}/tts_stream",
                 json=speaker,
                 stream=True,
@@ -686,6 +909,7 @@ class XTTS(BaseTTS):
 
             if res.status_code != 200:
                 print("Error:", res.text)
+                self.mark_failed()
                 return
 
             first = True
@@ -695,29 +919,17 @@ class XTTS(BaseTTS):
                     end = time.perf_counter()
                     logger.info(f"xtts Time to first chunk: {end-start}s")
                     first = False
+                if self.state!=State.RUNNING:
+                    break
                 if chunk:
                     yield chunk
         except Exception as e:
             print(e)
+            self.mark_failed()
+        finally:
+            if res is not None:
+                res.close()
     
     def stream_tts(self,audio_stream,msg):
-        text,textevent = msg
-        first = True
-        for chunk in audio_stream:
-            if chunk is not None and len(chunk)>0:          
-                stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                stream = resampy.resample(x=stream, sr_orig=24000, sr_new=self.sample_rate)
-                #byte_stream=BytesIO(buffer)
-                #stream = self.__create_bytes_stream(byte_stream)
-                streamlen = stream.shape[0]
-                idx=0
-                while streamlen >= self.chunk:
-                    eventpoint=None
-                    if first:
-                        eventpoint={'status':'start','text':text,'msgenvent':textevent}
-                        first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-                    streamlen -= self.chunk
-                    idx += self.chunk
-        eventpoint={'status':'end','text':text,'msgenvent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)  
\ No newline at end of file
+        self.stream_audio(pcm16_chunks(audio_stream,24000),msg)
+ 
\ No newline at end of file
@@ -16,6 +16,7 @@
 ###############################################################################
 
 import asyncio
+import collections
 import json
 import logging
 import threading
@@ -33,6 +34,8 @@ VIDEO_PTIME = 1 / 25  # 30fps
 VIDEO_TIME_BASE = fractions.Fraction(1, VIDEO_CLOCK_RATE)
 SAMPLE_RATE = 16000
 AUDIO_TIME_BASE = fractions.Fraction(1, SAMPLE_RATE)
+DEFAULT_BUFFER_MS = 200
+MIN_BUFFER_MS = 2 * VIDEO_PTIME * 1000  # at least two video frames in flight
 
 #from aiortc.contrib.media import MediaPlayer, MediaRelay
 #from aiortc.rtcrtpsender import RTCRtpSender
@@ -43,6 +46,177 @@ from aiortc import (
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 from logger import logger as mylogger
+from audioframe import AudioFramePool
+
+
+class FrameRing:
+    """
+    Single producer / single consumer frame queue between a render thread and
+    PlayerStreamTrack.recv. The producer never schedules a coroutine, the event
+    loop is only woken when the consumer is actually waiting.
+
+    maxsize is the credit given to the producer. When it is used up the producer
+    either blocks until recv frees a slot (policy 'block') or the oldest frames
+    are dropped (policy 'drop'). Dropped items are passed to on_drop.
+    """
+
+    def __init__(self, maxsize: int = 0, policy: str = 'block', on_drop=None):
+        self._items = collections.deque()
+        self._loop = None
+        self._waiter = None
+        self._lock = threading.Lock() #guards the waiter handoff and drops, held only for a few bytecodes
+        self.maxsize = maxsize
+        self.policy = policy
+        self.on_drop = on_drop
+        self._gop_lost = False #a dropped packet left the next ones undecodable until a keyframe
+        self._space = threading.Condition()
+        self._blocked = False
+        self._closed = False
+        self.puts = 0
+        self.wakeups = 0
+        self.dropped = 0
+
+    def push(self, item) -> None:
+        self.push_many((item,))
+
+    def push_many(self, items) -> None:
+        """called from the render thread, one loop wakeup per batch at most"""
+        drop = self.maxsize > 0 and self.policy == 'drop'
+        if self.maxsize > 0 and not drop:
+            while not self.wait_credit(len(items), 1):
+                pass
+        if self._closed:
+            return
+        with self._lock:
+            self._items.extend(items)
+            dropped = self._trim() if drop else ()
+            waiter = None
+            if self._items: #everything dropped, the consumer keeps waiting
+                waiter, self._waiter = self._waiter, None
+        self.puts += len(items)
+        self.dropped += len(dropped)
+        if self.on_drop is not None:
+            for item in dropped:
+                self.on_drop(item)
+        if waiter is not None:
+            self.wakeups += 1
+            self._loop.call_soon_threadsafe(self._wake, waiter)
+
+    def _trim(self) -> list:
+        """
+        drop the oldest items beyond maxsize, called with _lock held.
+        An encoded Packet depends on the ones before it, so dropping one also
+        drops the rest of its GOP, the ring resumes at the next keyframe or at
+        a raw frame (recv asks the encoder for a keyframe when passthrough ends).
+        """
+        items = self._items
+        dropped = []
+        lost = self._gop_lost
+        while items:
+            frame = items[0][0]
+            packet = isinstance(frame, Packet)
+            if not (len(items) > self.maxsize or (lost and packet and not frame.is_keyframe)):
+                break
+            dropped.append(items.popleft())
+            lost = packet
+        self._gop_lost = lost and not items
+        return dropped
+
+    def wait_credit(self, n: int = 1, timeout: Optional[float] = None) -> bool:
+        """block the producer until n more frames fit, False on timeout"""
+        if self.maxsize <= 0 or self._closed or len(self._items) + n <= self.maxsize:
+            return True
+        with self._space:
+            self._blocked = True
+            ok = self._space.wait_for(lambda: self._closed or len(self._items) + n <= self.maxsize, timeout)
+            self._blocked = False
+        return ok
+
+    @staticmethod
+    def _wake(waiter) -> None:
+        if not waiter.done():
+            waiter.set_result(None)
+
+    async def get(self):
+        while True:
+            self._loop = asyncio.get_running_loop()
+            waiter = self._loop.create_future()
+            with self._lock: #producer pushed or dropped before it could see the waiter
+                if self._items:
+                    item = self._items.popleft()
+                    break
+                self._waiter = waiter
+            await waiter
+        if self._blocked: #give the credit back
+            with self._space:
+                self._space.notify()
+        return item
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def close(self) -> None:
+        """release a blocked producer, later pushes are discarded"""
+        self._closed = True
+        with self._space:
+            self._space.notify_all()
+
+
+def buffer_ms(opt) -> float:
+    """--max_buffer_ms, 0 means the default, never less than two video frames"""
+    return max(getattr(opt, 'max_buffer_ms', 0) or DEFAULT_BUFFER_MS, MIN_BUFFER_MS)
+
+
+class MediaClock:
+    """
+    Monotonic clock shared by the audio and video track of one HumanPlayer.
+    Both tracks pace against it and report the media time at which each frame
+    is presented; the difference of their presentation delays is the A/V offset.
+    """
+
+    def __init__(self, max_lag: float = 0.5, tolerance: float = 0.02):
+        self._start = None
+        self.max_lag = max_lag
+        self.tolerance = tolerance
+        self.delay = {'audio': None, 'video': None} #media time - content time
+        self.late = {'audio': 0, 'video': 0}
+        self.resyncs = {'audio': 0, 'video': 0}
+
+    def start(self) -> None:
+        if self._start is None:
+            self._start = time.monotonic()
+
+    def now(self) -> float:
+        return time.monotonic() - self._start
+
+    def presented(self, kind: str, media_time: float, content_time: float) -> None:
+        self.delay[kind] = media_time - content_time
+
+    def av_offset(self) -> float:
+        """seconds, > 0 when video is presented later than the matching audio"""
+        if self.delay['audio'] is None or self.delay['video'] is None:
+            return 0.0
+        return self.delay['video'] - self.delay['audio']
+
+    def correction(self, kind: str, ptime: float) -> float:
+        """extra delay for the track that runs ahead, at most half a frame per frame"""
+        other = 'audio' if kind == 'video' else 'video'
+        if self.delay[kind] is None or self.delay[other] is None:
+            return 0.0
+        skew = self.delay[other] - self.delay[kind]
+        if skew > self.tolerance:
+            return min(skew, ptime / 2)
+        return 0.0
+
+    def stats(self) -> Dict:
+        return {
+            'av_offset_ms': round(self.av_offset() * 1000, 1),
+            'late': dict(self.late),
+            'resyncs': dict(self.resyncs),
+        }
 
 
 class PlayerStreamTrack(MediaStreamTrack):
@@ -50,18 +224,32 @@ class PlayerStreamTrack(MediaStreamTrack):
     A video track that returns an animated flag.
     """
 
-    def __init__(self, player, kind):
+    def __init__(self, player, kind, clock, max_buffer_ms=DEFAULT_BUFFER_MS, policy='block'):
         super().__init__()  # don't forget this!
         self.kind = kind
         self._player = player
-        self._queue = asyncio.Queue()
-        self.timelist = [] #记录最近包的时间戳
+        self._clock = clock
+        self._sent = 0
+        ptime = VIDEO_PTIME if kind == 'video' else AUDIO_PTIME
+        self.buffer_ms = max_buffer_ms #渲染循环等待额度的超时
         if self.kind == 'video':
+            self._passthrough = False #上一帧是否是透传的已编码包
             self.framecount = 0
             self.lasttime = time.perf_counter()
             self.totaltime = 0
+            on_drop = None
+        else:
+            self.pool = AudioFramePool(int(AUDIO_PTIME * SAMPLE_RATE))
+            self._last = None #上一次返回的帧,编码器用完后才能回收
+            on_drop = self._recycle
+        self._queue = FrameRing(int(max_buffer_ms / 1000 / ptime), policy, on_drop)
+
+    def _recycle(self, item) -> None:
+        """dropped audio frames go back to the pool"""
+        frame, _ = item
+        if frame is not None:
+            self.pool.release(frame)
     
-    _start: float
     _timestamp: int
 
     async def next_timestamp(self) -> Tuple[int, fractions.Fraction]:
@@ -69,40 +257,30 @@ class PlayerStreamTrack(MediaStreamTrack):
             raise Exception
 
         if self.kind == 'video':
-            if hasattr(self, "_timestamp"):
-                #self._timestamp = (time.time()-self._start) * VIDEO_CLOCK_RATE
-                self._timestamp += int(VIDEO_PTIME * VIDEO_CLOCK_RATE)
-                wait = self._start + (self._timestamp / VIDEO_CLOCK_RATE) - time.time()
-                # wait = self.timelist[0] + len(self.timelist)*VIDEO_PTIME - time.time()               
-                if wait>0:
-                    await asyncio.sleep(wait)
-                # if len(self.timelist)>=100:
-                #     self.timelist.pop(0)
-                # self.timelist.append(time.time())
-            else:
-                self._start = time.time()
-                self._timestamp = 0
-                self.timelist.append(self._start)
-                mylogger.info('video start:%f',self._start)
-            return self._timestamp, VIDEO_TIME_BASE
+            rate, ptime, time_base = VIDEO_CLOCK_RATE, VIDEO_PTIME, VIDEO_TIME_BASE
         else: #audio
-            if hasattr(self, "_timestamp"):
-                #self._timestamp = (time.time()-self._start) * SAMPLE_RATE
-                self._timestamp += int(AUDIO_PTIME * SAMPLE_RATE)
-                wait = self._start + (self._timestamp / SAMPLE_RATE) - time.time()
-                # wait = self.timelist[0] + len(self.timelist)*AUDIO_PTIME - time.time()
-                if wait>0:
-                    await asyncio.sleep(wait)
-                # if len(self.timelist)>=200:
-                #     self.timelist.pop(0)
-                #     self.timelist.pop(0)
-                # self.timelist.append(time.time())
-            else:
-                self._start = time.time()
-                self._timestamp = 0
-                self.timelist.append(self._start)
-                mylogger.info('audio start:%f',self._start)
-            return self._timestamp, AUDIO_TIME_BASE
+            rate, ptime, time_base = SAMPLE_RATE, AUDIO_PTIME, AUDIO_TIME_BASE
+        clock = self._clock
+        if hasattr(self, "_timestamp"):
+            self._timestamp += int(ptime * rate)
+            #比另一条轨道超前时逐帧放慢,把累计的音画偏差拉回来
+            self._timestamp += int(clock.correction(self.kind, ptime) * rate)
+            wait = self._timestamp / rate - clock.now()
+            if wait>0:
+                await asyncio.sleep(wait)
+            elif -wait > ptime:
+                clock.late[self.kind] += 1
+                if -wait > clock.max_lag: #落后太多不再追赶,跳到当前时间,避免突发发送
+                    self._timestamp = int(clock.now() * rate)
+                    clock.resyncs[self.kind] += 1
+        else:
+            clock.start()
+            self._timestamp = int(clock.now() * rate)
+            mylogger.info('%s start:%f', self.kind, clock.now())
+        content_time = (self._sent + self._queue.dropped) * ptime
+        self._sent += 1
+        clock.presented(self.kind, self._timestamp / rate, content_time)
+        return self._timestamp, time_base
 
     async def recv(self) -> Union[Frame, Packet]:
         # frame = self.frames[self.counter % 30]            
@@ -124,11 +302,21 @@ class PlayerStreamTrack(MediaStreamTrack):
         #     else:
         #         frame = await self._queue.get()
         frame,eventpoint = await self._queue.get()
+        if self.kind == 'audio':
+            if self._last is not None:
+                self.pool.release(self._last)
+            self._last = frame
         pts, time_base = await self.next_timestamp()
         frame.pts = pts
         frame.time_base = time_base
         if eventpoint:
             self._player.notify(eventpoint)
+        if self.kind == 'video':
+            if isinstance(frame, Packet):
+                self._passthrough = True
+            elif self._passthrough: #透传结束,恢复编码时要从关键帧开始
+                self._passthrough = False
+                self._player.request_keyframe()
         if frame is None:
             self.stop()
             raise Exception
@@ -137,13 +325,38 @@ class PlayerStreamTrack(MediaStreamTrack):
             self.framecount += 1
             self.lasttime = time.perf_counter()
             if self.framecount==100:
-                mylogger.info(f"------actual avg final fps:{self.framecount/self.totaltime:.4f}")
+                mylogger.info(f"------actual avg final fps:{self.framecount/self.totaltime:.4f} ring puts:{self._queue.puts} wakeups:{self._queue.wakeups} dropped:{self._queue.dropped} av offset:{self._clock.av_offset()*1000:.1f}ms late:{self._clock.late}")
                 self.framecount = 0
                 self.totaltime=0
         return frame
     
+    def tap(self, callback):
+        """
+        Wrap recv: every frame or packet goes through callback, run in the thread
+        pool, before the RTCRtpSender sees it. callback returns what the sender
+        gets, None to skip to the next frame. Returns a function removing the tap.
+        """
+        recv = self.recv
+
+        async def tapped():
+            loop = asyncio.get_running_loop()
+            while True:
+                data = await loop.run_in_executor(None, callback, await recv())
+                if data is not None:
+                    return data
+
+        self.recv = tapped
+
+        def untap():
+            if self.__dict__.get('recv') is tapped:
+                del self.recv
+                if self.kind == 'video':
+                    self._passthrough = True #the sender's encoder takes over, start it with a keyframe
+        return untap
+
     def stop(self):
         super().stop()
+        self._queue.close()
         if self._player is not None:
             self._player._stop(self)
             self._player = None
@@ -170,14 +383,58 @@ class HumanPlayer:
         self.__audio: Optional[PlayerStreamTrack] = None
         self.__video: Optional[PlayerStreamTrack] = None
 
-        self.__audio = PlayerStreamTrack(self, kind="audio")
-        self.__video = PlayerStreamTrack(self, kind="video")
+        opt = nerfreal.opt
+        max_buffer_ms = buffer_ms(opt)
+        policy = getattr(opt, 'buffer_policy', 'block')
+        self.clock = MediaClock()
+        self.__audio = PlayerStreamTrack(self, kind="audio", clock=self.clock, max_buffer_ms=max_buffer_ms, policy=policy)
+        self.__video = PlayerStreamTrack(self, kind="video", clock=self.clock, max_buffer_ms=max_buffer_ms, policy=policy)
 
         self.__container = nerfreal
+        self.__video_sender = None
+        self.__h264 = False
+
+    def set_video_codec(self, video_sender, video_codec) -> None:
+        """
+        Keep the negotiated video codec and the sender keyframe requests go to.
+        """
+        self.__video_sender = video_sender
+        self.__h264 = video_codec == 'H264'
+
+    @property
+    def packet_tracks(self) -> Optional[Dict[str, PlayerStreamTrack]]:
+        """tracks whose frames can be encoded once for webrtc and the recording, None unless video is H264"""
+        if not self.__h264:
+            return None
+        return {'audio': self.__audio, 'video': self.__video}
+
+    def set_video_sender(self, sender) -> None:
+        """
+        Enable idle packet passthrough on the session, the sender must have negotiated H264.
+        """
+        self.__video_sender = sender
+        self.__container.idle_passthrough = True
+
+    def request_keyframe(self) -> None:
+        if self.__video_sender is not None:
+            self.__video_sender._send_keyframe()
 
     def notify(self,eventpoint):
         self.__container.notify(eventpoint)
 
+    def stats(self) -> Dict:
+        """A/V sync and buffer telemetry of this session"""
+        stats = self.clock.stats()
+        for kind, track in (('audio', self.__audio), ('video', self.__video)):
+            stats[kind] = {
+                'sent': track._sent,
+                'buffered': track._queue.qsize(),
+                'dropped': track._queue.dropped,
+                'late': self.clock.late[kind],
+                'resyncs': self.clock.resyncs[kind],
+            }
+        return stats
+
     @property
     def audio(self) -> MediaStreamTrack:
         """
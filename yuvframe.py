@@ -0,0 +1,118 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# 合成器直接输出yuv420p(I420), 编码器不用再做整帧的bgr->yuv转换
+# I420数组布局和cv2.COLOR_BGR2YUV_I420一致: shape (h*3/2, w), Y平面后面接U,V平面
+
+import threading
+
+import cv2
+
+def even_size(frame):
+    h, w = frame.shape[:2]
+    return h % 2 == 0 and w % 2 == 0
+
+def bgr_to_i420(image):
+    return cv2.cvtColor(image, cv2.COLOR_BGR2YUV_I420)
+
+def i420_planes(yuv, w, h):
+    """返回Y,U,V三个平面的视图"""
+    flat = yuv.reshape(-1)
+    y = flat[:w*h].reshape(h, w)
+    u = flat[w*h:w*h*5//4].reshape(h//2, w//2)
+    v = flat[w*h*5//4:w*h*3//2].reshape(h//2, w//2)
+    return y, u, v
+
+def paste_i420(bg_yuv, bg_bgr, patch, x1, y1):
+    """
+    把bgr小图patch贴到背景帧的(x1,y1)处, 返回新的I420帧
+    只转换patch所在的区域(扩展到偶数边界, 色度是2x2采样), 背景I420整帧只做一次拷贝
+    """
+    h, w = bg_bgr.shape[:2]
+    ph, pw = patch.shape[:2]
+    # 裁掉超出画面的部分
+    if x1 < 0:
+        patch = patch[:, -x1:]
+        x1 = 0
+    if y1 < 0:
+        patch = patch[-y1:]
+        y1 = 0
+    patch = patch[:h-y1, :w-x1]
+    ph, pw = patch.shape[:2]
+    if ph <= 0 or pw <= 0:
+        return bg_yuv
+
+    ex1, ey1 = x1 & ~1, y1 & ~1
+    ex2, ey2 = min(w, (x1+pw+1) & ~1), min(h, (y1+ph+1) & ~1)
+    roi = bg_bgr[ey1:ey2, ex1:ex2].copy()
+    roi[y1-ey1:y1-ey1+ph, x1-ex1:x1-ex1+pw] = patch
+    roi_yuv = bgr_to_i420(roi)
+
+    out = bg_yuv.copy()
+    rh, rw = ey2-ey1, ex2-ex1
+    dy, du, dv = i420_planes(out, w, h)
+    sy, su, sv = i420_planes(roi_yuv, rw, rh)
+    dy[ey1:ey2, ex1:ex2] = sy
+    du[ey1//2:ey2//2, ex1//2:ex2//2] = su
+    dv[ey1//2:ey2//2, ex1//2:ex2//2] = sv
+    return out
+
+
+class YuvCycle:
+    """一个帧序列对应的I420缓存, 第一次访问某帧时转换"""
+
+    def __init__(self, frames):
+        self.frames = frames
+        self._yuv = [None] * len(frames)
+        self.streaming = getattr(frames, 'streaming', False) #按需解码的帧序列不缓存转换结果
+
+    def __len__(self):
+        return len(self._yuv)
+
+    def __getitem__(self, idx):
+        yuv = self._yuv[idx]
+        if yuv is None:
+            yuv = bgr_to_i420(self.frames[idx])
+            if not self.streaming:
+                self._yuv[idx] = yuv  # 多线程同时转换同一帧结果一样, 不加锁
+        return yuv
+
+
+class YuvCycleCache:
+    """进程级缓存, 同一份帧序列(avatar的frame_list_cycle, 同一路径的自定义视频)所有会话共享"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cycles = {}
+
+    def get(self, key, frames):
+        cycle = self._cycles.get(key)
+        if cycle is None:
+            with self._lock:
+                cycle = self._cycles.get(key)
+                if cycle is None:
+                    cycle = YuvCycle(frames)
+                    self._cycles[key] = cycle
+        return cycle
+
+    def discard(self, key):
+        """删除key开头的所有缓存"""
+        with self._lock:
+            for k in [k for k in self._cycles if k[:len(key)] == key]:
+                del self._cycles[k]
+
+yuv_cache = YuvCycleCache()